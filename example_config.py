@@ -52,6 +52,10 @@ JOSECOIN_API = 'http://0.0.0.0:8080/api'
 # generated using ./jcoin/client_add.py
 JOSECOIN_TOKEN = 'something secret'
 
+# Connections to the JoséCoin API, and seconds before a call times out
+# JOSECOIN_POOL_SIZE = 20
+# JOSECOIN_TIMEOUT = 10
+
 # Where to put guild logs (join, leave, available, unavailable)
 GUILD_LOG_CHAN = 'a webhook url'
 
@@ -1,7 +1,6 @@
 import logging
 import datetime
 import decimal
-from random import uniform
 
 import discord
 from discord.ext import commands
@@ -12,17 +11,18 @@ from .coins import AccountType
 
 log = logging.getLogger(__name__)
 
-# steal constants
-BASE_CHANCE = decimal.Decimal('1')
-STEAL_CONSTANT = decimal.Decimal('0.42')
-
 # 6 hours in jail by default
-# 9 hours for point regen
 DEFAULT_ARREST = 6
-DEFAULT_REGEN = 9
 
-# how many hours for grace periods
-GRACE_PERIOD = 5
+# how much of the tax paid is given back on tax returns
+TAXRETURN_RATE = decimal.Decimal('0.25')
+
+# why the backend arrested a thief
+ARREST_REASONS = {
+    'infinite': 'You can not steal from this account.',
+    'too_much': 'Trying to steal more than the target',
+    'roll': '',
+}
 
 
 class CooldownTypes:
@@ -44,7 +44,8 @@ class CoinsExt(Cog, requires=['coins']):
     def coins2(self):
         return self.bot.get_cog('Coins2')
 
-    async def show(self, ctx, accounts, *, field='amount', limit=10):
+    async def show(self, ctx, accounts, *, field='amount', limit=10,
+                   start=0):
         """Show a list of accounts"""
         filtered = []
 
@@ -59,8 +60,8 @@ class CoinsExt(Cog, requires=['coins']):
         table = Table('pos', 'name', 'account id', field)
         for idx, account in enumerate(filtered):
             table.add_row(
-                str(idx + 1), account['_name'], str(account['account_id']),
-                str(account[field]))
+                str(start + idx + 1), account['_name'],
+                str(account['account_id']), str(account[field]))
 
         rendered = await table.render(loop=self.loop)
 
@@ -69,8 +70,28 @@ class CoinsExt(Cog, requires=['coins']):
         else:
             await ctx.send(f'```\n{rendered}```')
 
+    async def get_page(self, params: dict, field: str, page: int) -> list:
+        """Get a page of a leaderboard.
+
+        The API paginates with a cursor (the last account of
+        the previous page), so pages are walked in order.
+        """
+        accounts = []
+        for _ in range(page):
+            if accounts:
+                last = accounts[-1]
+                params['after_value'] = last[field]
+                params['after_id'] = last['account_id']
+
+            accounts = await self.coins.jc_get('/wallets', params)
+            if not accounts:
+                break
+
+        return accounts
+
     @commands.command()
-    async def top(self, ctx, mode: str = 'g', limit: int = 10):
+    async def top(self, ctx, mode: str = 'g', limit: int = 10,
+                  page: int = 1):
         """Show accounts by specific criteria.
 
         'global' means all accounts in josé.
@@ -88,51 +109,59 @@ class CoinsExt(Cog, requires=['coins']):
         if limit > 30 or limit < 1:
             raise self.SayException('invalid limit')
 
+        if page > 20 or page < 1:
+            raise self.SayException('invalid page')
+
+        field = 'amount'
+
         if mode == 'g':
-            accounts = await self.coins.jc_get(
-                '/wallets', {
-                    'key': 'global',
-                    'reverse': True,
-                    'type': self.coins.AccountType.USER,
-                    'limit': limit,
-                })
+            params = {
+                'key': 'global',
+                'reverse': True,
+                'type': self.coins.AccountType.USER,
+                'limit': limit,
+            }
         elif mode == 'l':
-            accounts = await self.coins.jc_get(
-                '/wallets', {
-                    'key': 'local',
-                    'guild_id': ctx.guild.id,
-                    'reverse': True,
-                    'limit': limit
-                })
+            params = {
+                'key': 'local',
+                'guild_id': ctx.guild.id,
+                'reverse': True,
+                'limit': limit
+            }
         elif mode == 't':
-            accounts = await self.coins.jc_get('/wallets', {
+            params = {
                 'key': 'taxpaid',
                 'reverse': True,
                 'limit': limit,
-            })
-            return await self.show(ctx, accounts, field='taxpaid', limit=limit)
+            }
+            field = 'taxpaid'
         elif mode == 'b':
-            accounts = await self.coins.jc_get('/wallets', {
+            params = {
                 'key': 'taxbanks',
                 'reverse': True,
                 'limit': limit,
-            })
+            }
         elif mode == 'p':
-            accounts = await self.coins.jc_get('/wallets', {
+            params = {
                 'key': 'global',
                 'type': AccountType.USER,
                 'limit': limit,
-            })
+            }
         elif mode == 'lp':
-            accounts = await self.coins.jc_get('/wallets', {
+            params = {
                 'key': 'local',
                 'guild_id': ctx.guild.id,
                 'limit': limit,
-            })
+            }
         else:
             raise self.SayException('mode not found')
 
-        await self.show(ctx, accounts, limit=limit)
+        accounts = await self.get_page(params, field, page)
+        if not accounts:
+            raise self.SayException('no accounts in this page')
+
+        await self.show(ctx, accounts, field=field, limit=limit,
+                        start=(page - 1) * limit)
 
     @commands.command(name='prices')
     async def _prices(self, ctx):
@@ -232,133 +261,27 @@ class CoinsExt(Cog, requires=['coins']):
                                         ' You are waiting for steal points. '
                                         f'Wait {fmt_tdelta(remaining)} hours')
 
-    async def check_grace(self, target: discord.User):
-        """Check if the target is in grace period."""
-        now = datetime.datetime.utcnow()
-        grace = await self.pool.fetchrow("""
-        SELECT finish FROM steal_grace
-        WHERE user_id = $1
-        """, target.id)
+    def steal_info(self, steal: dict) -> str:
+        """Show the information about the result of a steal."""
+        msg_res = []
 
-        if not grace:
-            return
-
-        if now < grace['finish']:
-            remaining = grace['finish'] - now
-            raise self.SayException('\N{BABY ANGEL} Your target is in'
-                                    ' grace period. it will expire in'
-                                    f' {fmt_tdelta(remaining)} hours')
-
-    async def check_points(self, thief: discord.User):
-        """Check if current thief has enough steal points,
-        decrement 1 from them if thief has enough,
-        puts cooldown if it reaches 0."""
-        points = await self.pool.fetchrow("""
-        SELECT points FROM steal_points
-        WHERE user_id = $1
-        """, thief.id)
-
-        if not points:
-            await self.pool.execute("""
-            INSERT INTO steal_points (user_id)
-            VALUES ($1)
-            """, thief.id)
-            points = {'points': 3}
-
-        if points['points'] < 1:
-            await self.add_cooldown(thief, CooldownTypes.points, DEFAULT_REGEN)
-            raise self.SayException('\N{FACE WITH TEARS OF JOY}'
-                                    ' You ran out of stealing points!'
-                                    f' wait {DEFAULT_REGEN} hours.')
-
-        await self.pool.execute("""
-        UPDATE steal_points
-        SET points = points - 1
-        WHERE user_id = $1
-        """, thief.id)
-
-        if (points['points'] - 1) < 1:
-            await self.add_cooldown(thief, CooldownTypes.points, DEFAULT_REGEN)
-
-    async def add_grace(self, target: discord.User, hours: int):
-        """Add a grace period to the target.
-
-        Removes an existing grace period.
-        """
-        grace = await self.pool.fetch("""
-        SELECT finish FROM steal_grace
-        WHERE user_id = $1
-        """, target.id)
-
-        if grace:
-            await self.pool.execute("""
-            DELETE FROM steal_grace
-            WHERE user_id = $1
-            """, target.id)
-
-        # Yes, I know, SQL injection, again.
-        await self.pool.execute(f"""
-        INSERT INTO steal_grace (user_id, finish)
-        VALUES ($1, now() + interval '{hours} hours')
-        """, target.id)
+        if 'chance' in steal:
+            msg_res.append(f'`[chance: {steal["chance"]} | '
+                           f'res: {steal["res"]}]`')
 
-    async def arrest(self, ctx, amount: decimal.Decimal) -> tuple:
-        """Arrest the thief.
-
-        Returns
-        -------
-        tuple
-            with information about the arrest,
-            and how many hours does the thief get
-            in prison.
-        """
-        thief = ctx.author
-        guild = ctx.guild
-        fee = amount / 2
-
-        # maintain sanity
-        await self.coins.ensure_ctx(ctx)
-
-        log.debug(f'arresting {thief}[{thief.id}]')
-
-        try:
-            transfer_info = await self.coins.transfer_str(thief, guild, fee)
-            # fee is paid, jail.
-            hours = await self.add_cooldown(thief)
-        except self.coins.ConditionError:
-            # fee is not paid, BIG JAIL.
-            thief_acc = await self.coins.get_account(thief)
-            amnt = thief_acc['amount']
-
-            # zero the wallet, convert 1jc to extra hour in jail
-            transfer_info = await self.coins.zero(thief, ctx.guild.id)
-            hours = await self.add_cooldown(thief, CooldownTypes.prison,
-                                            DEFAULT_ARREST + int(amnt))
-
-        return hours, transfer_info
-
-    def info_arrest(self, hours: int, transfer_info: str, message: str):
-        """Generate a SayException with the information on the autojail."""
-        raise self.SayException(f'\N{POLICE OFFICER} You got '
-                                f'arrested! {message}\n{hours}h in jail.\n'
-                                f'`{transfer_info}`')
-
-    def steal_info(self,
-                   res: float,
-                   chance: float,
-                   transfer_info: str,
-                   hours: int = None):
-        """Show the information about the success / failure of a steal."""
-        msg_res = [f'`[chance: {chance} | res: {res}]`']
-
-        if res < chance:
+        if steal['status'] == 'success':
             msg_res.append(f'Congrats!')
         else:
-            msg_res.append(f'\N{POLICE OFFICER} Arrested!')
-            msg_res.append(f'{hours}h in jail.')
+            msg_res.append(f'\N{POLICE OFFICER} Arrested! '
+                           f'{ARREST_REASONS[steal["reason"]]}')
+            msg_res.append(f'{steal["hours"]}h in jail.')
+
+        for transfer in steal['transfers']:
+            msg_res.append(f'`{self.coins.get_name(transfer["sender"])} > '
+                           f'{transfer["amount"]} > '
+                           f'{self.coins.get_name(transfer["receiver"])}`')
 
-        msg_res.append(transfer_info)
-        raise self.SayException('\n'.join(msg_res))
+        return '\n'.join(msg_res)
 
     @commands.command(name='steal')
     @commands.guild_only()
@@ -391,105 +314,57 @@ class CoinsExt(Cog, requires=['coins']):
         if thief == target:
             raise self.SayException('You can not steal from yourself')
 
-        # make sure both have accounts
+        # the whole steal happens in the backend
         try:
-            thief_acc = await c2.get_account(thief.id)
-            target_acc = await c2.get_account(target.id)
+            steal = await c2.jc_post('/steal', {
+                'thief': thief.id,
+                'target': target.id,
+                'guild_id': ctx.guild.id,
+                'amount': str(amount),
+            })
         except c2.AccountNotFoundError:
             raise self.SayException("One of you don't have a JoséCoin wallet")
 
-        if amount <= 0.01:
-            raise self.SayException('\N{LOW BRIGHTNESS SYMBOL} '
-                                    'Stealing too low.')
-
-        if thief_acc['amount'] < 6:
-            raise self.SayException("You have less than `6JC`, "
-                                    "can't use the steal command")
+        c2.drop_caches([thief.id, target.id, ctx.guild.id])
 
-        if target_acc['amount'] < 3:
-            raise self.SayException('Target has less than `3JC`, '
-                                    'cannot steal them')
+        status = steal['status']
+        if status == 'cooldown':
+            remaining = fmt_tdelta(
+                datetime.timedelta(seconds=steal['remaining']))
 
-        if amount > 2 * thief_acc['amount']:
-            raise self.SayException('You can not steal more than double '
-                                    'your current wallet amount.')
-
-        try:
-            await c2.lock(thief.id, target.id)
-
-            await self.check_cooldowns(thief)
-            await self.check_grace(target)
-            await self.check_points(thief)
-
-            await c2.jc_post(f'/wallets/{thief.id}/steal_use')
-            await c2.unlock(thief.id, target.id)
-
-            # checking for other stuff that cause autojail
-            if target_acc['amount'] == -69:
-                hours, transfer_info = await self.arrest(ctx, amount)
-                self.info_arrest(hours, transfer_info,
-                                 'You can not steal from this account.')
-
-            t_amnt = target_acc['amount']
-            if amount > t_amnt:
-                hours, transfer_info = await self.arrest(ctx, amount)
-                self.info_arrest(hours, transfer_info,
-                                 'Trying to steal more than the target')
-
-            chance = (BASE_CHANCE + (t_amnt / amount)) * STEAL_CONSTANT
-            if chance > 5:
-                chance = 5
-            chance = round(chance, 3)
-
-            res = uniform(0, 10)
-            res = round(res, 3)
+            if steal['cooldown'] == CooldownTypes.prison:
+                raise self.SayException('\N{POLICE CAR} You are still in '
+                                        f'prison, wait {remaining} hours')
+
+            raise self.SayException('\N{DIAMOND SHAPE WITH A DOT INSIDE}'
+                                    ' You are waiting for steal points. '
+                                    f'Wait {remaining} hours')
+        elif status == 'grace':
+            remaining = fmt_tdelta(
+                datetime.timedelta(seconds=steal['remaining']))
+            raise self.SayException('\N{BABY ANGEL} Your target is in'
+                                    ' grace period. it will expire in'
+                                    f' {remaining} hours')
+        elif status == 'no_points':
+            raise self.SayException('\N{FACE WITH TEARS OF JOY}'
+                                    ' You ran out of stealing points!'
+                                    f' wait {steal["hours"]} hours.')
 
-            log.info(f'[steal] chance={chance} res={res} amount={amount}'
-                     f' t_amnt={t_amnt} '
-                     f'thief={thief}[{thief.id}] target={target}[{target.id}]')
+        c2.transfers_done += len(steal['transfers'])
 
-            success = res < chance
+        if status == 'success':
+            grace = decimal.Decimal(steal['grace'])
+            try:
+                grace_s = f'{grace}h grace period' if grace > 0 else \
+                    '(NO GRACE AVAILABLE)'
+                await target.send(':gun: **You were robbed!** '
+                                  f'The thief(`{thief}`) stole '
+                                  f'{amount} from you. '
+                                  f'{grace_s}')
+            except:
+                pass
 
-            # log steal
-            await self.pool.execute("""
-                insert into steal_history (thief, target, target_before,
-                    amount, success, chance, res)
-                values ($1, $2, $3, $4, $5, $6, $7)
-            """, thief.id, target.id, t_amnt, amount, success, chance, res)
-
-            if success:
-                # success
-                await c2.jc_post(f'/wallets/{thief.id}/steal_success')
-                transfer_info = await c2.transfer_str(target.id, thief.id,
-                                                      amount)
-
-                grace = GRACE_PERIOD
-
-                if t_amnt > 200:
-                    # decrease grace period the richer you are
-                    temp = t_amnt * (decimal.Decimal('0.3') * t_amnt)
-                    grace -= (temp / amount) * decimal.Decimal(0.001)
-
-                try:
-                    grace_s = f'{grace}h grace period' if grace > 0 else \
-                        '(NO GRACE AVAILABLE)'
-                    await target.send(':gun: **You were robbed!** '
-                                      f'The thief(`{thief}`) stole '
-                                      f'{amount} from you. '
-                                      f'{grace_s}')
-                except:
-                    pass
-
-                if grace > 0:
-                    await self.add_grace(target, GRACE_PERIOD)
-
-                self.steal_info(res, chance, transfer_info)
-            else:
-                # jail
-                hours, transfer_info = await self.arrest(ctx, amount)
-                self.steal_info(res, chance, transfer_info, hours)
-        finally:
-            await c2.unlock(thief.id, target.id)
+        raise self.SayException(self.steal_info(steal))
 
     @commands.command(name='stealstate', aliases=['stealstatus'])
     async def stealstate(self, ctx):
@@ -580,58 +455,37 @@ class CoinsExt(Cog, requires=['coins']):
         """
         await ctx.invoke(self.bot.get_command('help'), 'txr')
 
-    async def txr_transactions(self, user: discord.User) -> list:
-        """Get all tax transactions done by the user.
+    async def txr_summary(self, user: discord.User) -> tuple:
+        """Get the tax paid that fits the tax return
+        criteria and how many transactions it came from.
 
-        Only transactions that are above average count torwards
-        the list.
+        This reads the tax return ledger, which is kept
+        by the backend on every tax transfer.
 
         Returns
         -------
-        list[asyncpg.Record]
-            List of transactions that satisfy the criteria.
-        """
-        return await self.pool.fetch("""
-        select *
-        from transactions
-
-        join accounts on transactions.receiver = accounts.account_id
-
-        where transactions.sender=$1
-         and accounts.account_type=1
-         and transactions.amount >= 5
-         and transactions.taxreturn_used = false
-        """, user.id)
-
-    async def txr_total(self, user: discord.User) -> decimal.Decimal:
-        """Get the total amount of tax that is available
-        to be returned to the user.
+        tuple[decimal.Decimal, int]
         """
-
-        return await self.pool.fetchval("""
-        select sum(transactions.amount) * 25/100
-        from transactions
-
-        join accounts on transactions.receiver = accounts.account_id
-
-        where transactions.sender=$1
-         and accounts.account_type=1
-         and transactions.amount >= 5
-         and transactions.taxreturn_used = false
+        row = await self.pool.fetchrow("""
+        SELECT SUM(amount) AS amount, SUM(count) AS count
+        FROM taxreturns
+        WHERE user_id = $1
         """, user.id)
 
-    async def txr_not_total(self, user: discord.User) -> decimal.Decimal:
-        return await self.pool.fetchval("""
-        select sum(transactions.amount)
-        from transactions
-
-        join accounts on transactions.receiver = accounts.account_id
-
-        where transactions.sender=$1
-         and accounts.account_type=1
-         and transactions.amount >= 5
-         and transactions.taxreturn_used = false
-        """, user.id)
+        amount = decimal.Decimal(row['amount'] or 0).scaleb(-2)
+        return amount, row['count'] or 0
+
+    async def txr_restore(self, user: discord.User, entries: list):
+        """Give ledger entries that couldn't be
+        returned back to the tax return ledger."""
+        await self.pool.executemany("""
+        INSERT INTO taxreturns (user_id, taxbank_id, amount, count)
+        VALUES ($1, $2, $3, $4)
+        ON CONFLICT (user_id, taxbank_id)
+        DO UPDATE SET amount = taxreturns.amount + EXCLUDED.amount,
+                      count = taxreturns.count + EXCLUDED.count
+        """, [(user.id, e['taxbank_id'], e['amount'], e['count'])
+              for e in entries])
 
     @taxreturn.command(name='query', aliases=['q'])
     async def taxreturn_check(self, ctx):
@@ -645,9 +499,8 @@ class CoinsExt(Cog, requires=['coins']):
         looking straight in your eyes, with fury in her eyes,
         wanting to kill you, with an AK-47.
         """
-        total_avail = await self.txr_total(ctx.author)
-        total_criteria = await self.txr_not_total(ctx.author)
-        total_trans = await self.txr_transactions(ctx.author)
+        total_criteria, total_trans = await self.txr_summary(ctx.author)
+        total_avail = total_criteria * TAXRETURN_RATE
 
         em = discord.Embed(
             title='Tax return situation', color=discord.Color.gold())
@@ -663,7 +516,7 @@ class CoinsExt(Cog, requires=['coins']):
             name='Withdrawable money', value=f'`{round(total_avail, 2)}JC`')
         em.add_field(
             name='Tax transactions that meet criteria',
-            value=f'{len(total_trans)}')
+            value=f'{total_trans}')
 
         await ctx.send(embed=em)
 
@@ -692,45 +545,51 @@ class CoinsExt(Cog, requires=['coins']):
             where user_id = $1
             """, ctx.author.id)
 
-        transactions = await self.txr_transactions(ctx.author)
-
-        success, error = 0, 0
-        sent = decimal.Decimal(0)
-
-        log.debug(f'[txr] processing {ctx.author}, ' f'{len(transactions)}')
-
-        for trans in transactions:
-            # apply 10% to the amount
+        # take everything out of the ledger first, so
+        # nothing can be returned twice.
+        entries = await self.pool.fetch("""
+        DELETE FROM taxreturns
+        WHERE user_id = $1
+        RETURNING taxbank_id, amount, count
+        """, ctx.author.id)
 
-            # theres transactions.amount and accounts.amount
-            # we do a filter to get the right one
-            items = trans.items()
-            t_amount = next(
-                v for k, v in items if isinstance(v, decimal.Decimal))
+        log.debug(f'[txr] processing {ctx.author}, {len(entries)}')
 
-            applied = t_amount * decimal.Decimal('0.25')
+        # the reverse transactions, as tax return
+        transfers = []
+        for entry in entries:
+            amount = decimal.Decimal(entry['amount']).scaleb(-2)
+            transfers.append((entry['taxbank_id'], ctx.author.id,
+                              round(amount * TAXRETURN_RATE, 2)))
 
-            # the reverse transaction, as tax return
+        results = []
+        if transfers:
             try:
-                await self.jcoin.transfer(trans['receiver'], trans['sender'],
-                                          applied)
+                results = await self.coins.transfer_many(transfers,
+                                                         atomic=False)
+            except Exception:
+                await self.txr_restore(ctx.author, entries)
+                raise
 
-                await self.pool.execute("""
-                update transactions
-                set taxreturn_used=true
-                where idx=$1
-                """, trans['idx'])
+        success, error = 0, 0
+        sent = decimal.Decimal(0)
 
-                success += 1
+        for entry, transfer, result in zip(entries, transfers, results):
+            applied = transfer[2]
+            if result['success']:
+                success += entry['count']
                 sent += applied
-            except self.coins.TransferError as err:
-                log.exception('error on tax return reverse transfer op')
-                await ctx.send('Error while transferring from '
-                               f'`{self.jcoin.get_name(trans["receiver"])}` '
-                               f'amount: `{applied}JC` '
-                               f'`{err!r}`')
-
-                error += 1
+                continue
+
+            log.error('error on tax return reverse transfer op: '
+                      f'{result["message"]}')
+            await ctx.send('Error while transferring from '
+                           f'`{self.jcoin.get_name(entry["taxbank_id"])}` '
+                           f'amount: `{applied}JC` '
+                           f'`{result["message"]}`')
+
+            await self.txr_restore(ctx.author, [entry])
+            error += 1
 
         sent = round(sent, 2)
         log.debug(f'[txr] {ctx.author}, {success} succ, '
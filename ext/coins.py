@@ -5,13 +5,19 @@ import sys
 import pprint
 import time
 import random
-import math
+import gzip
+import os
+import tempfile
+import json
+import copy
 
+import aiohttp
 import discord
 from discord.ext import commands
 
 from .common import Cog, CoinConverter
-from .utils import Timer
+from .utils import Timer, ExpiringCache
+from .utils.jcclient import JoseCoinClient
 
 sys.path.append('..')
 from jcoin.errors import GenericError, TransferError, \
@@ -20,6 +26,35 @@ from jcoin.errors import GenericError, TransferError, \
 log = logging.getLogger(__name__)
 REWARD_COOLDOWN = 18000
 
+# users on reward cooldown and cached probabilities kept at most
+REWARD_CACHE_SIZE = 200000
+PROB_CACHE_SIZE = 100000
+PROB_TTL = 7200
+
+# seconds between removals of expired cache entries
+CACHE_SWEEP = 600
+
+# autocoin rewards are paid in batches every REWARD_FLUSH
+# seconds, of at most REWARD_BATCH transfers each
+REWARD_FLUSH = 5
+REWARD_BATCH = 1000
+
+# seconds to wait before resubscribing to wallet events
+EVENTS_RETRY = 10
+
+# connections to the API, and seconds a call can take
+JC_POOL_SIZE = 20
+JC_TIMEOUT = 10
+
+# wallets per bulk probability request
+PROB_BULK = 1000
+
+# wallets are cached for WALLET_TTL seconds while wallet
+# events are on, for WALLET_TTL_NO_EVENTS seconds otherwise
+WALLET_CACHE_SIZE = 10000
+WALLET_TTL = 300
+WALLET_TTL_NO_EVENTS = 15
+
 TAX_MULTIPLIER = decimal.Decimal('1.42')
 
 
@@ -36,61 +71,136 @@ class Coins(Cog):
     def __init__(self, bot):
         super().__init__(bot)
         self.base_url = bot.config.JOSECOIN_API
+        self.client = JoseCoinClient(
+            self.base_url, bot.config.JOSECOIN_TOKEN, loop=self.loop,
+            pool_size=getattr(bot.config, 'JOSECOIN_POOL_SIZE', JC_POOL_SIZE),
+            timeout=getattr(bot.config, 'JOSECOIN_TIMEOUT', JC_TIMEOUT))
         self.bot.simple_exc.extend(err_list)
         self.transfers_done = 0
 
-        #: Reward cooldowns are stored here
-        self.rewards = {}
+        #: Users on reward cooldown, until it expires
+        self.rewards = ExpiringCache(REWARD_CACHE_SIZE, REWARD_COOLDOWN)
+
+        #: Autocoin rewards waiting to be paid, user ID -> amount
+        self.pending_rewards = {}
 
         #: Cache for probability values
-        self.prob_cache = {}
+        self.prob_cache = ExpiringCache(PROB_CACHE_SIZE, PROB_TTL)
+
+        #: Cache for wallets
+        self.wallet_cache = ExpiringCache(WALLET_CACHE_SIZE, WALLET_TTL)
+
+        #: If we are receiving wallet events, and so
+        #  if cached wallets are up to date
+        self.events_ok = False
+
+        #: Bumped every time caches are dropped, fetches that
+        #  started before it changed don't get cached
+        self._cache_gen = 0
+
+        #: GETs being made, (route, payload, cache generation)
+        #  -> task, so identical ones share a single request
+        self._inflight = {}
+
+        #: how many GETs were answered by another in-flight one
+        self.coalesced = 0
+
+        #: Sets getting the IDs dropped from the caches while
+        #  bulk fetches run, None in them means everything.
+        self._drop_watchers = []
+        self._prob_warmed = False
+
+        self.events_task = self.loop.create_task(self.wallet_events())
+        self.reward_task = self.loop.create_task(self.reward_flusher())
+        self.sweep_task = self.loop.create_task(self.cache_sweeper())
 
         self.AccountType = AccountType
         self.AccountNotFoundError = AccountNotFoundError
         self.TransferError = TransferError
         self.ConditionError = ConditionError
 
+    def __unload(self):
+        self.events_task.cancel()
+        self.reward_task.cancel()
+        self.sweep_task.cancel()
+
+        # don't lose what was already won
+        self.loop.create_task(self._close())
+
+    async def _close(self):
+        try:
+            await self.flush_rewards()
+        finally:
+            await self.client.close()
+
     def _route(self, route):
-        return f'{self.base_url}{route}'
+        return self.client.route(route)
 
     @property
     def headers(self):
         """Get the headers for a josécoin request."""
-        return {'Authorization': self.bot.config.JOSECOIN_TOKEN}
+        return self.client.headers
 
     async def generic_call(self,
                            method: str,
                            route: str,
                            payload: dict = None,
                            **kwargs) -> 'any':
-        """Generic call to any JoséCoin API route."""
-        route = self._route(route)
-        headers = self.headers
-        async with self.bot.session.request(
-                method, route, json=payload, headers=headers) as resp:
-
-            if kwargs.get('log', True):
-                log.debug(f'called {route!r}, status {resp.status}')
-
-            if resp.status == 500:
-                raise Exception('Internal Server Error')
-
-            data = await resp.json()
-            if isinstance(data, dict) and data.get('error'):
-                msg = data.get('message')
-                for exc in err_list:
-                    if exc.status_code == resp.status:
-                        if exc == AccountNotFoundError:
-                            raise AccountNotFoundError("Account not found, rea"
-                                                       "d the documentation "
-                                                       "at 'j!help Coins' "
-                                                       "(CASE-SENSITIVE)")
-                        raise exc(msg)
-
-                # generic exception for unknown error codes
-                raise Exception(msg)
-
-            return data
+        """Generic call to any JoséCoin API route.
+
+        Deadlines, retries and the circuit breaker
+        are handled by the client, see utils/jcclient.py.
+
+        GETs identical to one still running wait for it.
+        Every caller gets its own copy of the response.
+        """
+        if method != 'GET':
+            status, data = await self.client.call(
+                method, route, payload, log_call=kwargs.get('log', True))
+        else:
+            status, data = await self._single_flight(
+                route, payload, kwargs.get('log', True))
+
+        if isinstance(data, dict) and data.get('error'):
+            msg = data.get('message')
+            for exc in err_list:
+                if exc.status_code == status:
+                    if exc == AccountNotFoundError:
+                        raise AccountNotFoundError("Account not found, rea"
+                                                   "d the documentation "
+                                                   "at 'j!help Coins' "
+                                                   "(CASE-SENSITIVE)")
+                    raise exc(msg)
+
+            # generic exception for unknown error codes
+            raise Exception(msg)
+
+        return data
+
+    async def _single_flight(self, route: str, payload,
+                             log_call: bool) -> tuple:
+        """Make a GET, sharing it with identical ones in flight."""
+        # GETs started before caches were dropped may have
+        # stale data, later ones can't join them.
+        key = (route, json.dumps(payload, sort_keys=True), self._cache_gen)
+
+        try:
+            task = self._inflight[key]
+        except KeyError:
+            task = self.loop.create_task(self.client.call(
+                'GET', route, payload, log_call=log_call))
+            self._inflight[key] = task
+            task.add_done_callback(
+                lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+
+        # shielded so a cancelled caller doesn't
+        # cancel the request for everyone else.
+        status, data = await asyncio.shield(task)
+
+        # callers change the data they get
+        return status, copy.deepcopy(data)
 
     def jc_get(self, route: str, payload: dict = None, **kwargs):
         """Make a GET request to JoséCoin API."""
@@ -153,25 +263,161 @@ class Coins(Cog):
         res = self.get_name_raw(*args, **kwargs)
         return self.bot.clean_content(res)
 
+    def _parse_account(self, r: dict) -> dict:
+        """Convert the amounts of an account from the API."""
+        # amounts come as strings, 'inf' for infinite accounts
+        r['amount'] = decimal.Decimal(r['amount'])
+        try:
+            r['taxpaid'] = decimal.Decimal(r['taxpaid'])
+        except KeyError:
+            pass
+
+        try:
+            r['ubank'] = decimal.Decimal(r['ubank'])
+        except KeyError:
+            pass
+
+        return r
+
     async def get_account(self, wallet_id: int) -> dict:
         """Get an account"""
         if getattr(wallet_id, 'id', None):
             wallet_id = wallet_id.id
 
-        r = await self.jc_get(f'/wallets/{wallet_id}', log=False)
-        r['amount'] = decimal.Decimal(f'{r["amount"]:.3f}')
         try:
-            r['taxpaid'] = decimal.Decimal(f'{r["taxpaid"]:.3f}')
+            return dict(self.wallet_cache.get(wallet_id))
         except KeyError:
             pass
 
-        try:
-            r['ubank'] = decimal.Decimal(f'{r["ubank"]:.3f}')
-        except KeyError:
-            pass
+        gen = self._cache_gen
+        r = await self.jc_get(f'/wallets/{wallet_id}', log=False)
+        r = self._parse_account(r)
+
+        if gen == self._cache_gen:
+            ttl = WALLET_TTL if self.events_ok else WALLET_TTL_NO_EVENTS
+            self.wallet_cache.set(wallet_id, dict(r), ttl)
 
         return r
 
+    def _mark_changed(self, account_ids: list = None):
+        """Make running fetches of these accounts
+        (or all of them) not get cached."""
+        self._cache_gen += 1
+
+        for dropped in self._drop_watchers:
+            dropped.update(account_ids or [None])
+
+    def cache_transfer(self, from_id: int, to_id: int, res: dict):
+        """Update the cached wallets of a transfer
+        with the balances it returned."""
+        self._mark_changed([from_id, to_id])
+
+        changes = {
+            from_id: {'amount': decimal.Decimal(res['sender_amount'])},
+            to_id: {'amount': decimal.Decimal(res['receiver_amount'])},
+        }
+
+        if res.get('sender_taxpaid') is not None:
+            changes[from_id]['taxpaid'] = \
+                decimal.Decimal(res['sender_taxpaid'])
+
+        if res.get('sender_bank') is not None:
+            changes[from_id]['ubank'] = decimal.Decimal(res['sender_bank'])
+
+            # the probability depends on it
+            self.prob_cache.pop(from_id, None)
+
+        for account_id, change in changes.items():
+            self.wallet_cache.update(
+                account_id, lambda account: {**account, **change})
+
+    def drop_caches(self, account_ids: list = None):
+        """Drop cached wallets and probabilities.
+
+        Parameters
+        ----------
+        account_ids: list, optional
+            Accounts to drop. Everything is dropped if not given.
+        """
+        self._mark_changed(account_ids)
+
+        if account_ids is None:
+            self.wallet_cache.clear()
+            self.prob_cache.clear()
+            return
+
+        for account_id in account_ids:
+            account_id = getattr(account_id, 'id', account_id)
+            self.wallet_cache.pop(account_id, None)
+            self.prob_cache.pop(account_id, None)
+
+    async def _handle_event(self, message: dict):
+        op = message.get('op')
+
+        if op == 'resync':
+            self.drop_caches()
+            self.events_ok = True
+        elif op == 'invalidate':
+            self.drop_caches(message['accounts'])
+
+    async def wallet_events(self):
+        """Keep subscribed to the wallet events of the API.
+
+        Caches are dropped on every (re)connection, since
+        anything could have changed while we weren't subscribed.
+        """
+        await self.bot.wait_until_ready()
+
+        while True:
+            try:
+                async with self.client.session.ws_connect(
+                        self._route('/events'), headers=self.headers,
+                        heartbeat=30) as ws:
+                    async for msg in ws:
+                        if msg.type != aiohttp.WSMsgType.TEXT:
+                            break
+
+                        await self._handle_event(json.loads(msg.data))
+            except asyncio.CancelledError:
+                self.events_ok = False
+                raise
+            except Exception:
+                log.exception('wallet events error')
+
+            self.events_ok = False
+            self.drop_caches()
+
+            log.warning('wallet events disconnected, retrying '
+                        f'in {EVENTS_RETRY} seconds')
+            await asyncio.sleep(EVENTS_RETRY)
+
+    async def get_accounts(self, wallet_ids: list) -> dict:
+        """Get many accounts in a single request.
+
+        Parameters
+        ----------
+        wallet_ids: list
+            IDs (or objects with an ``id``) of the accounts.
+            Duplicates are only fetched once.
+
+        Returns
+        -------
+        dict
+            Account ID to account. IDs without an
+            account are not in it.
+        """
+        ids = {getattr(wallet_id, 'id', wallet_id) for wallet_id in wallet_ids}
+        if not ids:
+            return {}
+
+        accounts = await self.jc_get('/wallets', {'ids': list(ids)},
+                                     log=False)
+
+        return {
+            account['account_id']: self._parse_account(account)
+            for account in accounts
+        }
+
     async def create_wallet(self, thing):
         """Send a request to create a JoséCoin account."""
 
@@ -179,6 +425,7 @@ class Coins(Cog):
             if isinstance(thing, discord.abc.User) else \
             AccountType.TAXBANK
 
+        self.drop_caches([thing.id])
         rows = await self.jc_post(f'/wallets/{thing.id}', {
             'type': acc_type,
         })
@@ -243,6 +490,9 @@ class Coins(Cog):
             },
             log=False)
 
+        # don't wait for the event to see our own writes
+        self.cache_transfer(from_id, to_id, res)
+
         sender_name = self.get_name(from_id)
         receiver_name = self.get_name(to_id)
 
@@ -255,6 +505,93 @@ class Coins(Cog):
 
         return res
 
+    async def transfer_many(self, transfers: list, *,
+                            atomic: bool = True) -> list:
+        """Make many transfers in a single call.
+
+        Parameters
+        ----------
+        transfers: list[tuple]
+            List of (from_id, to_id, amount) tuples.
+        atomic: bool, optional
+            If any failing transfer should make the whole
+            batch fail. If False, each transfer is
+            done independently.
+
+        Returns
+        -------
+        list[dict]
+            One result for each transfer, in order, with a
+            `success` field and a `message` field on failure.
+        """
+        legs = []
+        for from_id, to_id, amount in transfers:
+            legs.append({
+                'sender': getattr(from_id, 'id', from_id),
+                'receiver': getattr(to_id, 'id', to_id),
+                'amount': str(amount),
+            })
+
+        res = await self.jc_post(
+            '/transfers/batch', {
+                'transfers': legs,
+                'atomic': atomic,
+            },
+            log=False)
+
+        results = res['results']
+        for leg, result in zip(legs, results):
+            if result['success']:
+                self.cache_transfer(leg['sender'], leg['receiver'], result)
+
+        done = sum(1 for r in results if r['success'])
+        self.transfers_done += done
+
+        msg = f'batch of {len(legs)} transfers, {done} done'
+        log.info(msg)
+        log.log(60, msg)
+
+        return results
+
+    async def export_transactions(self, fp, fmt: str = 'ndjson',
+                                  **filters) -> int:
+        """Stream an export of the transaction log into a file.
+
+        Parameters
+        ----------
+        fp: file-like
+            Binary file to write the export to.
+        fmt: str, optional
+            Export format, 'ndjson' or 'csv'.
+        **filters
+            sender, receiver, account, since and until,
+            see the API documentation.
+
+        Returns
+        -------
+        int
+            How many bytes were written.
+        """
+        params = {'format': fmt}
+        for name, value in filters.items():
+            if value is not None:
+                params[name] = str(getattr(value, 'id', value))
+
+        written = 0
+        async with self.client.session.get(
+                self._route('/transactions/export'),
+                params=params, headers=self.headers) as resp:
+            if resp.status != 200:
+                data = await resp.json()
+                raise Exception(data.get('message'))
+
+            # chunk by chunk, exports can be huge
+            async for chunk in resp.content.iter_chunked(65536):
+                fp.write(chunk)
+                written += len(chunk)
+
+        return written
+
     async def transfer_str(self, from_id: int, to_id: int,
                            amount: decimal.Decimal) -> str:
         """Transfer between accounts, but returning a string."""
@@ -319,21 +656,104 @@ class Coins(Cog):
         """Check if an account is locked"""
         return await self.jc_get('/check_lock', {'account_id': account_id})
 
-    def _pcache_invalidate(self, user_id: int):
-        """Invalidate the prob cache after 2 hours for one user."""
-        # log.debug(f'popping {user_id} from cache')
-        try:
-            self.prob_cache.pop(user_id)
-        except KeyError:
-            pass
-
     def pcache_set(self, author_id: int, value):
         """Set a value for a user in the probability cache"""
-        self.prob_cache[author_id] = value
+        self.prob_cache.set(author_id, value)
+
+    async def warm_prob_cache(self, guild: discord.Guild):
+        """Fetch the probabilities of the members of a
+        guild that aren't cached, in bulk."""
+        ids = [member.id for member in guild.members
+               if not member.bot and member.id not in self.prob_cache]
+
+        for idx in range(0, len(ids), PROB_BULK):
+            chunk = ids[idx:idx + PROB_BULK]
+
+            dropped = set()
+            self._drop_watchers.append(dropped)
+            try:
+                probs = await self.jc_get('/wallets/probability',
+                                          {'ids': chunk}, log=False)
+            finally:
+                self._drop_watchers.remove(dropped)
+
+            # what changed while we were fetching may be stale
+            if None in dropped:
+                continue
+
+            for user_id in chunk:
+                if user_id in dropped or user_id in self.prob_cache:
+                    continue
+
+                # users without wallets are cached as None
+                self.pcache_set(user_id, probs.get(str(user_id)))
+
+        log.debug(f'warmed prob cache for {len(ids)} members of {guild}')
+
+    async def on_ready(self):
+        # on_ready is also called on reconnects
+        if self._prob_warmed:
+            return
+
+        self._prob_warmed = True
+        for guild in self.bot.guilds:
+            try:
+                await self.warm_prob_cache(guild)
+            except Exception:
+                log.exception(f'failed to warm prob cache for {guild}')
+
+    async def on_guild_join(self, guild):
+        try:
+            await self.warm_prob_cache(guild)
+        except Exception:
+            log.exception(f'failed to warm prob cache for {guild}')
+
+    async def flush_rewards(self):
+        """Pay the pending autocoin rewards."""
+        # keep them for when the API is back
+        if not self.pending_rewards or not self.client.breaker.available:
+            return
+
+        rewards, self.pending_rewards = self.pending_rewards, {}
+        transfers = [(self.bot.user.id, user_id, amount)
+                     for user_id, amount in rewards.items()]
+
+        for idx in range(0, len(transfers), REWARD_BATCH):
+            chunk = transfers[idx:idx + REWARD_BATCH]
+            try:
+                results = await self.transfer_many(chunk, atomic=False)
+            except Exception:
+                log.exception(f'failed to pay {len(chunk)} autocoin rewards, '
+                              'retrying on the next flush')
+
+                # put them back, with whatever was won meanwhile
+                for _, user_id, amount in chunk:
+                    self.pending_rewards[user_id] = \
+                        self.pending_rewards.get(user_id, 0) + amount
+                continue
+
+            for (_, user_id, amount), result in zip(chunk, results):
+                if not result['success']:
+                    log.warning(f'autocoin reward of {amount} to {user_id} '
+                                f'failed: {result.get("message")}')
+
+    async def reward_flusher(self):
+        """Pay the pending autocoin rewards every REWARD_FLUSH seconds."""
+        await self.bot.wait_until_ready()
+
+        while True:
+            await asyncio.sleep(REWARD_FLUSH)
+            try:
+                await self.flush_rewards()
+            except Exception:
+                log.exception('autocoin flush error')
 
-        # NOTE: this feels like Redis, but I don't want to use
-        #  Redis, so we use a dict! (webscale! no sockets!)
-        self.loop.call_later(7200, self._pcache_invalidate, author_id)
+    async def cache_sweeper(self):
+        """Remove expired cache entries every CACHE_SWEEP seconds."""
+        while True:
+            await asyncio.sleep(CACHE_SWEEP)
+            for cache in (self.rewards, self.prob_cache, self.wallet_cache):
+                cache.sweep()
 
     async def pricing(self, ctx, base_tax: decimal.Decimal) -> str:
         """Tax someone."""
@@ -350,9 +770,9 @@ class Coins(Cog):
         amount = account['amount'] + account['ubank']
 
         gdp = await self.jc_get('/gdp')
-        gdp = gdp['gdp']
+        gdp = decimal.Decimal(gdp['gdp'])
 
-        gdp_sqrt = decimal.Decimal(math.sqrt(gdp))
+        gdp_sqrt = gdp.sqrt()
         total_tax = base_tax + pow((amount / gdp_sqrt) * TAX_MULTIPLIER, 2)
         try:
             await self.transfer(ctx.author.id, ctx.guild.id, total_tax)
@@ -373,8 +793,6 @@ class Coins(Cog):
         if user_blocked or guild_blocked:
             return
 
-        now = time.monotonic()
-
         cext = self.bot.get_cog('CoinsExt')
         if not cext:
             return
@@ -389,15 +807,18 @@ class Coins(Cog):
                 return
 
         # manage reward cooldowns
-        last_reward = self.rewards.get(author_id, 0)
-        if now < last_reward:
+        if author_id in self.rewards:
+            return
+
+        # don't pile up calls to an API that is failing
+        if not self.client.breaker.available:
             return
 
         # check the user's probability
         try:
-            if author_id in self.prob_cache:
-                probdata = self.prob_cache[author_id]
-            else:
+            try:
+                probdata = self.prob_cache.get(author_id)
+            except KeyError:
                 probdata = await self.jc_get(
                     f'/wallets/{author_id}/'
                     'probability', log=False)
@@ -418,24 +839,22 @@ class Coins(Cog):
         if to_give < 0.3:
             return
 
-        try:
-            await self.transfer(self.bot.user.id, author_id, to_give)
+        # the reward is paid in the next batch, see flush_rewards
+        to_give = decimal.Decimal(str(to_give))
+        self.pending_rewards[author_id] = \
+            self.pending_rewards.get(author_id, 0) + to_give
 
-            self.rewards[author_id] = time.monotonic() + REWARD_COOLDOWN
-            if message.guild.large:
-                return
+        self.rewards.set(author_id, True)
+        if message.guild.large:
+            return
 
-            hc = await self.jc_get(f'/wallets/{author_id}/hidecoin_status')
-            # hc = {'hidden': True}
-            if hc['hidden']:
-                return
+        if probdata['hidecoins']:
+            return
 
-            try:
-                await message.add_reaction('\N{MONEY BAG}')
-            except Exception as e:
-                log.exception('autocoin failed to add reaction')
+        try:
+            await message.add_reaction('\N{MONEY BAG}')
         except Exception as e:
-            log.exception('autocoin error')
+            log.exception('autocoin failed to add reaction')
 
     @commands.command()
     async def account(self, ctx):
@@ -491,6 +910,7 @@ class Coins(Cog):
         resp = await self.jc_post(f'/wallets/{ctx.author.id}/deposit', {
             'amount': str(amount),
         })
+        self.drop_caches([ctx.author.id])
 
         await ctx.success(resp['status'])
 
@@ -563,11 +983,23 @@ class Coins(Cog):
                 alive = res['status']
 
                 if not alive:
-                    return await ctx.send('JoséCoin API is not ok.')
+                    return await ctx.send('JoséCoin API is not ok.\n'
+                                          f'{self.client_status()}')
             except Exception as e:
-                return await ctx.send(f'Failed to contact JoséCoin API {e!r}')
+                return await ctx.send(f'Failed to contact JoséCoin API {e!r}'
+                                      f'\n{self.client_status()}')
 
-        await ctx.send(f'`{timer}`, db: `{res["db_latency_sec"]*1000}ms`')
+        await ctx.send(f'`{timer}`, db: `{res["db_latency_sec"]*1000}ms`\n'
+                       f'{self.client_status()}')
+
+    def client_status(self) -> str:
+        """Describe the state of the API client."""
+        stats = self.client.stats
+        return (f'client: `{stats["state"]}`, {stats["calls"]} calls, '
+                f'{stats["failures"]} failures, {stats["retried"]} retries, '
+                f'{stats["rejected"]} rejected, {stats["trips"]} trips, '
+                f'{stats["in_flight"]} in flight, '
+                f'{self.coalesced} GETs coalesced')
 
     @commands.command()
     async def coinprob(self, ctx, person: discord.User = None):
@@ -597,15 +1029,44 @@ class Coins(Cog):
 
         Only bot owner can use this command.
         """
+        # through the API, so it updates its leaderboard
         with Timer() as timer:
-            await self.pool.execute("""
-            UPDATE accounts
-            SET amount=$1
-            WHERE account_id=$2
-            """, amount, person.id)
+            await self.jc_post(f'/wallets/{person.id}/amount',
+                               {'amount': amount})
 
+        self.drop_caches([person.id])
         await ctx.send(f'write took {timer}')
 
+    @commands.command()
+    @commands.is_owner()
+    async def jcexport(self, ctx, account: discord.User = None,
+                       days: int = 30, fmt: str = 'csv'):
+        """Export transactions of the last [days] days.
+
+        Only bot owner can use this command.
+        """
+        since = time.time() - days * 86400
+        fd, path = tempfile.mkstemp(suffix=f'.{fmt}.gz')
+        os.close(fd)
+
+        try:
+            with Timer() as timer:
+                with gzip.open(path, 'wb') as fp:
+                    written = await self.export_transactions(
+                        fp, fmt, account=account, since=since)
+
+            size = os.path.getsize(path)
+            msg = f'exported {written} bytes ({size} gzipped), took {timer}'
+
+            # discord's upload limit
+            if size > 8 * 1024 * 1024:
+                return await ctx.send(f'{msg}, too big to upload')
+
+            await ctx.send(msg, file=discord.File(
+                path, filename=f'transactions.{fmt}.gz'))
+        finally:
+            os.remove(path)
+
     @commands.command()
     @commands.is_owner()
     async def spam(self, ctx, taskcount: int = 200, timeout: int = 30):
@@ -655,12 +1116,14 @@ class Coins(Cog):
         log.warning(f'deleting account {ctx.author!r}')
 
         res = await self.jc_delete(f'/wallets/{ctx.author.id}')
+        self.drop_caches([ctx.author.id])
         await ctx.status(res['success'])
 
     @commands.command()
     async def hidecoins(self, ctx):
         """Toggle the coin reaction in your account"""
         result = await self.jc_post(f'/wallets/{ctx.author.id}/hidecoins')
+        self.drop_caches([ctx.author.id])
         result = result['new_hidecoins']
         resultstr = 'on' if result else 'off'
         await ctx.send(f'no reactions are set to `{resultstr}` for you.')
@@ -685,6 +1148,29 @@ class Coins(Cog):
 
         em.add_field(name='total steals done', value=stats['steals'])
         em.add_field(name='total steal success', value=stats['success'])
+
+        events = stats['events']
+        em.add_field(name='wallet events',
+                     value=f'{"on" if self.events_ok else "off"}, '
+                     f'{events["received"]} received by the API, '
+                     f'{events["subscribers"]} subscribers')
+
+        cache = self.wallet_cache.stats
+        em.add_field(name='wallet cache',
+                     value=f'{cache["size"]}/{cache["max_size"]} wallets, '
+                     f'{cache["hit_rate"] * 100:.1f}% hit rate '
+                     f'({cache["hits"]} hits, {cache["misses"]} misses), '
+                     f'{cache["evictions"]} evictions')
+
+        for name, cache in (('probability cache', self.prob_cache),
+                            ('reward cooldowns', self.rewards)):
+            info = cache.stats
+            em.add_field(name=name,
+                         value=f'{info["size"]}/{info["max_size"]} '
+                         f'entries, {info["memory"] / 1024:.1f}KiB, '
+                         f'{info["expired"]} expired, '
+                         f'{info["evictions"]} evictions')
+
         await ctx.send(embed=em)
 
     def steal_fmt(self, row) -> str:
@@ -56,11 +56,13 @@ class Gambling(Cog, requires=['coins']):
         if challenger in self.duels:
             raise self.SayException('You are already in a duel')
 
-        challenger_acc = await self.jcoin.get_account(challenger)
+        accounts = await self.jcoin.get_accounts([challenger, challenged])
+
+        challenger_acc = accounts.get(challenger)
         if not challenger_acc:
             raise self.SayException("You don't have a wallet.")
 
-        challenged_acc = await self.jcoin.get_account(challenged)
+        challenged_acc = accounts.get(challenged)
         if not challenged_acc:
             raise self.SayException("Challenged person doesn't have a wallet.")
 
@@ -147,8 +149,6 @@ class Gambling(Cog, requires=['coins']):
         if amount > 8:
             raise self.SayException('You cannot gamble too much.')
 
-        await self.jcoin.transfer(ctx.author.id, ctx.guild.id, amount)
-
         res = []
         slots = [random.choice(EMOJI_POOL) for i in range(3)]
 
@@ -168,12 +168,15 @@ class Gambling(Cog, requires=['coins']):
         res.append(f'bet: {amount}, won: {applied_amount}')
 
         if applied_amount > 0:
-            try:
-                await self.jcoin.transfer(ctx.guild.id, ctx.author.id,
-                                          applied_amount)
-            except self.jcoin.TransferError as err:
-                raise self.SayException(f'err(g->a, a): {err!r}')
+            # bet and prize go in the same batch, so
+            # the bet is never taken without the prize
+            # being paid.
+            await self.jcoin.transfer_many([
+                (ctx.author.id, ctx.guild.id, amount),
+                (ctx.guild.id, ctx.author.id, applied_amount),
+            ])
         else:
+            await self.jcoin.transfer(ctx.author.id, ctx.guild.id, amount)
             res.append(':peach:')
 
         await ctx.send('\n'.join(res))
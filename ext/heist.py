@@ -173,12 +173,15 @@ class JoinSession:
         transferred = decimal.Decimal(0)
         thief_transferred = 0
 
-        for user_id in self.users:
-            try:
-                await self.coins.transfer(user_id, self.target.id, self.fine)
+        results = await self.coins.transfer_many(
+            [(user_id, self.target.id, self.fine) for user_id in self.users],
+            atomic=False)
+
+        for user_id, result in zip(self.users, results):
+            if result['success']:
                 transferred += self.fine
                 thief_transferred += 1
-            except self.coins.TransferError:
+            else:
                 await self.coins.zero(user_id)
 
         for jailed_id in res['jailed']:
@@ -251,16 +254,24 @@ class JoinSession:
 
         log.info('Heist success')
 
+        users = []
         for user_id in self.users:
             user = self.bot.get_user(user_id)
             if user is None:
                 log.debug('Ignoring uid %d', user_id)
                 continue
 
-            try:
-                await self.coins.transfer(self.target.id, user_id, self.fine)
-            except self.coins.TransferError as err:
-                log.warning(f'transfer failed {err!r}')
+            users.append(user)
+
+        results = []
+        if users:
+            results = await self.coins.transfer_many(
+                [(self.target.id, user.id, self.fine) for user in users],
+                atomic=False)
+
+        for user, result in zip(users, results):
+            if not result['success']:
+                log.warning(f'transfer failed {result["message"]!r}')
 
             # using hardcoded because we cant import coins+
             await self.cext.add_cooldown(user, 'points', 12)
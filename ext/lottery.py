@@ -1,6 +1,5 @@
 import logging
 import decimal
-import asyncio
 from random import SystemRandom
 
 import discord
@@ -123,27 +122,25 @@ class Lottery(Cog, requires=['coins']):
         })
 
         # business logic is here
-        total = decimal.Decimal(0)
+        transfers = []
         taxbanks = await self.get_taxbanks()
         for account in taxbanks:
             amount = PERCENTAGE_PER_TAXBANK * \
                     decimal.Decimal(account['amount'])
-
-            try:
-                await self.jcoin.transfer(account['account_id'], winner_id,
-                                          amount)
-                total += amount
-            except Exception as err:
-                await ctx.send(f'err txb tx: {err!r}')
-
-            await asyncio.sleep(0.1)
+            transfers.append((account['account_id'], winner_id, amount))
 
         amount_people = await self.ticket_coll.count()
         amount_from_ticket = TICKET_INCREASE * amount_people * TICKET_PRICE
-        await self.jcoin.transfer(self.bot.user.id, winner_id,
-                                  amount_from_ticket)
+        transfers.append((self.bot.user.id, winner_id, amount_from_ticket))
+
+        total = decimal.Decimal(0)
+        results = await self.jcoin.transfer_many(transfers, atomic=False)
+        for (_, _, amount), result in zip(transfers, results):
+            if result['success']:
+                total += amount
+            else:
+                await ctx.send(f'err txb tx: {result["message"]!r}')
 
-        total += amount_from_ticket
         total = round(total, 3)
         await ctx.send(f'Sent a total of `{total}` to the winner')
 
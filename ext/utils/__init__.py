@@ -1 +1,2 @@
 from .mousey import *
+from .cache import ExpiringCache
@@ -0,0 +1,129 @@
+import sys
+import time
+import collections
+
+
+class ExpiringCache:
+    """Dict-like cache with a maximum size and expiring entries.
+
+    The least recently used entry is evicted when the cache is
+    full. Expired entries are removed when they are read, or by
+    :meth:`sweep`, so no timers are needed to expire them.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # key -> (value, expires)
+        self._data = collections.OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        try:
+            self.get(key, count=False)
+            return True
+        except KeyError:
+            return False
+
+    def get(self, key, *, count: bool = True):
+        """Get a value, raising KeyError if it isn't
+        in the cache or expired."""
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            if count:
+                self.misses += 1
+            raise
+
+        if time.monotonic() >= expires:
+            del self._data[key]
+            self.expired += 1
+            if count:
+                self.misses += 1
+            raise KeyError(key)
+
+        self._data.move_to_end(key)
+        if count:
+            self.hits += 1
+
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        """Set a value, expiring in ``ttl`` seconds
+        (the cache's ttl if not given)."""
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, key, func):
+        """Change a cached value in place with ``func``,
+        keeping its expiry. Does nothing if it isn't cached."""
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            return
+
+        self._data[key] = (func(value), expires)
+
+    def pop(self, key, default=None):
+        try:
+            return self._data.pop(key)[0]
+        except KeyError:
+            return default
+
+    def clear(self):
+        self._data.clear()
+
+    def sweep(self) -> int:
+        """Remove the expired entries, returning how many were."""
+        now = time.monotonic()
+        expired = [key for key, (_, expires) in self._data.items()
+                   if now >= expires]
+
+        for key in expired:
+            del self._data[key]
+
+        self.expired += len(expired)
+        return len(expired)
+
+    @property
+    def memory(self) -> int:
+        """Rough size of the cache in bytes, not
+        counting what the keys and values point to."""
+        size = sys.getsizeof(self._data)
+        for key, entry in self._data.items():
+            size += sys.getsizeof(key) + sys.getsizeof(entry) \
+                + sys.getsizeof(entry[0])
+
+        return size
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expired': self.expired,
+            'memory': self.memory,
+            'hit_rate': self.hit_rate,
+        }
@@ -0,0 +1,235 @@
+"""
+HTTP client for the JoséCoin API.
+
+Has its own connection pool, deadlines on every call, retries
+and a circuit breaker, so a slow or dead API makes callers fail
+fast instead of piling up requests.
+"""
+import asyncio
+import json
+import logging
+import random
+import time
+import uuid
+
+import aiohttp
+
+log = logging.getLogger(__name__)
+
+
+class ServerError(Exception):
+    """The API failed, without applying anything."""
+    pass
+
+
+class CircuitOpenError(Exception):
+    """The API is failing, calls aren't being made."""
+    pass
+
+
+class CircuitBreaker:
+    """Stop calling something that keeps failing.
+
+    After ``threshold`` failures in a row the breaker opens
+    and calls are refused. ``reset_timeout`` seconds later
+    a single trial call is let through (half-open): it closes
+    the breaker if it works, opens it again if it doesn't.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._trial = False
+
+        #: how many times it opened
+        self.trips = 0
+
+    @property
+    def available(self) -> bool:
+        """If calls may go through, without claiming the trial call."""
+        if self.state == self.OPEN:
+            return time.monotonic() - self.opened_at >= self.reset_timeout
+
+        return self.state == self.CLOSED or not self._trial
+
+    def allow(self) -> bool:
+        """Check if a call can be made."""
+        if self.state == self.OPEN and \
+                time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._trial = False
+
+        if self.state == self.CLOSED:
+            return True
+
+        if self.state == self.HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+
+        return False
+
+    def release(self):
+        """Give back the trial call, when it ended
+        without telling if the thing works."""
+        if self.state == self.HALF_OPEN:
+            self._trial = False
+
+    def success(self):
+        if self.state != self.CLOSED:
+            log.info('circuit breaker closed')
+
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+            if self.state != self.OPEN:
+                log.warning(f'circuit breaker open after '
+                            f'{self.failures} failures')
+                self.trips += 1
+
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class JoseCoinClient:
+    """Make calls to the JoséCoin API.
+
+    GETs are retried on timeouts, connection errors and
+    server errors. Other calls are too, with an idempotency
+    key so they are never applied twice.
+    """
+    RETRYABLE = (aiohttp.ClientError, asyncio.TimeoutError, ServerError)
+
+    def __init__(self, base_url: str, token: str, *, loop=None,
+                 pool_size: int = 20, timeout: float = 10,
+                 retries: int = 2, write_retries: int = 3,
+                 retry_delay: float = 0.5, breaker: CircuitBreaker = None):
+        self.base_url = base_url
+        self.token = token
+        self.timeout = timeout
+        self.retries = retries
+        self.write_retries = write_retries
+        self.retry_delay = retry_delay
+        self.breaker = breaker or CircuitBreaker()
+
+        connector = aiohttp.TCPConnector(limit=pool_size, loop=loop)
+        self.session = aiohttp.ClientSession(connector=connector, loop=loop)
+
+        self.calls = 0
+        self.failures = 0
+        self.retried = 0
+        self.rejected = 0
+        self.in_flight = 0
+
+    @property
+    def headers(self) -> dict:
+        return {'Authorization': self.token}
+
+    def route(self, route: str) -> str:
+        return f'{self.base_url}{route}'
+
+    async def close(self):
+        await self.session.close()
+
+    async def _request(self, method: str, route: str, payload,
+                       headers: dict, log_call: bool) -> tuple:
+        async with self.session.request(
+                method, self.route(route), json=payload,
+                headers=headers) as resp:
+
+            if log_call:
+                log.debug(f'called {route!r}, status {resp.status}')
+
+            if resp.status >= 500:
+                raise ServerError('Internal Server Error')
+
+            body = await resp.read()
+            try:
+                return resp.status, (json.loads(body) if body else None)
+            except ValueError:
+                # proxies give out HTML error pages
+                raise ServerError(f'Invalid response, status {resp.status}')
+
+    async def call(self, method: str, route: str, payload=None, *,
+                   timeout: float = None, log_call: bool = True) -> tuple:
+        """Call a route.
+
+        Returns
+        -------
+        tuple
+            The status code and the parsed body.
+
+        Raises
+        ------
+        CircuitOpenError
+            If the API has been failing.
+        ServerError, aiohttp.ClientError, asyncio.TimeoutError
+            If the call still failed after all retries.
+        """
+        headers = self.headers
+        retries = self.retries
+        if method != 'GET':
+            headers['Idempotency-Key'] = uuid.uuid4().hex
+            retries = self.write_retries
+
+        for attempt in range(retries + 1):
+            if not self.breaker.allow():
+                self.rejected += 1
+                raise CircuitOpenError('JoséCoin API is unavailable, '
+                                       'try again later')
+
+            self.calls += 1
+            self.in_flight += 1
+            try:
+                status, data = await asyncio.wait_for(
+                    self._request(method, route, payload, headers, log_call),
+                    timeout or self.timeout)
+            except self.RETRYABLE as err:
+                self.failures += 1
+                self.breaker.failure()
+                if attempt == retries:
+                    raise
+
+                error = err
+            except BaseException:
+                # cancelled, or something that isn't about the API
+                self.breaker.release()
+                raise
+            else:
+                self.breaker.success()
+
+                # the same key is still running, wait for it
+                if status != 409 or method == 'GET' or attempt == retries:
+                    return status, data
+
+                error = 'conflict'
+            finally:
+                self.in_flight -= 1
+
+            self.retried += 1
+            delay = self.retry_delay * (2 ** attempt)
+            delay *= random.uniform(0.5, 1.5)
+            log.warning(f'{method} {route} failed ({error!r}), '
+                        f'retrying in {delay:.2f} seconds')
+            await asyncio.sleep(delay)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'state': self.breaker.state,
+            'trips': self.breaker.trips,
+            'calls': self.calls,
+            'failures': self.failures,
+            'retried': self.retried,
+            'rejected': self.rejected,
+            'in_flight': self.in_flight,
+        }
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3.6
+"""
+bench_transactions.py - insert and query cost of the transaction
+log as it grows, partitioned by month against a single table.
+
+Each simulated month of transactions is COPYed into both tables,
+then the queries are timed. Both tables get the same indexes for
+the queries, so partition pruning is compared against index scans
+and not against sequential scans. Everything happens in a scratch
+schema (bench_txlog) that is dropped at the end, the real
+tables aren't touched.
+
+usage:
+    python3 bench_transactions.py [months] [rows_per_month]
+"""
+import sys
+import time
+import random
+import decimal
+import datetime
+
+import asyncio
+import asyncpg
+
+import config
+
+SCHEMA = 'bench_txlog'
+ACCOUNTS = 10000
+COLUMNS = ('transferred_at', 'sender', 'receiver', 'amount', 'description')
+RUNS = 5
+
+QUERIES = {
+    # what stats over recent transactions look like
+    'month_sum': """
+    SELECT COUNT(*), SUM(amount) FROM {table}
+    WHERE transferred_at >= $1
+    """,
+
+    # recent history of an account
+    'history': """
+    SELECT * FROM {table}
+    WHERE sender = $2 AND transferred_at >= $1
+    ORDER BY transferred_at DESC
+    LIMIT 50
+    """,
+}
+
+
+def month_start(base: datetime.datetime, months: int) -> datetime.datetime:
+    month = base.month - 1 + months
+    return base.replace(year=base.year + month // 12, month=month % 12 + 1)
+
+
+def make_rows(start: datetime.datetime, end: datetime.datetime,
+              count: int) -> list:
+    span = (end - start).total_seconds()
+    rows = []
+    for _ in range(count):
+        rows.append((
+            start + datetime.timedelta(seconds=random.uniform(0, span)),
+            random.randrange(ACCOUNTS),
+            random.randrange(ACCOUNTS),
+            decimal.Decimal(random.randrange(1, 10000)).scaleb(-2),
+            random.choice(('transfer', 'steal', 'arrest')),
+        ))
+
+    return rows
+
+
+async def setup(conn):
+    await conn.execute(f"""
+    DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;
+    CREATE SCHEMA {SCHEMA};
+
+    CREATE TABLE {SCHEMA}.plain (
+        idx bigserial PRIMARY KEY,
+        transferred_at timestamp NOT NULL,
+        sender bigint NOT NULL,
+        receiver bigint NOT NULL,
+        amount numeric NOT NULL,
+        description text
+    );
+
+    CREATE TABLE {SCHEMA}.parted (
+        idx bigserial,
+        transferred_at timestamp NOT NULL,
+        sender bigint NOT NULL,
+        receiver bigint NOT NULL,
+        amount numeric NOT NULL,
+        description text,
+        PRIMARY KEY (idx, transferred_at)
+    ) PARTITION BY RANGE (transferred_at);
+    """)
+
+    # indexes on a partitioned table are made on every partition
+    for table in ('plain', 'parted'):
+        await conn.execute(f"""
+        CREATE INDEX {table}_transferred_at_idx
+        ON {SCHEMA}.{table} (transferred_at);
+
+        CREATE INDEX {table}_sender_idx
+        ON {SCHEMA}.{table} (sender, transferred_at);
+        """)
+
+
+async def timed(coro) -> float:
+    """Await something, returning how long it took, in ms."""
+    start = time.perf_counter()
+    await coro
+    return (time.perf_counter() - start) * 1000
+
+
+async def query_cost(conn, table: str, start: datetime.datetime) -> dict:
+    """Average time of each query, in ms."""
+    costs = {}
+    for name, query in QUERIES.items():
+        query = query.format(table=f'{SCHEMA}.{table}')
+        args = [start, random.randrange(ACCOUNTS)]
+        args = args[:query.count('$')]
+
+        total = 0
+        for _ in range(RUNS):
+            total += await timed(conn.fetch(query, *args))
+
+        costs[name] = total / RUNS
+
+    return costs
+
+
+async def main():
+    months = int(sys.argv[1]) if len(sys.argv) > 1 else 24
+    per_month = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+
+    conn = await asyncpg.connect(**config.db)
+    try:
+        await setup(conn)
+        base = datetime.datetime(2000, 1, 1)
+
+        print(f'{per_month} transactions per month, '
+              f'query times are the average of {RUNS} runs, in ms')
+        print('month      rows  copy plain  copy part  '
+              'sum plain  sum part  hist plain  hist part')
+
+        for month in range(months):
+            start = month_start(base, month)
+            end = month_start(base, month + 1)
+            rows = make_rows(start, end, per_month)
+
+            name = f'parted_{start:%Y_%m}'
+            await conn.execute(f"""
+            CREATE TABLE {SCHEMA}.{name} PARTITION OF {SCHEMA}.parted
+            FOR VALUES FROM ('{start}') TO ('{end}')
+            """)
+
+            copy_plain = await timed(conn.copy_records_to_table(
+                'plain', schema_name=SCHEMA, records=rows, columns=COLUMNS))
+            copy_part = await timed(conn.copy_records_to_table(
+                'parted', schema_name=SCHEMA, records=rows, columns=COLUMNS))
+
+            await conn.execute(f'ANALYZE {SCHEMA}.plain')
+            await conn.execute(f'ANALYZE {SCHEMA}.parted')
+
+            plain = await query_cost(conn, 'plain', start)
+            part = await query_cost(conn, 'parted', start)
+
+            print(f'{month + 1:5d} {(month + 1) * per_month:9d} '
+                  f'{copy_plain:11.1f} {copy_part:10.1f} '
+                  f'{plain["month_sum"]:10.1f} {part["month_sum"]:9.1f} '
+                  f'{plain["history"]:11.1f} {part["history"]:10.1f}')
+    finally:
+        await conn.execute(f'DROP SCHEMA IF EXISTS {SCHEMA} CASCADE')
+        await conn.close()
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
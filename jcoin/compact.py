@@ -0,0 +1,169 @@
+#!/usr/bin/env python3.6
+"""
+compact.py - archive old partitions of the transaction log.
+
+Partitions older than `archive_months` (from the config) are:
+ - exported, raw, to <archive_dir>/transactions_YYYY_MM.csv.gz
+ - rolled into per account daily summaries, in transactions_daily
+ - detached and dropped
+
+It also makes sure the partitions for the current and next
+month exist, so run it from cron at least once a month.
+
+usage:
+    python3 compact.py            archive old partitions
+    python3 compact.py --dry-run  only show what would be archived
+"""
+import sys
+import os
+import re
+import gzip
+import datetime
+import logging
+
+import asyncio
+import asyncpg
+
+import config
+
+log = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PARTITION_RGX = re.compile(r'^transactions_(\d{4})_(\d{2})$')
+
+
+def archive_dir() -> str:
+    return os.path.join(BASE_DIR, getattr(config, 'archive_dir', 'archive'))
+
+
+def cutoff_month() -> tuple:
+    """Get the (year, month) before which partitions are archived."""
+    now = datetime.datetime.utcnow()
+    months = now.year * 12 + (now.month - 1) - \
+        getattr(config, 'archive_months', 6)
+
+    return months // 12, months % 12 + 1
+
+
+async def get_partitions(conn) -> list:
+    """Get the monthly partitions of the transaction
+    log, as sorted (year, month, name) tuples."""
+    rows = await conn.fetch("""
+    SELECT child.relname
+    FROM pg_inherits
+    JOIN pg_class parent ON pg_inherits.inhparent = parent.oid
+    JOIN pg_class child ON pg_inherits.inhrelid = child.oid
+    WHERE parent.relname = 'transactions'
+    """)
+
+    partitions = []
+    for row in rows:
+        match = PARTITION_RGX.match(row['relname'])
+        if match:
+            year, month = map(int, match.groups())
+            partitions.append((year, month, row['relname']))
+
+    return sorted(partitions)
+
+
+async def export(conn, partition: str) -> str:
+    """Export the raw rows of a partition to a gzipped CSV file."""
+    os.makedirs(archive_dir(), exist_ok=True)
+    path = os.path.join(archive_dir(), f'{partition}.csv.gz')
+    tmp_path = f'{path}.tmp'
+
+    with gzip.open(tmp_path, 'wb') as archive:
+        await conn.copy_from_table(
+            partition, output=archive, format='csv', header=True)
+
+    # only a complete export gets the final name
+    os.replace(tmp_path, path)
+    return path
+
+
+async def summarize(conn, partition: str):
+    """Add the daily summaries of a partition to transactions_daily."""
+    # partition names come from the catalog, and are
+    # checked against PARTITION_RGX, so no injection here.
+    await conn.execute(f"""
+    INSERT INTO transactions_daily (day, account_id, description,
+                                    sent, received,
+                                    sent_count, received_count)
+    SELECT day, account_id, description,
+           sum(sent), sum(received), sum(sent_count), sum(received_count)
+    FROM (
+        SELECT transferred_at::date AS day, sender AS account_id,
+               coalesce(description, 'transfer') AS description,
+               amount AS sent, 0 AS received,
+               1 AS sent_count, 0 AS received_count
+        FROM {partition}
+
+        UNION ALL
+
+        SELECT transferred_at::date, receiver,
+               coalesce(description, 'transfer'),
+               0, amount,
+               0, 1
+        FROM {partition}
+    ) AS legs
+    GROUP BY day, account_id, description
+    ON CONFLICT (day, account_id, description)
+    DO UPDATE SET sent = transactions_daily.sent + EXCLUDED.sent,
+                  received = transactions_daily.received + EXCLUDED.received,
+                  sent_count = transactions_daily.sent_count
+                               + EXCLUDED.sent_count,
+                  received_count = transactions_daily.received_count
+                                   + EXCLUDED.received_count
+    """)
+
+
+async def archive(conn, partition: str):
+    """Archive a partition."""
+    path = await export(conn, partition)
+    log.info('exported %s to %s', partition, path)
+
+    async with conn.transaction():
+        await summarize(conn, partition)
+        await conn.execute(f"""
+        ALTER TABLE transactions DETACH PARTITION {partition}
+        """)
+        await conn.execute(f'DROP TABLE {partition}')
+
+    log.info('archived %s', partition)
+
+
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    dry_run = '--dry-run' in sys.argv
+
+    conn = await asyncpg.connect(**config.db)
+    try:
+        await conn.execute("""
+        SELECT transactions_ensure_partitions($1)
+        """, datetime.datetime.utcnow())
+
+        default_rows = await conn.fetchval("""
+        SELECT COUNT(*) FROM transactions_default
+        """)
+
+        if default_rows:
+            log.warning('%d transactions in the default partition, '
+                        'they are not archived', default_rows)
+
+        cutoff = cutoff_month()
+        for year, month, partition in await get_partitions(conn):
+            if (year, month) >= cutoff:
+                continue
+
+            if dry_run:
+                log.info('would archive %s', partition)
+                continue
+
+            await archive(conn, partition)
+    finally:
+        await conn.close()
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
@@ -8,4 +8,47 @@ db = {
     # 'host': '',
 }
 
+# leaderboards, ranks, probabilities and exports use a separate pool,
+# connected to db_read (a streaming replica) if given, or to db.
+# db_read = {
+#     'user': 'jose',
+#     'password': '12345',
+#     'database': 'josecoin',
+#     'host': 'replica',
+# }
+db_pool_size = 10
+db_read_pool_size = 10
+
 port = 8080
+
+# how many server processes to run. with more than one, changes to
+# ranks, economy stats and the token cache are sent to the others
+# over NOTIFY (see sync.py)
+workers = 1
+
+# ranks and economy stats are reloaded every state_refresh seconds,
+# to fix anything missed and direct database writes
+state_refresh = 30
+
+# default seconds for an account lock to expire
+lock_lease = 600
+
+# how many seconds client tokens stay cached
+token_ttl = 300
+
+# transaction logs are commited in batches of up to
+# log_batch rows, at most every log_interval seconds
+log_batch = 500
+log_interval = 2
+
+# wallet change events are sent to subscribers
+# at most every events_interval seconds
+events_interval = 0.25
+
+# seconds responses to requests with an Idempotency-Key are kept
+idempotency_ttl = 86400
+
+# compact.py archives transaction log partitions older
+# than archive_months, raw rows are exported to archive_dir
+archive_months = 6
+archive_dir = 'archive'
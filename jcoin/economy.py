@@ -0,0 +1,107 @@
+"""
+economy.py - running totals of the economy, so GDP and
+stats don't need to aggregate the whole accounts table.
+
+all amounts are in cents.
+"""
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Economy:
+    """Running sums and counts of accounts.
+
+    The last known amount of every account is kept, so
+    each update only needs the new amount to know how
+    much the totals changed.
+    """
+    def __init__(self):
+        #: account_id -> [account_type, amount]
+        self._accounts = {}
+
+        #: account_type -> account count / sum of amounts
+        self.counts = {0: 0, 1: 0}
+        self.sums = {0: 0, 1: 0}
+
+        self.steal_uses = 0
+        self.steal_success = 0
+
+    def __contains__(self, account_id: int):
+        return account_id in self._accounts
+
+    async def load(self, db):
+        """Rebuild the totals from the database."""
+        accounts = await db.fetch("""
+        SELECT account_id, account_type, amount FROM accounts
+        """)
+
+        steals = await db.fetchrow("""
+        SELECT SUM(steal_uses) AS uses, SUM(steal_success) AS success
+        FROM wallets
+        """)
+
+        self._accounts = {}
+        self.counts = {0: 0, 1: 0}
+        self.sums = {0: 0, 1: 0}
+
+        for row in accounts:
+            self.add_account(row['account_id'], row['account_type'],
+                             row['amount'])
+
+        self.steal_uses = steals['uses'] or 0
+        self.steal_success = steals['success'] or 0
+
+        log.info('loaded economy, %d accounts, gdp %s',
+                 len(self._accounts), self.gdp)
+
+    def add_account(self, account_id: int, account_type: int, amount=0):
+        """Add a new account."""
+        self._accounts[account_id] = [account_type, amount]
+        self.counts[account_type] = self.counts.get(account_type, 0) + 1
+        self.sums[account_type] = self.sums.get(account_type, 0) + amount
+
+    def remove_account(self, account_id: int, steal_uses: int = 0,
+                       steal_success: int = 0):
+        """Remove an account and its wallet's steal statistics."""
+        try:
+            account_type, amount = self._accounts.pop(account_id)
+        except KeyError:
+            return
+
+        self.counts[account_type] -= 1
+        self.sums[account_type] -= amount
+
+        self.steal_uses -= steal_uses
+        self.steal_success -= steal_success
+
+    def set_amount(self, account_id: int, amount):
+        """Update an account's amount."""
+        try:
+            account = self._accounts[account_id]
+        except KeyError:
+            return
+
+        account_type, old_amount = account
+        self.sums[account_type] += amount - old_amount
+        account[1] = amount
+
+    @property
+    def gdp(self) -> int:
+        return sum(self.sums.values())
+
+    def get_sums(self) -> dict:
+        """Get sum information about accounts."""
+        return {
+            'gdp': self.gdp,
+            'user': self.sums[0],
+            'taxbank': self.sums[1],
+        }
+
+    def get_counts(self) -> dict:
+        """Get account counts."""
+        return {
+            'accounts': len(self._accounts),
+            'user_accounts': self.counts[0],
+            'txb_accounts': self.counts[1],
+        }
@@ -23,7 +23,17 @@ class ConditionError(TransferError):
     status_code = 412
 
 
+class AuthError(GenericError):
+    """Client is not allowed to do this."""
+    status_code = 403
+
+
+class ConflictError(GenericError):
+    """Another request with the same idempotency key is running."""
+    status_code = 409
+
+
 err_list = [
     GenericError, TransferError, AccountNotFoundError, InputError,
-    ConditionError
+    ConditionError, AuthError, ConflictError
 ]
@@ -0,0 +1,200 @@
+"""
+events.py - fan out wallet change notifications to clients.
+
+Triggers on accounts and wallets NOTIFY the ID of every
+changed account on the wallet_changes channel. Each server
+process LISTENs on its own connection and forwards the IDs
+to the websockets subscribed to GET /api/events.
+"""
+import asyncio
+import json
+import logging
+
+import asyncpg
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'wallet_changes'
+
+
+class Subscriber:
+    """Pending changes of a single websocket client.
+
+    Changes are coalesced into a set of account IDs. If a
+    client falls too far behind, the set is dropped and it
+    is told to resync (drop everything it has cached).
+    """
+    def __init__(self, max_pending: int):
+        self.max_pending = max_pending
+        self.pending = set()
+        self.resync = True
+        self._ready = asyncio.Event()
+        self._ready.set()
+
+    def push(self, account_id: int):
+        if not self.resync:
+            self.pending.add(account_id)
+            if len(self.pending) > self.max_pending:
+                self.mark_resync()
+                return
+
+        self._ready.set()
+
+    def mark_resync(self):
+        self.resync = True
+        self.pending.clear()
+        self._ready.set()
+
+    async def get(self) -> dict:
+        """Wait for the next message to send."""
+        await self._ready.wait()
+        self._ready.clear()
+
+        if self.resync:
+            self.resync = False
+            self.pending.clear()
+            return {'op': 'resync'}
+
+        accounts, self.pending = list(self.pending), set()
+        return {'op': 'invalidate', 'accounts': accounts}
+
+
+class WalletEvents:
+    """Listen for wallet changes and hand them to subscribers.
+
+    Messages to a subscriber are sent at most every ``interval``
+    seconds, with all the accounts changed in between.
+    """
+    def __init__(self, db_config: dict, *, interval: float = 0.25,
+                 max_pending: int = 10000, ping_interval: float = 30):
+        self.db_config = db_config
+        self.interval = interval
+        self.max_pending = max_pending
+        self.ping_interval = ping_interval
+
+        self.subscribers = set()
+        self._conn = None
+        self._task = None
+
+        #: other channels, channel -> (callback, on_lost)
+        self._listeners = {}
+
+        #: how many notifications were received
+        self.received = 0
+
+    @property
+    def loop(self):
+        return asyncio.get_event_loop()
+
+    def _on_notify(self, conn, pid, channel, payload):
+        self.received += 1
+        try:
+            account_id = int(payload)
+        except (TypeError, ValueError):
+            log.warning('invalid wallet change payload %r', payload)
+            return
+
+        for sub in self.subscribers:
+            sub.push(account_id)
+
+    def listen(self, channel: str, callback, on_lost=None):
+        """Also listen on another channel, with the same connection.
+
+        ``callback`` is an asyncpg listener, and ``on_lost``
+        is called when notifications may have been lost. Must
+        be called before :meth:`start`.
+        """
+        self._listeners[channel] = (callback, on_lost)
+
+    async def _connect(self):
+        self._conn = await asyncpg.connect(**self.db_config)
+        await self._conn.add_listener(CHANNEL, self._on_notify)
+
+        for channel, (callback, _) in self._listeners.items():
+            await self._conn.add_listener(channel, callback)
+
+        log.info('listening for wallet changes')
+
+    async def _close_conn(self):
+        if self._conn is None:
+            return
+
+        try:
+            await self._conn.close()
+        except Exception:
+            pass
+
+        self._conn = None
+
+    async def watch_task(self):
+        """Check the listening connection, reconnecting if it died.
+
+        Notifications are lost while it is down, so
+        every subscriber is told to resync after that.
+        """
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            try:
+                await asyncio.wait_for(self._conn.fetchval('SELECT 1'),
+                                       self.ping_interval)
+                continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.warning('wallet change listener died, reconnecting')
+
+            await self._close_conn()
+            try:
+                await self._connect()
+            except Exception:
+                log.exception('failed to reconnect the listener')
+                continue
+
+            for sub in self.subscribers:
+                sub.mark_resync()
+
+            for _, on_lost in self._listeners.values():
+                if on_lost is not None:
+                    on_lost()
+
+    async def start(self):
+        """Start listening."""
+        await self._connect()
+        self._task = self.loop.create_task(self.watch_task())
+
+    async def close(self):
+        """Stop listening."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        await self._close_conn()
+
+    async def serve(self, ws):
+        """Send wallet changes to a websocket until it disconnects."""
+        sub = Subscriber(self.max_pending)
+        self.subscribers.add(sub)
+
+        try:
+            while True:
+                # sending something now and then is how
+                # we notice clients that went away
+                try:
+                    message = await asyncio.wait_for(sub.get(),
+                                                     self.ping_interval)
+                except asyncio.TimeoutError:
+                    message = {'op': 'heartbeat'}
+
+                await ws.send(json.dumps(message))
+
+                # let changes pile up between messages
+                await asyncio.sleep(self.interval)
+        finally:
+            self.subscribers.discard(sub)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'subscribers': len(self.subscribers),
+            'received': self.received,
+        }
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3.6
+"""
+explain.py - snapshot the query plans of the hot read paths.
+
+Writes one EXPLAIN output per query to explain/<name>.txt,
+so plan changes show up in diffs. The queries here must be
+kept in sync with the ones in josecoin.py (leaderboard_query)
+and ext/coins+.py, see indexes.rst for the endpoint each one
+belongs to.
+
+Run it against a database with realistic data, plans
+for empty tables are always sequential scans.
+
+usage:
+    python3 explain.py
+"""
+import os
+
+import asyncio
+import asyncpg
+
+import config
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SNAPSHOT_DIR = os.path.join(BASE_DIR, 'explain')
+
+COLUMNS = """
+accounts.account_id, accounts.account_type, accounts.amount,
+accounts.infinite, wallets.taxpaid, wallets.steal_uses,
+wallets.steal_success, wallets.ubank
+"""
+
+# name -> (query, argument names)
+QUERIES = {
+    'get_wallet': ("""
+    SELECT account_id, account_type, amount, infinite,
+           taxpaid, steal_uses, steal_success, ubank
+    FROM accounts
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE account_id = $1
+    """, ('user_id',)),
+
+    'probability': ("""
+    SELECT taxpaid, hidecoins FROM wallets
+    WHERE user_id=$1
+    """, ('user_id',)),
+
+    'probability_bulk': ("""
+    SELECT user_id, taxpaid, hidecoins FROM wallets
+    WHERE user_id = ANY($1::bigint[])
+    """, ('user_ids',)),
+
+    'rank_local_total': ("""
+    SELECT COUNT(*) FROM accounts
+    JOIN members ON accounts.account_id = members.user_id
+    WHERE members.guild_id = $1
+    """, ('guild_id',)),
+
+    'rank_local': ("""
+    SELECT s.rank FROM (
+        SELECT accounts.account_id, rank() over (
+            ORDER BY accounts.amount DESC
+        ) FROM accounts
+        JOIN members ON accounts.account_id = members.user_id
+        WHERE members.guild_id = $1
+    ) AS s WHERE s.account_id = $2
+    """, ('guild_id', 'user_id')),
+
+    'top_local': (f"""
+    SELECT {COLUMNS} FROM accounts
+    JOIN members ON accounts.account_id = members.user_id
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE members.guild_id = $1
+    ORDER BY accounts.amount DESC, accounts.account_id DESC
+    LIMIT 10
+    """, ('guild_id',)),
+
+    'top_global': (f"""
+    SELECT {COLUMNS} FROM accounts
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE EXISTS (SELECT 1 FROM members
+                  WHERE members.user_id = accounts.account_id)
+    AND accounts.amount != 0
+    AND accounts.account_type=0
+    ORDER BY accounts.amount DESC, accounts.account_id DESC
+    LIMIT 10
+    """, ()),
+
+    'top_global_page': (f"""
+    SELECT {COLUMNS} FROM accounts
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE EXISTS (SELECT 1 FROM members
+                  WHERE members.user_id = accounts.account_id)
+    AND accounts.amount != 0
+    AND accounts.account_type=0
+    AND (accounts.amount, accounts.account_id) < ($1::bigint, $2::bigint)
+    ORDER BY accounts.amount DESC, accounts.account_id DESC
+    LIMIT 10
+    """, ('amount', 'user_id')),
+
+    'top_taxpaid': (f"""
+    SELECT {COLUMNS} FROM wallets
+    JOIN accounts ON accounts.account_id = wallets.user_id
+    WHERE EXISTS (SELECT 1 FROM members
+                  WHERE members.user_id = wallets.user_id)
+    ORDER BY wallets.taxpaid DESC, wallets.user_id DESC
+    LIMIT 10
+    """, ()),
+
+    'top_taxbanks': (f"""
+    SELECT {COLUMNS} FROM accounts
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE accounts.account_type=1
+    ORDER BY accounts.amount DESC, accounts.account_id DESC
+    LIMIT 10
+    """, ()),
+
+    'txr_total': ("""
+    SELECT SUM(amount) AS amount, SUM(count) AS count
+    FROM taxreturns
+    WHERE user_id = $1
+    """, ('user_id',)),
+}
+
+
+async def get_sample_args(conn) -> dict:
+    """Get some existing IDs to run the queries with."""
+    row = await conn.fetchrow("""
+    SELECT members.user_id, members.guild_id, accounts.amount
+    FROM members
+    JOIN accounts ON accounts.account_id = members.user_id
+    WHERE accounts.account_type = 0
+    LIMIT 1
+    """)
+
+    if not row:
+        raise RuntimeError('need at least one user account in a guild')
+
+    sample = dict(row)
+    sample['user_ids'] = [row['user_id']]
+    return sample
+
+
+async def main():
+    conn = await asyncpg.connect(**config.db)
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+
+    try:
+        await conn.execute('ANALYZE')
+        sample = await get_sample_args(conn)
+
+        for name, (query, argnames) in QUERIES.items():
+            args = [sample[argname] for argname in argnames]
+            rows = await conn.fetch(f'EXPLAIN (COSTS OFF) {query}', *args)
+
+            path = os.path.join(SNAPSHOT_DIR, f'{name}.txt')
+            with open(path, 'w') as snapshot:
+                snapshot.write('\n'.join(r[0] for r in rows) + '\n')
+
+            print(f'wrote {path}')
+    finally:
+        await conn.close()
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
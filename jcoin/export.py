@@ -0,0 +1,146 @@
+"""
+export.py - stream the transaction log out, as CSV or NDJSON.
+
+Rows go from Postgres to the client in chunks, through
+COPY TO STDOUT (CSV) or a server-side cursor (NDJSON), so
+memory use doesn't depend on how many rows are exported.
+"""
+import asyncio
+import datetime
+import json
+import logging
+
+from errors import InputError
+
+log = logging.getLogger(__name__)
+
+EXPORT_COLUMNS = ('idx', 'transferred_at', 'sender', 'receiver',
+                  'amount', 'description')
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+# rows per NDJSON chunk
+CHUNK_ROWS = 1000
+
+# stop writing while the client has more than this buffered
+MAX_BUFFER = 1024 * 1024
+
+
+def _timestamp(value: str) -> datetime.datetime:
+    return datetime.datetime.utcfromtimestamp(float(value))
+
+
+# filter -> (condition, argument conversion)
+FILTERS = {
+    'sender': ('sender = ${}', int),
+    'receiver': ('receiver = ${}', int),
+    'account': ('(sender = ${0} OR receiver = ${0})', int),
+    'since': ('transferred_at >= ${}', _timestamp),
+    'until': ('transferred_at < ${}', _timestamp),
+}
+
+
+def build_query(args: dict) -> tuple:
+    """Make the export query out of the request's filters.
+
+    Returns the query and its arguments.
+    """
+    conditions, query_args = [], []
+
+    for name, (condition, convert) in FILTERS.items():
+        value = args.get(name)
+        if value is None:
+            continue
+
+        try:
+            query_args.append(convert(value))
+        except (ValueError, TypeError, OverflowError):
+            raise InputError(f'Invalid {name}')
+
+        conditions.append(condition.format(len(query_args)))
+
+    where = f'WHERE {" AND ".join(conditions)}' if conditions else ''
+    query = f"""
+    SELECT {', '.join(EXPORT_COLUMNS)}
+    FROM transactions
+    {where}
+    """
+
+    return query, query_args
+
+
+async def write(resp, data: bytes):
+    """Write a chunk to the client, waiting
+    for it to read what is buffered."""
+    transport = resp.transport
+    if transport.is_closing():
+        raise ConnectionError('client went away')
+
+    resp.write(data)
+
+    while transport.get_write_buffer_size() > MAX_BUFFER:
+        if transport.is_closing():
+            raise ConnectionError('client went away')
+
+        await asyncio.sleep(0.01)
+
+
+def _ndjson_row(row) -> str:
+    return json.dumps({
+        'idx': row['idx'],
+        'transferred_at': row['transferred_at'].isoformat(),
+        'sender': row['sender'],
+        'receiver': row['receiver'],
+        'amount': str(row['amount']),
+        'description': row['description'],
+    })
+
+
+async def stream_csv(conn, resp, query: str, args: list):
+    async def output(data: bytes):
+        await write(resp, data)
+
+    await conn.copy_from_query(query, *args, output=output,
+                               format='csv', header=True)
+
+
+async def stream_ndjson(conn, resp, query: str, args: list):
+    lines = []
+
+    # cursors only work inside transactions
+    async with conn.transaction():
+        async for row in conn.cursor(query, *args, prefetch=CHUNK_ROWS):
+            lines.append(_ndjson_row(row))
+
+            if len(lines) >= CHUNK_ROWS:
+                await write(resp, ('\n'.join(lines) + '\n').encode())
+                lines = []
+
+    if lines:
+        await write(resp, ('\n'.join(lines) + '\n').encode())
+
+
+STREAMERS = {
+    'csv': stream_csv,
+    'ndjson': stream_ndjson,
+}
+
+
+def exporter(pool, fmt: str, query: str, args: list):
+    """Make the streaming function for sanic's response.stream."""
+    streamer = STREAMERS[fmt]
+
+    async def streaming_fn(resp):
+        try:
+            async with pool.acquire() as conn:
+                await streamer(conn, resp, query, args)
+        except ConnectionError:
+            log.info('export stopped, client disconnected')
+        except Exception:
+            # headers are already sent, nothing to tell the client
+            log.exception('error while exporting transactions')
+
+    return streaming_fn
@@ -0,0 +1,189 @@
+"""
+idempotency.py - make mutating routes safe to retry.
+
+A client sends an Idempotency-Key header with a request it may
+retry. The first request with a key runs, and its response is
+stored. Retries with the same key get the stored response back
+instead of running again, so a transfer whose response was lost
+to a timeout is never applied twice.
+"""
+import asyncio
+import datetime
+import functools
+import hashlib
+import logging
+
+from sanic import response
+
+from errors import GenericError, InputError, ConflictError
+
+log = logging.getLogger(__name__)
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LEN = 255
+
+
+def fingerprint(request) -> str:
+    """Hash what makes a request, so a key can't
+    be reused for a different one."""
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.path.encode())
+    digest.update(request.body or b'')
+    return digest.hexdigest()
+
+
+class IdempotencyStore:
+    """Keep the responses of requests made with an
+    idempotency key for ``ttl`` seconds."""
+    def __init__(self, app, *, ttl: int = 86400):
+        self.app = app
+        self.ttl = ttl
+        self._task = None
+
+        #: how many requests got a stored response
+        self.replays = 0
+
+    @property
+    def db(self):
+        return self.app.db
+
+    @property
+    def loop(self):
+        return asyncio.get_event_loop()
+
+    async def begin(self, client_id: str, key: str, fprint: str):
+        """Claim a key.
+
+        Returns the stored response if the key was already
+        used, None if the request should run.
+        """
+        row = await self.db.fetchrow("""
+        INSERT INTO idempotency_keys (client_id, key, fingerprint)
+        VALUES ($1, $2, $3)
+        ON CONFLICT (client_id, key) DO NOTHING
+        RETURNING key
+        """, client_id, key, fprint)
+
+        if row is not None:
+            return None
+
+        row = await self.db.fetchrow("""
+        SELECT fingerprint, status, content_type, body
+        FROM idempotency_keys
+        WHERE client_id = $1 AND key = $2
+        """, client_id, key)
+
+        # the key expired between our two queries.
+        if row is None:
+            raise ConflictError('Request with this key expired, try again')
+
+        if row['fingerprint'] != fprint:
+            raise InputError('Idempotency key used for a different request')
+
+        if row['status'] is None:
+            raise ConflictError('Request with this key is still running')
+
+        self.replays += 1
+        return response.HTTPResponse(
+            body_bytes=row['body'],
+            status=row['status'],
+            content_type=row['content_type'],
+            headers={'Idempotent-Replayed': 'true'})
+
+    async def finish(self, client_id: str, key: str, resp):
+        """Store the response of a key."""
+        await self.db.execute("""
+        UPDATE idempotency_keys
+        SET status = $3, content_type = $4, body = $5
+        WHERE client_id = $1 AND key = $2
+        """, client_id, key, resp.status, resp.content_type, resp.body)
+
+    async def fail(self, client_id: str, key: str):
+        """Mark a key as failed with an unknown outcome.
+
+        Whatever the request changed may already be committed,
+        so retries get an error back instead of running again.
+        """
+        resp = response.json({
+            'error': True,
+            'message': 'Request failed and may have been applied, '
+                       'check before making it again with a new key',
+        }, status=500)
+
+        try:
+            await self.finish(client_id, key, resp)
+        except Exception:
+            # the key stays as running until it expires,
+            # which also keeps it from running twice.
+            log.exception('failed to mark idempotency key as failed')
+
+    async def run(self, client_id: str, key: str, handler, request,
+                  *args, **kwargs):
+        """Run a handler, storing its response under the key."""
+        try:
+            resp = await handler(request, *args, **kwargs)
+        except GenericError as err:
+            # errors like missing funds are a result, and
+            # the same request would get them again.
+            resp = request.app.error_handler.response(request, err)
+        except BaseException:
+            await self.fail(client_id, key)
+            raise
+
+        # on server errors, part of the request may
+        # have been applied already, never run it again.
+        if resp.status >= 500:
+            await self.fail(client_id, key)
+        else:
+            await self.finish(client_id, key, resp)
+
+        return resp
+
+    async def cleanup_task(self, interval: int = 3600):
+        """Delete expired keys every `interval` seconds."""
+        while True:
+            try:
+                res = await self.db.execute("""
+                DELETE FROM idempotency_keys
+                WHERE created_at < now() - $1::interval
+                """, datetime.timedelta(seconds=self.ttl))
+                log.debug('idempotency key cleanup: %s', res)
+            except Exception:
+                log.exception('error while deleting idempotency keys')
+
+            await asyncio.sleep(interval)
+
+    def start(self):
+        self._task = self.loop.create_task(self.cleanup_task())
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+def idempotent(handler):
+    """Make a route honor the Idempotency-Key header."""
+    @functools.wraps(handler)
+    async def wrapper(request, *args, **kwargs):
+        key = request.headers.get(HEADER)
+        if key is None:
+            return await handler(request, *args, **kwargs)
+
+        if not key or len(key) > MAX_KEY_LEN:
+            raise InputError('Invalid idempotency key')
+
+        store = request.app.idempotency
+        client_id = request['client']['client_id']
+
+        replay = await store.begin(client_id, key, fingerprint(request))
+        if replay is not None:
+            return replay
+
+        # keep going if the client goes away, so
+        # the key always ends up with the outcome.
+        return await asyncio.shield(store.run(
+            client_id, key, handler, request, *args, **kwargs))
+
+    return wrapper
@@ -8,7 +8,8 @@ import logging
 import asyncio
 import decimal
 import time
-from collections import defaultdict
+import datetime
+import random
 
 import asyncpg
 
@@ -17,7 +18,16 @@ from sanic import response
 
 import config as jconfig
 from errors import GenericError, AccountNotFoundError, \
-        InputError, ConditionError
+        InputError, ConditionError, AuthError
+from tokens import TokenCache
+from manager import TransferManager
+from ranks import Ranks
+from economy import Economy
+import export
+from events import WalletEvents
+from metrics import Metrics
+from idempotency import IdempotencyStore, idempotent
+from sync import StateSync
 
 app = Sanic()
 logging.basicConfig(level=logging.DEBUG)
@@ -27,15 +37,64 @@ log = logging.getLogger(__name__)
 AUTOCOIN_BASE_PROB = decimal.Decimal('0.012')
 PROB_CONSTANT = decimal.Decimal('1.003384590736')
 
-# !!!!! VERY IMPORTANT
-# the money type in psql doesn't handle Infinity or NaN,
-# so I have to "encode" infinity inside another number which
-# application wise is impossible, negative numbers do the job.
-ENCODED_INFINITY = -69
+# maximum amount of transfers in a single batch
+MAX_BATCH_TRANSFERS = 5000
 
+# steal constants
+STEAL_BASE_CHANCE = decimal.Decimal('1')
+STEAL_CONSTANT = decimal.Decimal('0.42')
 
-def is_inf(decimal):
-    return decimal == ENCODED_INFINITY
+# hours in jail, for steal points to regen and of grace for targets
+STEAL_ARREST_HOURS = 6
+STEAL_REGEN_HOURS = 9
+STEAL_GRACE_HOURS = 5
+
+# maximum accounts fetched by a single bulk lookup
+MAX_BULK_WALLETS = 200
+
+# maximum wallets in a single bulk probability lookup
+MAX_BULK_PROBABILITIES = 1000
+
+# how infinite amounts are shown to clients
+INFINITY_STR = 'inf'
+
+
+def to_cents(amount: decimal.Decimal) -> int:
+    """Convert an amount in JC to cents, as stored in the database."""
+    return int(round(amount, 2) * 100)
+
+
+def from_cents(cents: int) -> decimal.Decimal:
+    """Convert an amount in cents to JC."""
+    return decimal.Decimal(cents).scaleb(-2)
+
+
+def fmt_cents(cents: int, infinite: bool = False) -> str:
+    """Format an amount in cents to be given to clients."""
+    if infinite:
+        return INFINITY_STR
+
+    return str(from_cents(cents))
+
+
+def account_to_json(row) -> dict:
+    """Convert a row with account (and maybe wallet)
+    fields to be given to clients."""
+    account = {
+        'account_id': row['account_id'],
+        'account_type': row['account_type'],
+        'amount': fmt_cents(row['amount'], row['infinite']),
+    }
+
+    if row['account_type'] == AccountType.USER:
+        account.update({
+            'taxpaid': fmt_cents(row['taxpaid']),
+            'steal_uses': row['steal_uses'],
+            'steal_success': row['steal_success'],
+            'ubank': fmt_cents(row['ubank']),
+        })
+
+    return account
 
 
 class AccountType:
@@ -62,6 +121,36 @@ async def index(_):
     return response.text('josecoin v3 haha ye')
 
 
+def route_name(request) -> str:
+    """Get the name of the handler of a request."""
+    try:
+        handler = request.app.router.get(request)[0]
+    except Exception:
+        # not found, method not allowed
+        return 'unknown'
+
+    return handler.__name__
+
+
+@app.middleware('request')
+async def metrics_start(request):
+    """Start timing the request. This must be
+    the first middleware, to time the others."""
+    request['started'] = time.monotonic()
+
+
+@app.middleware('response')
+async def metrics_end(request, resp):
+    """Record the request in the metrics."""
+    # websocket handlers only return when the client leaves
+    if resp is None or 'started' not in request:
+        return
+
+    request.app.metrics.observe_request(
+        route_name(request), resp.status,
+        time.monotonic() - request['started'])
+
+
 @app.middleware('request')
 async def request_check(request):
     """Check the client token and deny if possible."""
@@ -70,33 +159,84 @@ async def request_check(request):
     except KeyError:
         return response.json({'error': 'no token provided'}, status=403)
 
-    row = await request.app.db.fetchrow("""
-    SELECT client_id, client_name, auth_level FROM clients
-    WHERE token=$1
-    """, token)
+    client = await request.app.tokens.get(token)
 
-    if row is None:
+    if client is None:
         log.info('token not found')
         return response.json({'error': 'unauthorized'}, status=403)
 
-    client_id = row['client_id']
-    client_name = row['client_name']
-    auth_level = row['auth_level']
+    client_id = client['client_id']
+    client_name = client['client_name']
+    auth_level = client['auth_level']
     log.info(f'id={client_id} name={client_name} level={auth_level}')
 
+    request['client'] = client
 
-@app.get('/api/health')
-async def get_status(request) -> response:
-    """Simple response."""
+
+def read_db(request):
+    """Get the pool for the read only queries of a request.
+
+    That is the read pool (maybe a replica), unless the
+    client needs to see its own writes right away.
+    """
+    if request.headers.get('X-Read-Primary'):
+        return request.app.db
+
+    return request.app.db_read
+
+
+async def db_latency(pool) -> float:
     t1 = time.monotonic()
-    await request.app.db.execute('SELECT 1')
+    await pool.execute('SELECT 1')
     t2 = time.monotonic()
-    delta = round((t2 - t1), 8)
+    return round((t2 - t1), 8)
 
+
+@app.get('/api/health')
+async def get_status(request) -> response:
+    """Simple response."""
     return response.json({
         'status': True,
-        'db_latency_sec': delta,
+        'db_latency_sec': await db_latency(request.app.db),
+        'db_read_latency_sec': await db_latency(request.app.db_read),
+        'token_cache': request.app.tokens.stats,
+        'state_sync': request.app.sync.stats,
+        'transfer_log': {
+            'pending': request.app.txmanager.pending,
+            'committed': request.app.txmanager.committed,
+        },
+    })
+
+
+@app.get('/api/metrics')
+async def get_metrics(request):
+    """Give request, query and pool metrics
+    in the Prometheus text format."""
+    text = request.app.metrics.render({
+        'main': request.app.db,
+        'read': request.app.db_read,
     })
+    return response.text(text, content_type='text/plain; version=0.0.4')
+
+
+@app.post('/api/tokens/invalidate')
+async def invalidate_tokens(request):
+    """Invalidate client tokens from the token cache.
+
+    Invalidates all of them if no `token` is given,
+    and reloads the cache from the database.
+    """
+    if request['client']['auth_level'] < 1:
+        raise AuthError('Client can not invalidate tokens')
+
+    try:
+        token = request.json.get('token')
+    except AttributeError:
+        token = None
+
+    request.app.sync.change('token', token)
+
+    return response.json({'success': True})
 
 
 @app.get('/api/wallets/<account_id:int>')
@@ -106,29 +246,21 @@ async def get_wallet(request, account_id):
     Can be user or taxbank.
     """
     account = await request.app.db.fetchrow("""
-    SELECT account_id, account_type, amount
-    FROM account_amount
+    SELECT account_id, account_type, amount, infinite,
+           taxpaid, steal_uses, steal_success, ubank
+    FROM accounts
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
     WHERE account_id = $1
     """, account_id)
 
     if not account:
         raise AccountNotFoundError('Account not found')
 
-    daccount = dict(account)
-    if account['account_type'] == AccountType.USER:
-        wallet = await request.app.db.fetchrow("""
-        SELECT taxpaid, steal_uses, steal_success, ubank
-        FROM wallets_taxpaid
-        WHERE user_id=$1
-        """, account_id)
-
-        daccount.update(dict(wallet))
-        return response.json(daccount)
-
-    return response.json(daccount)
+    return response.json(account_to_json(account))
 
 
 @app.post('/api/wallets/<account_id:int>')
+@idempotent
 async def create_account(request, account_id):
     """Create a single account.
 
@@ -151,30 +283,76 @@ async def create_account(request, account_id):
         VALUES ($1)
         """, account_id)
 
+    request.app.sync.change('add', account_id, account_type)
+
     _, _, rows = res.split()
     return response.json({'inserted': rows})
 
 
 @app.delete('/api/wallets/<account_id:int>')
+@idempotent
 async def delete_account(request, account_id: int):
     try:
-        await request.app.db.execute("""
+        # the wallet goes away with ON DELETE CASCADE,
+        # so get its steal statistics in the same statement.
+        row = await request.app.db.fetchrow("""
+        WITH wallet AS (
+            SELECT steal_uses, steal_success FROM wallets
+            WHERE user_id = $1
+        )
         DELETE FROM accounts
         WHERE account_id = $1
+        RETURNING (SELECT steal_uses FROM wallet),
+                  (SELECT steal_success FROM wallet)
         """, account_id)
 
+        if row is None:
+            request.app.sync.change('remove', account_id, 0, 0)
+        else:
+            request.app.sync.change('remove', account_id,
+                                    row['steal_uses'] or 0,
+                                    row['steal_success'] or 0)
+
         return response.json({'success': True})
     except Exception as err:
         log.exception('error while deleting')
         return response.json({'success': False, 'err': repr(err)})
 
 
-@app.post('/api/wallets/<sender_id:int>/transfer')
-async def transfer(request, sender_id):
-    """Transfer money between users."""
+def check_transfer(res, amount: decimal.Decimal):
+    """Raise the respective error if a call
+    to transfer_funds() did not succeed."""
+    status = res['status']
+    if status == 'ok':
+        return
+
+    if status == 'sender_missing':
+        raise AccountNotFoundError('Sender is missing account')
+    elif status == 'receiver_missing':
+        raise AccountNotFoundError('Receiver is missing account')
+    elif status == 'sender_locked':
+        raise ConditionError('Sender account is locked')
+    elif status == 'receiver_locked':
+        raise ConditionError('Receiver account is locked')
+    elif status == 'no_funds':
+        raise ConditionError(f'Not enough funds: {amount} > '
+                             f'{from_cents(res["sender_amount"])}')
+    elif status == 'no_tax_funds':
+        raise ConditionError('Tax transfer did not find any available funds.')
+
+    raise GenericError(f'Unknown transfer status: {status!r}')
+
+
+def check_transfer_input(sender_id: int, receiver_id: int,
+                         amount) -> decimal.Decimal:
+    """Check the input of a transfer.
+
+    Returns the rounded amount to be transferred.
+    """
     try:
-        receiver_id = int(request.json['receiver'])
-        amount = decimal.Decimal(request.json['amount'])
+        sender_id = int(sender_id)
+        receiver_id = int(receiver_id)
+        amount = decimal.Decimal(amount)
     except:
         raise InputError('Invalid input')
 
@@ -189,162 +367,265 @@ async def transfer(request, sender_id):
     if amount < 0.01:
         raise InputError('Negative amounts are not allowed')
 
-    # NOTE: this uses the view
-    accs = await request.app.db.fetch("""
-    SELECT * FROM account_amount
-    WHERE account_id=$1 or account_id=$2
-    """, sender_id, receiver_id)
+    return amount
 
-    accounts = {a['account_id']: a for a in accs}
-    sender = accounts.get(sender_id)
-    receiver = accounts.get(receiver_id)
 
-    if not sender:
-        raise AccountNotFoundError('Sender is missing account')
+def after_transfer(app, sender_id: int, receiver_id: int,
+                   amount: decimal.Decimal, res,
+                   description: str = 'transfer'):
+    """Update the server's state after a successful transfer."""
+    app.txmanager.queue(sender_id, receiver_id, amount, description)
 
-    if not receiver:
-        raise AccountNotFoundError('Receiver is missing account')
+    for account_id, new_amount in ((sender_id, res['sender_amount']),
+                                   (receiver_id, res['receiver_amount'])):
+        app.sync.change('amount', account_id, new_amount)
 
-    sender_lock = request.app.account_locks[sender_id]
-    receiver_lock = request.app.account_locks[receiver_id]
+    if res['sender_taxpaid'] is not None:
+        app.sync.change('taxpaid', sender_id, res['sender_taxpaid'])
 
-    if sender_lock:
-        raise ConditionError('Sender account is locked')
 
-    if receiver_lock:
-        raise ConditionError('Receiver account is locked')
+def transfer_result(res) -> dict:
+    """Make the response for a successful transfer."""
+    result = {
+        'sender_amount':
+        fmt_cents(res['sender_amount'], res['sender_infinite']),
+        'receiver_amount':
+        fmt_cents(res['receiver_amount'], res['receiver_infinite']),
+    }
 
-    # does sender have enough money?
-    snd_amount = decimal.Decimal(str(sender['amount']))
-    snd_enough = snd_amount > amount
-    bank_enough = False
+    # only tax transfers change them, the bank
+    # when it is what paid the tax.
+    if res['sender_taxpaid'] is not None:
+        result['sender_taxpaid'] = fmt_cents(res['sender_taxpaid'])
+        result['sender_bank'] = fmt_cents(res['sender_bank'])
 
-    rtype = receiver['account_type']
-    stype = sender['account_type']
-    is_tax_transfer = rtype == AccountType.TAXBANK and \
-        stype == AccountType.USER
+    return result
 
-    if is_tax_transfer:
-        snd_bank = await request.app.db.fetchval("""
-        SELECT ubank
-        FROM wallets_taxpaid
-        WHERE user_id = $1
-        """, sender_id)
-        snd_bank = decimal.Decimal(str(snd_bank))
 
-        # does bank have enough money?
-        bank_enough = snd_bank > amount
+@app.post('/api/wallets/<sender_id:int>/transfer')
+@idempotent
+async def transfer(request, sender_id):
+    """Transfer money between users."""
+    try:
+        receiver_id = int(request.json['receiver'])
+        amount = request.json['amount']
+    except:
+        raise InputError('Invalid input')
 
-    if not is_tax_transfer and not is_inf(snd_amount) and not snd_enough:
-        raise ConditionError(f'Not enough funds: {amount} > {snd_amount}')
+    amount = check_transfer_input(sender_id, receiver_id, amount)
 
-    enough = snd_enough or bank_enough
-    if is_tax_transfer and not enough:
-        raise ConditionError(f'Tax transfer did not find any available funds.')
+    res = await request.app.db.fetchrow("""
+    SELECT * FROM transfer_funds($1, $2, $3)
+    """, sender_id, receiver_id, to_cents(amount))
 
-    rcv_amount = receiver['amount']
+    check_transfer(res, amount)
+    after_transfer(request.app, sender_id, receiver_id, amount, res)
+    return response.json(transfer_result(res))
 
-    amount = str(amount)
-    async with request.app.db.acquire() as conn, conn.transaction():
-        if is_tax_transfer:
-            if bank_enough:
-                # subtract from user bank
-                await conn.execute("""
-                UPDATE wallets
-                SET ubank = ubank - $1
-                WHERE user_id = $2
-                """, amount, sender_id)
-            elif not is_inf(snd_amount):
-                # subtract from user wallet
-                await conn.execute("""
-                UPDATE accounts
-                SET amount=accounts.amount - $1
-                WHERE account_id = $2
-                """, amount, sender_id)
-        elif not is_inf(snd_amount):
-            # normal method of operation,
-            # subtract from accounts.amount
-            await conn.execute("""
-            UPDATE accounts
-            SET amount=accounts.amount - $1
-            WHERE account_id = $2
-            """, amount, sender_id)
 
-        if is_tax_transfer:
-            await conn.execute("""
-            UPDATE wallets
-            SET taxpaid=wallets.taxpaid + $1
-            WHERE user_id=$2
-            """, amount, sender_id)
+@app.post('/api/transfers/batch')
+@idempotent
+async def transfer_batch(request):
+    """Apply many transfers in a single database transaction.
+
+    With `atomic` (the default), any failing transfer
+    makes the whole batch fail and nothing is applied.
+    Without it, each transfer succeeds or fails on its own.
+    """
+    try:
+        legs = list(request.json['transfers'])
+        atomic = bool(request.json.get('atomic', True))
+    except:
+        raise InputError('Invalid input')
 
-        if not is_inf(rcv_amount):
+    if not legs or len(legs) > MAX_BATCH_TRANSFERS:
+        raise InputError('invalid batch size')
+
+    # index of the leg -> error message, for non-atomic
+    # batches, where invalid legs fail on their own
+    invalid = {}
+
+    senders, receivers, amounts = [], [], []
+    for idx, leg in enumerate(legs):
+        try:
+            sender_id = int(leg['sender'])
+            receiver_id = int(leg['receiver'])
+            amount = check_transfer_input(sender_id, receiver_id,
+                                          leg['amount'])
+        except (KeyError, TypeError, ValueError):
+            if atomic:
+                raise InputError(f'Invalid input on transfer {idx}')
+
+            invalid[idx] = 'Invalid input'
+            continue
+        except GenericError as err:
+            if atomic:
+                raise err.__class__(f'Transfer {idx}: {err.args[0]}')
+
+            invalid[idx] = err.args[0]
+            continue
+
+        senders.append(sender_id)
+        receivers.append(receiver_id)
+        amounts.append(amount)
+
+    rows = []
+    valid_results = []
+    if senders:
+        async with request.app.db.acquire() as conn, conn.transaction():
+            # transfer_funds() locks the accounts of one leg in order,
+            # but legs run in request order. Lock everything the batch
+            # touches first, in order, so batches can't deadlock.
             await conn.execute("""
-                UPDATE accounts
-                SET amount=accounts.amount + $1
-                WHERE account_id = $2
-            """, amount, receiver_id)
+            SELECT 1 FROM accounts
+            WHERE account_id = ANY($1::bigint[])
+            ORDER BY account_id
+            FOR UPDATE
+            """, list(set(senders) | set(receivers)))
+
+            # transfer_funds() doesn't touch anything on a failed
+            # check, so only atomic batches need to roll back.
+            rows = await conn.fetch("""
+            SELECT res.*
+            FROM unnest($1::bigint[], $2::bigint[], $3::bigint[])
+                WITH ORDINALITY AS legs(sender, receiver, amount, idx)
+            CROSS JOIN LATERAL
+                transfer_funds(legs.sender, legs.receiver,
+                               legs.amount) AS res
+            ORDER BY legs.idx
+            """, senders, receivers, [to_cents(a) for a in amounts])
+
+            for idx, (res, amount) in enumerate(zip(rows, amounts)):
+                try:
+                    check_transfer(res, amount)
+                except GenericError as err:
+                    if atomic:
+                        raise err.__class__(
+                            f'Transfer {idx}: {err.args[0]}')
+
+                    valid_results.append({'success': False,
+                                          'message': err.args[0]})
+                    continue
+
+                result = transfer_result(res)
+                result['success'] = True
+                valid_results.append(result)
+
+    # only touch the server's state after the transaction is committed
+    for sender_id, receiver_id, amount, res, result in \
+            zip(senders, receivers, amounts, rows, valid_results):
+        if result['success']:
+            after_transfer(request.app, sender_id, receiver_id, amount, res)
+
+    # put the invalid legs back in their place
+    valid_results = iter(valid_results)
+    results = [
+        {'success': False, 'message': invalid[idx]} if idx in invalid
+        else next(valid_results)
+        for idx in range(len(legs))
+    ]
 
-        # log transaction
-        await conn.execute("""
-            INSERT INTO transactions (sender, receiver, amount)
-            VALUES ($1, $2, $3)
-        """, sender_id, receiver_id, amount)
-
-    einf = str(ENCODED_INFINITY)
-    # yes, we go back and forth.
-    amount = decimal.Decimal(str(amount))
-    rcv_amount = decimal.Decimal(str(rcv_amount))
     return response.json({
-        'sender_amount':
-        einf if is_inf(snd_amount) else snd_amount - amount,
-        'receiver_amount':
-        einf if is_inf(rcv_amount) else rcv_amount + amount
+        'success': all(r['success'] for r in results),
+        'results': results,
     })
 
 
 @app.post('/api/wallets/<wallet_id:int>/deposit')
+@idempotent
 async def bank_deposit(request, wallet_id):
-    amount = decimal.Decimal(request.json['amount'])
+    try:
+        amount = round(decimal.Decimal(request.json['amount']), 2)
+    except:
+        raise InputError('Invalid input')
 
-    account = await request.app.db.fetchrow("""
-    SELECT account_id, account_type, amount
-    FROM account_amount
-    WHERE account_id = $1
-    """, wallet_id)
+    if amount < 0.01:
+        raise InputError('Negative amounts are not allowed')
 
-    if not account:
-        raise AccountNotFoundError('Account not found')
+    amount = to_cents(amount)
 
-    if account['account_type'] != AccountType.USER:
-        raise ConditionError('Account is not taxbank')
+    async with request.app.db.acquire() as conn, conn.transaction():
+        account = await conn.fetchrow("""
+        SELECT account_type, amount
+        FROM accounts
+        WHERE account_id = $1
+        FOR UPDATE
+        """, wallet_id)
 
-    if account['amount'] < amount:
-        raise ConditionError('Not enough funds')
+        if not account:
+            raise AccountNotFoundError('Account not found')
 
-    async with request.app.db.acquire() as conn, conn.transaction():
-        await conn.execute("""
+        if account['account_type'] != AccountType.USER:
+            raise ConditionError('Account is not taxbank')
+
+        if account['amount'] < amount:
+            raise ConditionError('Not enough funds')
+
+        new_amount = await conn.fetchval("""
         UPDATE accounts
         SET amount = amount - $1
         WHERE account_id = $2
-        """, str(amount), wallet_id)
+        RETURNING amount
+        """, amount, wallet_id)
 
         await conn.execute("""
         UPDATE wallets
         SET ubank = ubank + $1
         WHERE user_id = $2
-        """, str(amount), wallet_id)
+        """, amount, wallet_id)
 
+    request.app.sync.change('amount', wallet_id, new_amount)
     return response.json({
         'status': True,
     })
 
 
+@app.post('/api/wallets/<wallet_id:int>/amount')
+@idempotent
+async def write_amount(request, wallet_id):
+    """Overwrite the amount of an account."""
+    try:
+        amount = round(decimal.Decimal(request.json['amount']), 2)
+    except:
+        raise InputError('Invalid input')
+
+    new_amount = await request.app.db.fetchval("""
+    UPDATE accounts
+    SET amount = $1
+    WHERE account_id = $2
+    RETURNING amount
+    """, to_cents(amount), wallet_id)
+
+    if new_amount is None:
+        raise AccountNotFoundError('Account not found')
+
+    # keep the leaderboard and totals right without waiting for a reload
+    request.app.sync.change('amount', wallet_id, new_amount)
+    return response.json({
+        'amount': fmt_cents(new_amount),
+    })
+
+
 @app.post('/api/lock_accounts')
 async def lock_account(request):
-    """Lock an account from transfer operations."""
+    """Lock an account from transfer operations.
+
+    Locks expire after `lease` seconds.
+    """
     accounts = list(request.json['accounts'])
-    for acc_id in accounts:
-        request.app.account_locks[acc_id] = True
+
+    try:
+        lease = int(request.json['lease'])
+    except (ValueError, TypeError, KeyError):
+        lease = getattr(jconfig, 'lock_lease', 600)
+
+    await request.app.db.execute("""
+    INSERT INTO account_locks (account_id, expires_at)
+    SELECT account_id, now() + $2::int * interval '1 second'
+    FROM unnest($1::bigint[]) AS account_id
+    ON CONFLICT (account_id)
+    DO UPDATE SET expires_at = EXCLUDED.expires_at
+    """, accounts, lease)
 
     return response.json({'status': True})
 
@@ -353,8 +634,10 @@ async def lock_account(request):
 async def unlock_account(request):
     """UnLock an account from transfer operations."""
     accounts = list(request.json['accounts'])
-    for acc_id in accounts:
-        request.app.account_locks[acc_id] = False
+    await request.app.db.execute("""
+    DELETE FROM account_locks
+    WHERE account_id = ANY($1::bigint[])
+    """, accounts)
 
     return response.json({'status': True})
 
@@ -363,10 +646,18 @@ async def unlock_account(request):
 async def is_locked(request):
     """Return if the account is locked or not."""
     account_id = int(request.json['account_id'])
-    return response.json({'locked': request.app.account_locks[account_id]})
+    locked = await request.app.db.fetchval("""
+    SELECT EXISTS (
+        SELECT 1 FROM account_locks
+        WHERE account_id = $1 AND expires_at > now()
+    )
+    """, account_id)
+
+    return response.json({'locked': locked})
 
 
 @app.post('/api/wallets/<wallet_id:int>/steal_use')
+@idempotent
 async def inc_steal_use(request, wallet_id: int):
     """Increment a wallet's `steal_uses` field by one."""
     async with request.app.db.acquire() as conn, conn.transaction():
@@ -378,12 +669,15 @@ async def inc_steal_use(request, wallet_id: int):
 
         _, items = res.split()
         items = int(items)
-        return response.json({
-            'success': bool(items),
-        })
+
+    request.app.sync.change('steals', items, 0)
+    return response.json({
+        'success': bool(items),
+    })
 
 
 @app.post('/api/wallets/<wallet_id:int>/steal_success')
+@idempotent
 async def inc_steal_success(request, wallet_id: int):
     """Increment a wallet's `steal_success` field by one."""
     async with request.app.db.acquire() as conn, conn.transaction():
@@ -395,10 +689,319 @@ async def inc_steal_success(request, wallet_id: int):
 
         _, items = res.split()
         items = int(items)
-        return response.json({
-            'success': bool(items),
+
+    request.app.sync.change('steals', 0, items)
+    return response.json({
+        'success': bool(items),
+    })
+
+
+def account_amount(row) -> decimal.Decimal:
+    """Get the amount of an account row, in JC."""
+    if row['infinite']:
+        return decimal.Decimal('inf')
+
+    return from_cents(row['amount'])
+
+
+async def add_steal_cooldown(conn, user_id: int, ctype: str, hours: int):
+    await conn.execute("""
+    INSERT INTO steal_cooldown (user_id, ctype, finish)
+    VALUES ($1, $2, now() + $3::int * interval '1 hour')
+    ON CONFLICT (user_id, ctype)
+    DO UPDATE SET finish = EXCLUDED.finish
+    """, user_id, ctype, hours)
+
+
+async def steal_arrest(conn, thief, guild_id: int,
+                       amount: decimal.Decimal) -> tuple:
+    """Arrest a thief.
+
+    Thieves pay half the amount they tried to steal to the
+    guild's taxbank. If they can't, their wallet is taken (all
+    but a cent, the funds check of transfer_funds() is strict)
+    and they get an extra hour in jail for each JC.
+
+    Returns the hours in jail and the transfer
+    that was made, as (sender, receiver, amount, res), if any.
+    """
+    thief_id = thief['account_id']
+    hours = STEAL_ARREST_HOURS
+
+    fee = round(amount / 2, 2)
+    res = await conn.fetchrow("""
+    SELECT * FROM transfer_funds($1, $2, $3)
+    """, thief_id, guild_id, to_cents(fee))
+
+    if res['status'] in ('no_funds', 'no_tax_funds'):
+        # BIG JAIL.
+        cents = thief['amount'] - 1
+        fee = from_cents(cents)
+        hours += int(fee)
+
+        res = None
+        if cents > 0:
+            res = await conn.fetchrow("""
+            SELECT * FROM transfer_funds($1, $2, $3)
+            """, thief_id, guild_id, cents)
+            check_transfer(res, fee)
+    else:
+        check_transfer(res, fee)
+
+    await add_steal_cooldown(conn, thief_id, 'prison', hours)
+
+    transfer = (thief_id, guild_id, fee, res) if res else None
+    return hours, transfer
+
+
+async def run_steal(conn, thief_id: int, target_id: int, guild_id: int,
+                    amount: decimal.Decimal) -> tuple:
+    """Run a steal, from its checks to the arrest
+    or the transfer, inside the current transaction.
+
+    Returns a tuple with the result and the list
+    of transfers made, as (sender, receiver, amount, res, description).
+    """
+    rows = await conn.fetch("""
+    SELECT account_id, account_type, amount, infinite
+    FROM accounts
+    WHERE account_id = ANY($1::bigint[])
+    ORDER BY account_id
+    FOR UPDATE
+    """, [thief_id, target_id, guild_id])
+    accounts = {row['account_id']: row for row in rows}
+
+    try:
+        thief = accounts[thief_id]
+        target = accounts[target_id]
+        accounts[guild_id]
+    except KeyError:
+        raise AccountNotFoundError('Account not found')
+
+    locked = await conn.fetchval("""
+    SELECT EXISTS (
+        SELECT 1 FROM account_locks
+        WHERE account_id = ANY($1::bigint[]) AND expires_at > now()
+    )
+    """, [thief_id, target_id])
+
+    if locked:
+        raise ConditionError('One of the accounts is locked')
+
+    thief_amount = account_amount(thief)
+    target_amount = account_amount(target)
+
+    if thief_amount < 6:
+        raise ConditionError("You have less than `6JC`, "
+                             "can't use the steal command")
+
+    if target_amount < 3:
+        raise ConditionError('Target has less than `3JC`, '
+                             'cannot steal them')
+
+    if amount > 2 * thief_amount:
+        raise ConditionError('You can not steal more than double '
+                             'your current wallet amount.')
+
+    now = datetime.datetime.utcnow()
+
+    cooldowns = await conn.fetch("""
+    SELECT ctype, finish FROM steal_cooldown
+    WHERE user_id=$1
+    """, thief_id)
+
+    for cooldown in cooldowns:
+        ctype, finish = cooldown['ctype'], cooldown['finish']
+        if now < finish:
+            return {
+                'status': 'cooldown',
+                'cooldown': ctype,
+                'remaining': (finish - now).total_seconds(),
+            }, []
+
+        await conn.execute("""
+        DELETE FROM steal_cooldown
+        WHERE user_id=$1 AND ctype=$2
+        """, thief_id, ctype)
+
+        if ctype == 'points':
+            await conn.execute("""
+            UPDATE steal_points
+            SET points=3
+            WHERE user_id=$1
+            """, thief_id)
+
+    grace = await conn.fetchval("""
+    SELECT finish FROM steal_grace
+    WHERE user_id = $1
+    """, target_id)
+
+    if grace and now < grace:
+        return {
+            'status': 'grace',
+            'remaining': (grace - now).total_seconds(),
+        }, []
+
+    points = await conn.fetchval("""
+    SELECT points FROM steal_points
+    WHERE user_id = $1
+    FOR UPDATE
+    """, thief_id)
+
+    if points is None:
+        await conn.execute("""
+        INSERT INTO steal_points (user_id)
+        VALUES ($1)
+        """, thief_id)
+        points = 3
+
+    if points < 1:
+        await add_steal_cooldown(conn, thief_id, 'points', STEAL_REGEN_HOURS)
+        return {
+            'status': 'no_points',
+            'hours': STEAL_REGEN_HOURS,
+        }, []
+
+    await conn.execute("""
+    UPDATE steal_points
+    SET points = points - 1
+    WHERE user_id = $1
+    """, thief_id)
+
+    if (points - 1) < 1:
+        await add_steal_cooldown(conn, thief_id, 'points', STEAL_REGEN_HOURS)
+
+    await conn.execute("""
+    UPDATE wallets
+    SET steal_uses = steal_uses + 1
+    WHERE user_id=$1
+    """, thief_id)
+
+    # checking for other stuff that cause autojail
+    reason = None
+    if target['infinite']:
+        reason = 'infinite'
+    elif amount > target_amount:
+        reason = 'too_much'
+
+    if reason:
+        hours, transfer = await steal_arrest(conn, thief, guild_id, amount)
+        return {
+            'status': 'arrested',
+            'reason': reason,
+            'hours': hours,
+        }, [transfer + ('arrest', )] if transfer else []
+
+    chance = (STEAL_BASE_CHANCE + (target_amount / amount)) * STEAL_CONSTANT
+    if chance > 5:
+        chance = 5
+    chance = round(chance, 3)
+
+    roll = round(random.uniform(0, 10), 3)
+    success = roll < chance
+
+    log.info(f'[steal] chance={chance} res={roll} amount={amount} '
+             f't_amnt={target_amount} thief={thief_id} target={target_id}')
+
+    await conn.execute("""
+    INSERT INTO steal_history (thief, target, target_before,
+        amount, success, chance, res)
+    VALUES ($1, $2, $3, $4, $5, $6, $7)
+    """, thief_id, target_id, target_amount, amount, success,
+                       float(chance), roll)
+
+    result = {
+        'chance': str(chance),
+        'res': roll,
+    }
+
+    if not success:
+        hours, transfer = await steal_arrest(conn, thief, guild_id, amount)
+        result.update({
+            'status': 'arrested',
+            'reason': 'roll',
+            'hours': hours,
+        })
+        return result, [transfer + ('arrest', )] if transfer else []
+
+    await conn.execute("""
+    UPDATE wallets
+    SET steal_success = steal_success + 1
+    WHERE user_id=$1
+    """, thief_id)
+
+    res = await conn.fetchrow("""
+    SELECT * FROM transfer_funds($1, $2, $3)
+    """, target_id, thief_id, to_cents(amount))
+    check_transfer(res, amount)
+
+    grace = decimal.Decimal(STEAL_GRACE_HOURS)
+    if target_amount > 200:
+        # decrease grace period the richer you are
+        temp = target_amount * (decimal.Decimal('0.3') * target_amount)
+        grace -= (temp / amount) * decimal.Decimal('0.001')
+
+    if grace > 0:
+        await conn.execute("""
+        INSERT INTO steal_grace (user_id, finish)
+        VALUES ($1, now() + $2::int * interval '1 hour')
+        ON CONFLICT (user_id)
+        DO UPDATE SET finish = EXCLUDED.finish
+        """, target_id, STEAL_GRACE_HOURS)
+
+    result.update({
+        'status': 'success',
+        'grace': str(round(grace, 2)),
+    })
+    return result, [(target_id, thief_id, amount, res, 'steal')]
+
+
+@app.post('/api/steal')
+@idempotent
+async def steal(request):
+    """Run a whole steal in a single transaction.
+
+    Returns the outcome of the steal, transfers
+    made are in its `transfers` list.
+    """
+    try:
+        thief_id = int(request.json['thief'])
+        target_id = int(request.json['target'])
+        guild_id = int(request.json['guild_id'])
+        amount = round(decimal.Decimal(request.json['amount']), 2)
+    except:
+        raise InputError('Invalid input')
+
+    if thief_id == target_id:
+        raise InputError('You can not steal from yourself')
+
+    if amount <= decimal.Decimal('0.01'):
+        raise InputError('Stealing too low.')
+
+    async with request.app.db.acquire() as conn, conn.transaction():
+        result, transfers = await run_steal(conn, thief_id, target_id,
+                                            guild_id, amount)
+
+    economy = request.app.economy
+    if result['status'] in ('success', 'arrested'):
+        economy.steal_uses += 1
+
+    if result['status'] == 'success':
+        economy.steal_success += 1
+
+    result['transfers'] = []
+    for sender_id, receiver_id, tx_amount, res, description in transfers:
+        after_transfer(request.app, sender_id, receiver_id, tx_amount, res,
+                       description)
+
+        result['transfers'].append({
+            'sender': sender_id,
+            'receiver': receiver_id,
+            'amount': str(tx_amount),
         })
 
+    return response.json(result)
+
 
 @app.get('/api/wallets/<wallet_id:int>/rank')
 async def wallet_rank(request, wallet_id: int):
@@ -412,32 +1015,27 @@ async def wallet_rank(request, wallet_id: int):
     except AttributeError:
         guild_id = None
 
-    global_rank = await request.app.db.fetchval("""
-    SELECT s.rank FROM (
-        SELECT accounts.account_id, rank() over (
-            ORDER BY accounts.amount DESC
-        ) FROM accounts WHERE account_type = $2
-    ) AS s WHERE s.account_id = $1
-    """, wallet_id, AccountType.USER)
+    ranks = request.app.ranks
 
+    global_rank = ranks.wealth.rank(wallet_id)
     if global_rank is None:
-        raise AccountNotFoundError('Account not found')
+        # it may have been made by another worker a moment ago
+        row = await request.app.db.fetchrow("""
+        SELECT accounts.amount, wallets.taxpaid
+        FROM accounts
+        JOIN wallets ON accounts.account_id = wallets.user_id
+        WHERE account_id = $1
+        """, wallet_id)
 
-    global_total = await request.app.db.fetchval("""
-    SELECT COUNT(*) FROM accounts WHERE account_type = $1
-    """, AccountType.USER)
+        if row is None:
+            raise AccountNotFoundError('Account not found')
 
-    taxes_total = await request.app.db.fetchval("""
-    SELECT COUNT(*) FROM wallets
-    """)
+        ranks.add_user(wallet_id, row['amount'], row['taxpaid'])
+        global_rank = ranks.wealth.rank(wallet_id)
 
-    taxes_rank = await request.app.db.fetchval("""
-    SELECT s.rank FROM (
-        SELECT wallets.user_id, rank() over (
-            ORDER BY wallets.taxpaid DESC
-        ) FROM wallets
-    ) AS s WHERE s.user_id = $1
-    """, wallet_id)
+    global_total = len(ranks.wealth)
+    taxes_rank = ranks.taxes.rank(wallet_id)
+    taxes_total = len(ranks.taxes)
 
     res = {
         'global': {
@@ -451,13 +1049,14 @@ async def wallet_rank(request, wallet_id: int):
     }
 
     if guild_id:
-        local_total = await request.app.db.fetchval("""
+        db = read_db(request)
+        local_total = await db.fetchval("""
         SELECT COUNT(*) FROM accounts
         JOIN members ON accounts.account_id = members.user_id
         WHERE members.guild_id = $1
         """, guild_id)
 
-        local_rank = await request.app.db.fetchval("""
+        local_rank = await db.fetchval("""
         SELECT s.rank FROM (
             SELECT accounts.account_id, rank() over (
                 ORDER BY accounts.amount DESC
@@ -475,105 +1074,211 @@ async def wallet_rank(request, wallet_id: int):
     return response.json(res)
 
 
-async def getsum(request, acc_type: int) -> decimal.Decimal:
-    """Get the sum of all the amounts of a
-    specific account type."""
-
-    resp = await request.app.db.fetchrow("""
-    SELECT SUM(amount)::numeric FROM accounts WHERE account_type=$1
-    """, acc_type)
-    return resp['sum']
+@app.get('/api/gdp')
+async def get_gdp_handler(request):
+    """Get the total amount of coins in the economy."""
+    sums = request.app.economy.get_sums()
+    return response.json({k: fmt_cents(v) for k, v in sums.items()})
 
 
-async def get_count(request, acc_type: int) -> int:
-    """Get the total account count for a specific
-    account type."""
-    resp = await request.app.db.fetchrow("""
-    SELECT COUNT(*) FROM accounts WHERE account_type=$1
-    """, acc_type)
-    return resp['count']
+def parse_ids(ids, limit: int) -> list:
+    """Parse a list of IDs, or a comma separated string of them."""
+    try:
+        if isinstance(ids, str):
+            ids = ids.split(',')
 
+        ids = list({int(wallet_id) for wallet_id in ids})
+    except (ValueError, TypeError):
+        raise InputError('Invalid wallet IDs')
 
-async def get_gdp(request):
-    """Get the GDP (sum of all account amounts) in the economy"""
-    resp = await request.app.db.fetchrow("""
-    SELECT SUM(amount)::numeric FROM accounts;
-    """)
-    return resp['sum']
+    if len(ids) > limit:
+        raise InputError(f'Too many wallets, max {limit}')
 
+    return ids
 
-async def get_counts(request) -> dict:
-    """Get account counts"""
 
-    # TODO: add idx and use MAX(idx) instead of COUNT(*)
+def wallet_probability(wallet) -> dict:
+    """Get the autocoin data of a wallet row
+    with its taxpaid and hidecoins."""
+    prob = AUTOCOIN_BASE_PROB
 
-    count = await request.app.db.fetchrow("""
-    SELECT COUNT(*) FROM accounts
-    """)
-    count = count['count']
+    # Based on the tax paid.
+    taxpaid = from_cents(wallet['taxpaid'])
+    if taxpaid >= 50:
+        raised = pow(PROB_CONSTANT, taxpaid)
+        prob += round(raised / 100, 5)
 
-    usercount = await get_count(request, AccountType.USER)
-    txbcount = await get_count(request, AccountType.TAXBANK)
+    if prob > 0.042:
+        prob = 0.042
 
     return {
-        'accounts': count,
-        'user_accounts': usercount,
-        'txb_accounts': txbcount,
+        'probability': str(prob),
+        'hidecoins': bool(wallet['hidecoins']),
     }
 
 
-async def get_sums(request) -> dict:
-    """Get sum information about accounts."""
-    total_amount = await get_gdp(request)
-    user_amount = await getsum(request, AccountType.USER)
-    txb_amount = await getsum(request, AccountType.TAXBANK)
-
-    return {'gdp': total_amount, 'user': user_amount, 'taxbank': txb_amount}
-
-
-@app.get('/api/gdp')
-async def get_gdp_handler(request):
-    """Get the total amount of coins in the economy."""
-    return response.json(await get_sums(request))
-
-
 @app.get('/api/wallets/<wallet_id:int>/probability')
 async def get_wallet_probability(request, wallet_id: int):
+    # clients refetch this right after a wallet changes and cache
+    # it for long, a replica that is behind would give stale data.
     wallet = await request.app.db.fetchrow("""
-    SELECT taxpaid FROM wallets_taxpaid
+    SELECT taxpaid, hidecoins FROM wallets
     WHERE user_id=$1
     """, wallet_id)
     if not wallet:
         raise AccountNotFoundError('Wallet not found')
-    taxpaid = wallet['taxpaid']
 
-    prob = AUTOCOIN_BASE_PROB
+    return response.json(wallet_probability(wallet))
 
-    # Based on the tax paid.
-    taxpaid = decimal.Decimal(taxpaid)
-    if taxpaid >= 50:
-        raised = pow(PROB_CONSTANT, taxpaid)
-        prob += round(raised / 100, 5)
 
-    if prob > 0.042:
-        prob = 0.042
+@app.get('/api/wallets/probability')
+async def get_wallet_probabilities(request):
+    """Get the probabilities of many wallets.
+
+    IDs that don't have a wallet are left out.
+    """
+    ids = request.raw_args.get('ids') or (request.json or {}).get('ids')
+    if ids is None:
+        raise InputError('No wallet IDs given')
+
+    ids = parse_ids(ids, MAX_BULK_PROBABILITIES)
+    rows = await read_db(request).fetch("""
+    SELECT user_id, taxpaid, hidecoins FROM wallets
+    WHERE user_id = ANY($1::bigint[])
+    """, ids)
 
     return response.json({
-        'probability': str(prob),
+        str(row['user_id']): wallet_probability(row) for row in rows
     })
 
 
+# leaderboards of GET /api/wallets.
+# name -> (FROM and WHERE clauses, sort column, id column, filters by guild)
+LEADERBOARDS = {
+    'local': ("""
+    FROM accounts
+    JOIN members ON accounts.account_id = members.user_id
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE members.guild_id = $1
+    """, 'accounts.amount', 'accounts.account_id', True),
+
+    # global / taxpaid checks if the user is in any mutual guild
+    # to avoid having unknown users in j!top
+    'global': ("""
+    FROM accounts
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE EXISTS (SELECT 1 FROM members
+                  WHERE members.user_id = accounts.account_id)
+    AND accounts.amount != 0
+    """, 'accounts.amount', 'accounts.account_id', False),
+
+    'global_users': (f"""
+    FROM accounts
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE EXISTS (SELECT 1 FROM members
+                  WHERE members.user_id = accounts.account_id)
+    AND accounts.amount != 0
+    AND accounts.account_type = {AccountType.USER}
+    """, 'accounts.amount', 'accounts.account_id', False),
+
+    # taxbanks aren't members, so no guild check for them
+    'global_taxbanks': (f"""
+    FROM accounts
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE accounts.amount != 0
+    AND accounts.account_type = {AccountType.TAXBANK}
+    """, 'accounts.amount', 'accounts.account_id', False),
+
+    'taxpaid': ("""
+    FROM wallets
+    JOIN accounts ON accounts.account_id = wallets.user_id
+    WHERE EXISTS (SELECT 1 FROM members
+                  WHERE members.user_id = wallets.user_id)
+    """, 'wallets.taxpaid', 'wallets.user_id', False),
+
+    'taxbanks': (f"""
+    FROM accounts
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE accounts.account_type = {AccountType.TAXBANK}
+    """, 'accounts.amount', 'accounts.account_id', False),
+}
+
+
+def leaderboard_query(name: str, reverse: bool, after: bool) -> str:
+    """Make the query of a leaderboard page.
+
+    Pages are keyset paginated over (sort column, id column),
+    so any page costs the same as the first one as long as
+    there's an index on those columns (see indexes.rst).
+
+    Arguments are the guild ID (if the leaderboard uses it),
+    then the sort value and id of the last account of the
+    previous page (if ``after``), then the limit.
+    """
+    clauses, sort_col, id_col, by_guild = LEADERBOARDS[name]
+    order = 'DESC' if reverse else 'ASC'
+
+    argc = 1 if by_guild else 0
+
+    keyset = ''
+    if after:
+        op = '<' if reverse else '>'
+        keyset = (f'AND ({sort_col}, {id_col}) {op} '
+                  f'(${argc + 1}::bigint, ${argc + 2}::bigint)')
+        argc += 2
+
+    return f"""
+    SELECT accounts.account_id, accounts.account_type, accounts.amount,
+           accounts.infinite, wallets.taxpaid, wallets.steal_uses,
+           wallets.steal_success, wallets.ubank
+    {clauses}
+    {keyset}
+    ORDER BY {sort_col} {order}, {id_col} {order}
+    LIMIT ${argc + 1}
+    """
+
+
+# all the queries are made once, so they are the same strings
+# every call and asyncpg can reuse its prepared statements.
+LEADERBOARD_QUERIES = {
+    (name, reverse, after): leaderboard_query(name, reverse, after)
+    for name in LEADERBOARDS
+    for reverse in (False, True)
+    for after in (False, True)
+}
+
+
+async def get_wallets_bulk(request, ids) -> list:
+    """Get many wallets by their IDs.
+
+    IDs that don't have an account are left out.
+    """
+    ids = parse_ids(ids, MAX_BULK_WALLETS)
+    rows = await read_db(request).fetch("""
+    SELECT account_id, account_type, amount, infinite,
+           taxpaid, steal_uses, steal_success, ubank
+    FROM accounts
+    LEFT JOIN wallets ON accounts.account_id = wallets.user_id
+    WHERE account_id = ANY($1::bigint[])
+    """, ids)
+
+    return [account_to_json(row) for row in rows]
+
+
 @app.get('/api/wallets')
 async def get_wallets(request):
     """Get wallets by specific criteria"""
+    # ?ids=1,2,3 or {"ids": [1, 2, 3]} is a lookup by ID
+    ids = request.raw_args.get('ids') or (request.json or {}).get('ids')
+    if ids is not None:
+        return response.json(await get_wallets_bulk(request, ids))
+
     key = request.json['key']
     try:
         reverse = bool(request.json['reverse'])
     except (ValueError, TypeError, KeyError):
         reverse = False
 
-    sorting = 'DESC' if reverse else 'ASC'
-
     try:
         guild_id = int(request.json['guild_id'])
     except (ValueError, TypeError, KeyError):
@@ -592,123 +1297,103 @@ async def get_wallets(request):
     if limit <= 0 or limit > 60:
         raise InputError('invalid limit range')
 
-    query = ''
-
-    # very ugly hack
-    acc_type_str = {
-        AccountType.USER:
-        f'account_amount.account_type={AccountType.USER}',
-        AccountType.TAXBANK:
-        'account_amount.account_type'
-        f'={AccountType.TAXBANK}',
-    }.get(acc_type, '')
-
-    acc_type_str_w = ''
-    if acc_type_str:
-        acc_type_str_w = f'AND {acc_type_str}'
-
-    args = [guild_id]
-
-    if key == 'local':
-        query = f"""
-        SELECT * FROM account_amount
-
-        JOIN members ON account_amount.account_id = members.user_id
-        WHERE members.guild_id = $1
-
-        ORDER BY amount {sorting}
-        LIMIT {limit}
-        """
-
-    # global / taxpaid checks if the user is in any mutual guild
-    # to avoid having unknown users in j!top
-    elif key == 'global':
-        query = f"""
-        SELECT * FROM account_amount
-        WHERE account_amount.account_id = ANY(SELECT user_id FROM members)
-        AND account_amount.amount != 0
-        {acc_type_str_w}
-
-        ORDER BY amount {sorting}
-        LIMIT {limit}
-        """
-
-        # NOTE: very shitty hack to get only-taxbank fetching
-        # working.
-        if acc_type == AccountType.TAXBANK:
-            query = f"""
-            SELECT * FROM account_amount
-            WHERE
-             account_amount.amount != 0
-             {acc_type_str_w}
-
-            ORDER BY amount {sorting}
-            LIMIT {limit}
-            """
-
-        args = []
-    elif key == 'taxpaid':
-        query = f"""
-        SELECT * FROM wallets_taxpaid
-        JOIN account_amount
-        ON account_amount.account_id = wallets_taxpaid.user_id
-        WHERE account_amount.account_id = ANY(SELECT user_id FROM members)
-
-        ORDER BY taxpaid {sorting}
-        LIMIT {limit}
-        """
-        args = []
-    elif key == 'taxbanks':
-        query = f"""
-        SELECT * FROM account_amount
-        WHERE account_type={AccountType.TAXBANK}
-
-        ORDER BY amount {sorting}
-        LIMIT {limit}
-        """
-        args = []
+    if key == 'global':
+        name = {
+            AccountType.USER: 'global_users',
+            AccountType.TAXBANK: 'global_taxbanks',
+        }.get(acc_type, 'global')
+    elif key in ('local', 'taxpaid', 'taxbanks'):
+        name = key
     else:
         return response.json({
             'success': False,
             'status': 'invalid key',
         })
 
-    log.info(query)
-    rows = await request.app.db.fetch(query, *args)
-    return response.json(map(dict, rows))
+    args = []
+    if LEADERBOARDS[name][3]:
+        if guild_id is None:
+            raise InputError('guild_id is required')
+
+        args.append(guild_id)
+
+    # cursor: sort value and id of the last account of the
+    # previous page. infinite accounts are sorted by their
+    # stored amount, which is 0.
+    after = request.json.get('after_id') is not None
+    if after:
+        try:
+            after_value = request.json['after_value']
+            after_value = 0 if after_value == INFINITY_STR else \
+                to_cents(decimal.Decimal(after_value))
+
+            args.extend([after_value, int(request.json['after_id'])])
+        except (ValueError, TypeError, KeyError, decimal.InvalidOperation):
+            raise InputError('Invalid cursor')
+
+    args.append(limit)
+
+    query = LEADERBOARD_QUERIES[(name, reverse, after)]
+    rows = await read_db(request).fetch(query, *args)
+    return response.json([account_to_json(row) for row in rows])
 
 
 @app.get('/api/stats')
 async def get_stats_handler(request):
     """Get stats about it all."""
 
-    gdp_data = await get_sums(request)
+    economy = request.app.economy
+    gdp_data = economy.get_sums()
     res = {
-        'gdp': gdp_data['gdp'],
+        'gdp': fmt_cents(gdp_data['gdp']),
     }
 
-    res.update(await get_counts(request))
-
-    res['user_money'] = gdp_data['user']
-    res['txb_money'] = gdp_data['taxbank']
+    res.update(economy.get_counts())
 
-    steal_uses = await request.app.db.fetchrow("""
-    SELECT SUM(steal_uses) FROM wallets
-    """)
-    steal_uses = steal_uses['sum']
+    res['user_money'] = fmt_cents(gdp_data['user'])
+    res['txb_money'] = fmt_cents(gdp_data['taxbank'])
 
-    steal_success = await request.app.db.fetchrow("""
-    SELECT SUM(steal_success) FROM wallets;
-    """)
-    steal_success = steal_success['sum']
+    res['steals'] = economy.steal_uses
+    res['success'] = economy.steal_success
 
-    res['steals'] = steal_uses
-    res['success'] = steal_success
+    res['events'] = request.app.events.stats
 
     return response.json(res)
 
 
+@app.get('/api/transactions/export')
+async def export_transactions(request):
+    """Stream the transaction log, filtered by
+    the query string, as CSV or NDJSON."""
+    args = request.raw_args
+    fmt = args.get('format', 'ndjson')
+    if fmt not in export.FORMATS:
+        raise InputError('Invalid format')
+
+    query, query_args = export.build_query(args)
+
+    log.info('exporting transactions as %s, filters %r', fmt, args)
+    return response.stream(
+        export.exporter(read_db(request), fmt, query, query_args),
+        content_type=export.FORMATS[fmt])
+
+
+@app.websocket('/api/events')
+async def wallet_events(request, ws):
+    """Send the IDs of changed accounts, so
+    clients know when to drop their caches."""
+    client = request['client']
+    log.info('%s subscribed to wallet events', client['client_name'])
+
+    try:
+        await request.app.events.serve(ws)
+    finally:
+        log.info('%s unsubscribed from wallet events',
+                 client['client_name'])
+
+
 @app.post('/api/wallets/<user_id:int>/hidecoins')
+@idempotent
 async def toggle_hidecoins(request, user_id: int):
     async with request.app.db.acquire() as conn, conn.transaction():
         await conn.execute("""
@@ -739,26 +1424,96 @@ async def hidecoin_status(request, user_id: int):
     return response.json({'hidden': hidecoins['hidecoins']})
 
 
-async def db_init(app):
+async def state_refresh(app, interval: int):
+    """Reload the in-memory state every `interval` seconds.
+
+    With many workers, each one only sees its own
+    transfers, so they need to catch up from the
+    database from time to time. Even with a single
+    one, this fixes drift from writes made to the
+    database directly.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # this is the state every other read is based
+            # on, a replica that is behind would roll it back.
+            await app.ranks.load(app.db)
+            await app.economy.load(app.db)
+        except Exception:
+            log.exception('error while refreshing state')
+
+
+@app.listener('before_server_start')
+async def db_init(app, loop):
     """Initialize database"""
-    app.db = await asyncpg.create_pool(**jconfig.db)
+    app.metrics = Metrics()
+    connection_class = app.metrics.connection_class()
+
+    # reads that can be a bit behind go to their own pool, so
+    # they never hold the connections transfers need.
+    app.db = await asyncpg.create_pool(
+        max_size=getattr(jconfig, 'db_pool_size', 10),
+        connection_class=connection_class, **jconfig.db)
+
+    app.db_read = await asyncpg.create_pool(
+        max_size=getattr(jconfig, 'db_read_pool_size', 10),
+        connection_class=connection_class,
+        **(getattr(jconfig, 'db_read', None) or jconfig.db))
+
+    app.tokens = TokenCache(app, getattr(jconfig, 'token_ttl', 300))
+    app.ranks = Ranks()
+    app.economy = Economy()
+    app.txmanager = TransferManager(
+        app,
+        max_batch=getattr(jconfig, 'log_batch', 500),
+        interval=getattr(jconfig, 'log_interval', 2))
+
+    await app.tokens.load()
+    await app.ranks.load(app.db)
+    await app.economy.load(app.db)
+    await app.txmanager.ensure_partitions()
+    app.txmanager.start()
+
+    app.idempotency = IdempotencyStore(
+        app, ttl=getattr(jconfig, 'idempotency_ttl', 86400))
+    app.idempotency.start()
+
+    app.events = WalletEvents(
+        jconfig.db,
+        interval=getattr(jconfig, 'events_interval', 0.25))
+
+    # each worker has its own ranks, economy and tokens,
+    # changes to them go to the others over NOTIFY.
+    app.sync = StateSync(app, enabled=getattr(jconfig, 'workers', 1) > 1)
+    app.sync.start()
+
+    await app.events.start()
+
+    interval = getattr(jconfig, 'state_refresh', 30)
+    app.refresh_task = loop.create_task(state_refresh(app, interval))
+
+
+@app.listener('after_server_stop')
+async def db_close(app, loop):
+    """Close the database, without losing the queued transaction logs."""
+    if app.refresh_task is not None:
+        app.refresh_task.cancel()
+
+    await app.sync.close()
+    await app.events.close()
+    app.idempotency.close()
+    await app.txmanager.close()
+    await app.db_read.close()
+    await app.db.close()
 
 
 def main():
     """Main entrypoint."""
-    loop = asyncio.get_event_loop()
-
-    server = app.create_server(host='0.0.0.0', port=getattr(jconfig, 'port', 8080))
-    app.account_locks = defaultdict(bool)
-    loop.create_task(server)
-    loop.create_task(db_init(app))
-    try:
-        loop.run_forever()
-    except KeyboardInterrupt:
-        loop.close()
-    except Exception:
-        log.exception('stopping')
-        loop.close()
+    app.run(
+        host='0.0.0.0',
+        port=getattr(jconfig, 'port', 8080),
+        workers=getattr(jconfig, 'workers', 1))
 
 
 if __name__ == '__main__':
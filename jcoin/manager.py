@@ -3,47 +3,187 @@ manager.py - manage transaction commiting from the queue
 to Postgres.
 """
 import asyncio
+import datetime
 import logging
 
+import asyncpg
+
 log = logging.getLogger(__name__)
 
+# columns of the transactions table that are
+# written by the manager, in order.
+LOG_COLUMNS = ('sender', 'receiver', 'amount', 'description',
+               'transferred_at')
+
 
 class TransferManager:
-    def __init__(self, app):
+    """Write-behind log of transactions.
+
+    Transfers put their log rows into a queue, and a
+    consumer task group-commits them to the transactions
+    table once there are ``max_batch`` rows waiting or
+    ``interval`` seconds passed since the first one.
+    """
+    def __init__(self, app, *, max_batch: int = 500, interval: float = 2):
         self.app = app
-        self._queue = []
+        self.max_batch = max_batch
+        self.interval = interval
+
+        self._queue = asyncio.Queue()
+        self._task = None
 
-        self.txlock = asyncio.Lock()
-        self.app.loop.create_task(self.commit_task())
+        #: how many rows / batches were committed
+        self.committed = 0
+        self.batches = 0
+
+        #: last month we made sure had partitions
+        self._partitions_month = None
 
     @property
     def db(self):
         return self.app.db
 
-    async def commit_all(self):
-        await self.txlock
-        # First, process batch of transactions
-        for tx in self._queues:
-            pass
+    @property
+    def loop(self):
+        # app.loop is not available when using create_server()
+        return asyncio.get_event_loop()
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        """Start the commit task."""
+        self._task = self.loop.create_task(self.commit_task())
+
+    async def close(self):
+        """Commit everything left in the queue
+        and stop the commit task."""
+        if self._task is None:
+            return
+
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+
+    def queue(self, sender: int, receiver: int, amount,
+              description: str = 'transfer'):
+        """Queue a transaction to be logged."""
+        self._queue.put_nowait((sender, receiver, amount, description,
+                                datetime.datetime.utcnow()))
+
+    async def ensure_partitions(self):
+        """Make sure the transaction log has partitions for
+        this month and the next one, once per month."""
+        now = datetime.datetime.utcnow()
+        month = (now.year, now.month)
+        if month == self._partitions_month:
+            return
+
+        await self.db.execute("""
+        SELECT transactions_ensure_partitions($1)
+        """, now)
+
+        self._partitions_month = month
+
+    async def _get_batch(self) -> tuple:
+        """Wait for a batch of transactions.
 
-        # Then, insert them into the log
-        await self.db.executemany("""
-        INSERT INTO transactions (sender, receiver, amount)
-        VALUES ($1, $2, $3)
-        """, ((a, b, str(c)) for (a, b, c) in self._queue))
+        Returns a tuple with the batch and a boolean
+        telling if the manager is closing.
+        """
+        first = await self._queue.get()
+        if first is None:
+            return [], True
 
-        self._queue = []
-        self.txlock.release()
+        batch = [first]
+        deadline = self.loop.time() + self.interval
+
+        while len(batch) < self.max_batch:
+            timeout = deadline - self.loop.time()
+            if timeout <= 0:
+                break
+
+            try:
+                txdata = await asyncio.wait_for(self._queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+
+            if txdata is None:
+                return batch, True
+
+            batch.append(txdata)
+
+        return batch, False
+
+    async def commit(self, batch: list, retries: int = 3):
+        """Commit a batch of transactions to the log."""
+        for attempt in range(retries):
+            try:
+                await self.ensure_partitions()
+
+                async with self.db.acquire() as conn:
+                    await conn.copy_records_to_table(
+                        'transactions', records=batch, columns=LOG_COLUMNS)
+
+                self.committed += len(batch)
+                self.batches += 1
+                return
+            except asyncpg.IntegrityConstraintViolationError:
+                # a row references something that is gone (like a
+                # deleted account), it shouldn't take the others down
+                log.warning('batch of %d transactions has a bad row, '
+                            'inserting them one by one', len(batch))
+                await self.commit_rows(batch)
+                return
+            except Exception:
+                log.exception('failed to commit %d transactions, '
+                              'attempt %d', len(batch), attempt + 1)
+                await asyncio.sleep(2**attempt)
+
+        # we did what we could, at least leave them somewhere
+        for txdata in batch:
+            log.error('lost transaction: %r', txdata)
+
+    async def commit_rows(self, batch: list):
+        """Commit transactions one by one, dropping
+        the ones that violate a constraint."""
+        columns = ', '.join(LOG_COLUMNS)
+        params = ', '.join(f'${idx}' for idx in range(1, len(LOG_COLUMNS) + 1))
+        query = f'INSERT INTO transactions ({columns}) VALUES ({params})'
+
+        async with self.db.acquire() as conn:
+            for txdata in batch:
+                try:
+                    await conn.execute(query, *txdata)
+                except asyncpg.IntegrityConstraintViolationError as err:
+                    log.error('dropped transaction %r: %s', txdata, err)
+                    continue
+
+                self.committed += 1
+
+        self.batches += 1
 
     async def commit_task(self):
-        try:
-            while True:
-                await self.commit()
-                await asyncio.sleep(20)
-        except:
-            log.exception('error in commit task')
-
-    async def queue(self, txdata):
-        await self.txlock
-        self._queue.append(txdata)
-        self.txlock.release()
+        closing = False
+        while not closing:
+            try:
+                batch, closing = await self._get_batch()
+                if batch:
+                    await self.commit(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception('error in commit task')
+
+        # drain whatever came after the close request
+        batch = []
+        while not self._queue.empty():
+            txdata = self._queue.get_nowait()
+            if txdata is not None:
+                batch.append(txdata)
+
+        if batch:
+            await self.commit(batch)
+
+        log.info('commit task finished, %d committed', self.committed)
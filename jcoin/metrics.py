@@ -0,0 +1,195 @@
+"""
+metrics.py - request, query and pool metrics, given to
+Prometheus by GET /api/metrics.
+
+Metrics are per server process. With many workers, each
+scrape only sees the worker that answered it.
+"""
+import bisect
+import collections
+import time
+
+import asyncpg
+
+# latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# quantiles given over the latest WINDOW samples
+QUANTILES = (0.5, 0.95, 0.99)
+WINDOW = 1024
+
+# queries are labelled by their first QUERY_LABEL_LEN characters
+QUERY_LABEL_LEN = 80
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\') \
+        .replace('"', r'\"').replace('\n', r'\n')
+
+
+def _labels(labels: dict) -> str:
+    return ','.join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+
+
+def query_label(query: str) -> str:
+    """Shorten a query into something usable as a label."""
+    return ' '.join(query.split())[:QUERY_LABEL_LEN]
+
+
+class Timing:
+    """Latency histogram of something, plus its latest samples."""
+    __slots__ = ('buckets', 'count', 'sum', 'recent')
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=WINDOW)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+        idx = bisect.bisect_left(BUCKETS, seconds)
+        if idx < len(BUCKETS):
+            self.buckets[idx] += 1
+
+    def quantiles(self) -> dict:
+        samples = sorted(self.recent)
+        if not samples:
+            return {}
+
+        return {
+            q: samples[min(int(q * len(samples)), len(samples) - 1)]
+            for q in QUANTILES
+        }
+
+    def render_histogram(self, name: str, labels: str) -> list:
+        lines = []
+
+        total = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+    def render_quantiles(self, name: str, labels: str) -> list:
+        return [f'{name}{{{labels},quantile="{q}"}} {value}'
+                for q, value in self.quantiles().items()]
+
+
+def render_timings(name: str, label: str, timings: dict) -> list:
+    """Render timings as a histogram named ``name``,
+    and their quantiles as a ``name_quantile`` gauge."""
+    timings = sorted(timings.items())
+    lines = [f'# TYPE {name} histogram']
+    for key, timing in timings:
+        lines.extend(timing.render_histogram(name, _labels({label: key})))
+
+    lines.append(f'# TYPE {name}_quantile gauge')
+    for key, timing in timings:
+        lines.extend(timing.render_quantiles(f'{name}_quantile',
+                                             _labels({label: key})))
+
+    return lines
+
+
+class Metrics:
+    """Collect request and query metrics."""
+    def __init__(self):
+        self.started = time.time()
+
+        #: route -> Timing
+        self.routes = collections.defaultdict(Timing)
+
+        #: (route, status) -> count
+        self.responses = collections.Counter()
+
+        #: query label -> Timing
+        self.queries = collections.defaultdict(Timing)
+
+    def observe_request(self, route: str, status: int, seconds: float):
+        self.routes[route].observe(seconds)
+        self.responses[(route, status)] += 1
+
+    def observe_query(self, query: str, seconds: float):
+        self.queries[query_label(query)].observe(seconds)
+
+    def connection_class(self):
+        """Make an asyncpg connection class that
+        times its queries into these metrics."""
+        metrics = self
+
+        def timed(name):
+            method = getattr(asyncpg.Connection, name)
+
+            async def timed_method(self, query, *args, **kwargs):
+                start = time.monotonic()
+                try:
+                    return await method(self, query, *args, **kwargs)
+                finally:
+                    metrics.observe_query(query, time.monotonic() - start)
+
+            timed_method.__name__ = name
+            timed_method.__doc__ = method.__doc__
+            return timed_method
+
+        return type('TimedConnection', (asyncpg.Connection,), {
+            name: timed(name)
+            for name in ('execute', 'executemany', 'fetch',
+                         'fetchrow', 'fetchval')
+        })
+
+    @staticmethod
+    def pool_stats(pool) -> dict:
+        """Get the size, connections in use and
+        tasks waiting for a connection of a pool."""
+        # asyncpg has no public API for this
+        holders = getattr(pool, '_holders', [])
+        queue = getattr(pool, '_queue', None)
+
+        return {
+            'size': sum(1 for h in holders
+                        if getattr(h, '_con', None) is not None),
+            'max_size': len(holders),
+            'in_use': sum(1 for h in holders if getattr(h, '_in_use', False)),
+            'waiters': len(getattr(queue, '_getters', ())),
+        }
+
+    def render(self, pools: dict) -> str:
+        """Render everything in the Prometheus text format.
+
+        Parameters
+        ----------
+        pools: dict
+            Name -> asyncpg pool to give the stats of.
+        """
+        lines = [
+            '# TYPE jcoin_uptime_seconds gauge',
+            f'jcoin_uptime_seconds {time.time() - self.started}',
+        ]
+
+        lines.append('# TYPE jcoin_responses_total counter')
+        for (route, status), count in sorted(self.responses.items()):
+            labels = _labels({'route': route, 'status': status})
+            lines.append(f'jcoin_responses_total{{{labels}}} {count}')
+
+        lines.extend(render_timings('jcoin_request_duration_seconds',
+                                    'route', self.routes))
+        lines.extend(render_timings('jcoin_query_duration_seconds',
+                                    'query', self.queries))
+
+        stats = {name: self.pool_stats(pool) for name, pool in pools.items()}
+        for stat in ('size', 'max_size', 'in_use', 'waiters'):
+            lines.append(f'# TYPE jcoin_pool_{stat} gauge')
+            for name, pool_stats in stats.items():
+                lines.append(f'jcoin_pool_{stat}{{pool="{name}"}} '
+                             f'{pool_stats[stat]}')
+
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3.6
+"""
+migrate.py - keep the JoséCoin database schema up to date.
+
+Migrations are the SQL files in migrations/, named
+NNNN_description.sql, applied in order. Each one runs in
+its own transaction, together with recording it in the
+schema_migrations table.
+
+schema.sql always has the latest schema, so any change to
+it must come with a migration doing the same change.
+
+usage:
+    python3 migrate.py          apply pending migrations
+    python3 migrate.py init     create a new database from schema.sql
+    python3 migrate.py status   show applied and pending migrations
+"""
+import sys
+import os
+import re
+
+import asyncio
+import asyncpg
+
+import config
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MIGRATIONS_DIR = os.path.join(BASE_DIR, 'migrations')
+MIGRATION_RGX = re.compile(r'^(\d{4})_(\w+)\.sql$')
+
+
+def get_migrations() -> list:
+    """Get a sorted list of (version, name, path)
+    tuples of all migration files."""
+    migrations = []
+
+    for filename in os.listdir(MIGRATIONS_DIR):
+        match = MIGRATION_RGX.match(filename)
+        if not match:
+            continue
+
+        version, name = match.groups()
+        migrations.append((int(version), name,
+                           os.path.join(MIGRATIONS_DIR, filename)))
+
+    return sorted(migrations)
+
+
+def read(path: str) -> str:
+    with open(path, 'r') as sqlfile:
+        return sqlfile.read()
+
+
+async def ensure_table(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version int PRIMARY KEY,
+        name text NOT NULL,
+        applied_at timestamp without time zone default now()
+    )
+    """)
+
+
+async def get_applied(conn) -> set:
+    rows = await conn.fetch("""
+    SELECT version FROM schema_migrations
+    """)
+
+    return {row['version'] for row in rows}
+
+
+async def mark_applied(conn, version: int, name: str):
+    await conn.execute("""
+    INSERT INTO schema_migrations (version, name)
+    VALUES ($1, $2)
+    """, version, name)
+
+
+async def init(conn):
+    """Create the schema from schema.sql and mark all
+    migrations as applied, since it already has them."""
+    await ensure_table(conn)
+    if await get_applied(conn):
+        print('database already initialized, '
+              'run without arguments to migrate')
+        return
+
+    async with conn.transaction():
+        await conn.execute(read(os.path.join(BASE_DIR, 'schema.sql')))
+
+        for version, name, _ in get_migrations():
+            await mark_applied(conn, version, name)
+
+    print('initialized database from schema.sql')
+
+
+async def migrate(conn):
+    """Apply all pending migrations."""
+    await ensure_table(conn)
+    applied = await get_applied(conn)
+
+    pending = [m for m in get_migrations() if m[0] not in applied]
+    if not pending:
+        print('nothing to migrate')
+        return
+
+    for version, name, path in pending:
+        print(f'applying {version:04d}_{name}')
+
+        async with conn.transaction():
+            await conn.execute(read(path))
+            await mark_applied(conn, version, name)
+
+    print(f'applied {len(pending)} migrations')
+
+
+async def status(conn):
+    await ensure_table(conn)
+    applied = await get_applied(conn)
+
+    for version, name, _ in get_migrations():
+        state = 'applied' if version in applied else 'pending'
+        print(f'{version:04d}_{name}: {state}')
+
+
+COMMANDS = {
+    'migrate': migrate,
+    'init': init,
+    'status': status,
+}
+
+
+async def main():
+    try:
+        command = COMMANDS[sys.argv[1] if len(sys.argv) > 1 else 'migrate']
+    except KeyError:
+        print(__doc__)
+        return
+
+    conn = await asyncpg.connect(**config.db)
+    try:
+        await command(conn)
+    finally:
+        await conn.close()
+
+
+if __name__ == '__main__':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main())
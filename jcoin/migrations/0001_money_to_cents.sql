@@ -0,0 +1,151 @@
+/*
+ Move balances from the money type to integer cents.
+
+ The José account had its infinite money "encoded" as -69,
+ that becomes the infinite flag (with a zero amount).
+
+ Also creates account_locks for databases made before it existed.
+ */
+CREATE TABLE IF NOT EXISTS account_locks (
+    account_id bigint PRIMARY KEY,
+    expires_at timestamp without time zone NOT NULL
+);
+
+DROP VIEW IF EXISTS account_amount;
+DROP VIEW IF EXISTS wallets_taxpaid;
+DROP FUNCTION IF EXISTS transfer_funds(bigint, bigint, numeric);
+
+ALTER TABLE accounts ADD COLUMN infinite boolean NOT NULL DEFAULT false;
+
+UPDATE accounts
+SET infinite = true, amount = 0
+WHERE amount = '-69'::money;
+
+ALTER TABLE accounts
+    ALTER COLUMN amount DROP DEFAULT,
+    ALTER COLUMN amount TYPE bigint
+        USING round(coalesce(amount, 0::money)::numeric * 100)::bigint,
+    ALTER COLUMN amount SET DEFAULT 0,
+    ALTER COLUMN amount SET NOT NULL;
+
+ALTER TABLE wallets
+    ALTER COLUMN taxpaid DROP DEFAULT,
+    ALTER COLUMN taxpaid TYPE bigint
+        USING round(coalesce(taxpaid, 0::money)::numeric * 100)::bigint,
+    ALTER COLUMN taxpaid SET DEFAULT 0,
+    ALTER COLUMN taxpaid SET NOT NULL,
+    ALTER COLUMN ubank DROP DEFAULT,
+    ALTER COLUMN ubank TYPE bigint
+        USING round(coalesce(ubank, 0::money)::numeric * 100)::bigint,
+    ALTER COLUMN ubank SET DEFAULT 1000,
+    ALTER COLUMN ubank SET NOT NULL;
+
+CREATE VIEW account_amount as
+SELECT account_id, account_type, amount / 100.0 AS amount, infinite
+FROM accounts;
+
+CREATE VIEW wallets_taxpaid as
+SELECT user_id, taxpaid / 100.0 AS taxpaid, hidecoins, steal_uses,
+       steal_success, ubank / 100.0 AS ubank
+FROM wallets;
+
+CREATE OR REPLACE FUNCTION transfer_funds(p_sender bigint, p_receiver bigint,
+                                          p_amount bigint,
+                                          OUT status text,
+                                          OUT sender_amount bigint,
+                                          OUT receiver_amount bigint,
+                                          OUT sender_bank bigint,
+                                          OUT sender_taxpaid bigint,
+                                          OUT sender_infinite boolean,
+                                          OUT receiver_infinite boolean)
+AS $$
+DECLARE
+    snd accounts%ROWTYPE;
+    rcv accounts%ROWTYPE;
+    is_tax boolean;
+    use_bank boolean := false;
+BEGIN
+    /* lock both rows in a fixed order so two transfers
+       going in opposite directions can't deadlock */
+    PERFORM 1 FROM accounts
+    WHERE account_id IN (p_sender, p_receiver)
+    ORDER BY account_id
+    FOR UPDATE;
+
+    SELECT * INTO snd FROM accounts WHERE account_id = p_sender;
+    IF NOT FOUND THEN
+        status := 'sender_missing';
+        RETURN;
+    END IF;
+
+    SELECT * INTO rcv FROM accounts WHERE account_id = p_receiver;
+    IF NOT FOUND THEN
+        status := 'receiver_missing';
+        RETURN;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM account_locks
+               WHERE account_id = p_sender AND expires_at > now()) THEN
+        status := 'sender_locked';
+        RETURN;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM account_locks
+               WHERE account_id = p_receiver AND expires_at > now()) THEN
+        status := 'receiver_locked';
+        RETURN;
+    END IF;
+
+    is_tax := rcv.account_type = 1 AND snd.account_type = 0;
+
+    sender_amount := snd.amount;
+    receiver_amount := rcv.amount;
+    sender_infinite := snd.infinite;
+    receiver_infinite := rcv.infinite;
+
+    IF is_tax THEN
+        SELECT ubank, taxpaid
+        INTO sender_bank, sender_taxpaid
+        FROM wallets
+        WHERE user_id = p_sender
+        FOR UPDATE;
+
+        use_bank := sender_bank > p_amount;
+        IF NOT use_bank AND NOT sender_amount > p_amount THEN
+            status := 'no_tax_funds';
+            RETURN;
+        END IF;
+    ELSIF NOT snd.infinite AND NOT sender_amount > p_amount THEN
+        status := 'no_funds';
+        RETURN;
+    END IF;
+
+    IF use_bank THEN
+        UPDATE wallets
+        SET ubank = ubank - p_amount
+        WHERE user_id = p_sender
+        RETURNING ubank INTO sender_bank;
+    ELSIF NOT snd.infinite THEN
+        UPDATE accounts
+        SET amount = amount - p_amount
+        WHERE account_id = p_sender
+        RETURNING amount INTO sender_amount;
+    END IF;
+
+    IF is_tax THEN
+        UPDATE wallets
+        SET taxpaid = taxpaid + p_amount
+        WHERE user_id = p_sender
+        RETURNING taxpaid INTO sender_taxpaid;
+    END IF;
+
+    IF NOT rcv.infinite THEN
+        UPDATE accounts
+        SET amount = amount + p_amount
+        WHERE account_id = p_receiver
+        RETURNING amount INTO receiver_amount;
+    END IF;
+
+    status := 'ok';
+END;
+$$ LANGUAGE plpgsql;
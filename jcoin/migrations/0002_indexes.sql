@@ -0,0 +1,26 @@
+/*
+ Secondary indexes for the hot read paths, see indexes.rst
+ for which endpoint uses which.
+ */
+
+/* wallets had no key at all, every lookup by user_id was a scan */
+CREATE UNIQUE INDEX IF NOT EXISTS wallets_user_id_idx
+    ON wallets (user_id);
+
+/* leaderboards (global, taxbanks) and local ranks */
+CREATE INDEX IF NOT EXISTS accounts_type_amount_idx
+    ON accounts (account_type, amount DESC, account_id);
+
+/* taxpaid leaderboard */
+CREATE INDEX IF NOT EXISTS wallets_taxpaid_idx
+    ON wallets (taxpaid DESC, user_id);
+
+/* members' primary key starts with guild_id,
+   this one serves the "is in any guild" checks */
+CREATE INDEX IF NOT EXISTS members_user_id_idx
+    ON members (user_id, guild_id);
+
+/* tax return queries only look at unused transactions of 5JC or more */
+CREATE INDEX IF NOT EXISTS transactions_taxreturn_idx
+    ON transactions (sender, receiver, amount)
+    WHERE taxreturn_used = false AND amount >= 5;
@@ -0,0 +1,12 @@
+/*
+ Leaderboards are keyset paginated over (amount, account_id) and
+ (taxpaid, user_id), comparing both columns in the same direction.
+ Indexes with mixed directions can't bound those scans.
+ */
+DROP INDEX IF EXISTS accounts_type_amount_idx;
+CREATE INDEX accounts_type_amount_idx
+    ON accounts (account_type, amount, account_id);
+
+DROP INDEX IF EXISTS wallets_taxpaid_idx;
+CREATE INDEX wallets_taxpaid_idx
+    ON wallets (taxpaid, user_id);
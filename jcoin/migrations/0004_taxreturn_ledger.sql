@@ -0,0 +1,136 @@
+/*
+ Tax return ledger, so tax return queries don't scan the whole
+ transaction log. Backfilled from the transactions that weren't
+ returned yet, taxreturn_used is not used anymore after this.
+ */
+CREATE TABLE IF NOT EXISTS taxreturns (
+    user_id bigint NOT NULL REFERENCES accounts (account_id) ON DELETE CASCADE,
+    taxbank_id bigint NOT NULL REFERENCES accounts (account_id) ON DELETE CASCADE,
+    amount bigint NOT NULL DEFAULT 0,
+
+    /* how many transactions that amount came from */
+    count int NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, taxbank_id)
+);
+
+INSERT INTO taxreturns (user_id, taxbank_id, amount, count)
+SELECT transactions.sender, transactions.receiver,
+       round(sum(transactions.amount) * 100)::bigint, count(*)
+FROM transactions
+JOIN accounts ON transactions.receiver = accounts.account_id
+WHERE accounts.account_type = 1
+  AND transactions.amount >= 5
+  AND transactions.taxreturn_used = false
+GROUP BY transactions.sender, transactions.receiver;
+
+DROP INDEX IF EXISTS transactions_taxreturn_idx;
+
+CREATE OR REPLACE FUNCTION transfer_funds(p_sender bigint, p_receiver bigint,
+                                          p_amount bigint,
+                                          OUT status text,
+                                          OUT sender_amount bigint,
+                                          OUT receiver_amount bigint,
+                                          OUT sender_bank bigint,
+                                          OUT sender_taxpaid bigint,
+                                          OUT sender_infinite boolean,
+                                          OUT receiver_infinite boolean)
+AS $$
+DECLARE
+    snd accounts%ROWTYPE;
+    rcv accounts%ROWTYPE;
+    is_tax boolean;
+    use_bank boolean := false;
+BEGIN
+    /* lock both rows in a fixed order so two transfers
+       going in opposite directions can't deadlock */
+    PERFORM 1 FROM accounts
+    WHERE account_id IN (p_sender, p_receiver)
+    ORDER BY account_id
+    FOR UPDATE;
+
+    SELECT * INTO snd FROM accounts WHERE account_id = p_sender;
+    IF NOT FOUND THEN
+        status := 'sender_missing';
+        RETURN;
+    END IF;
+
+    SELECT * INTO rcv FROM accounts WHERE account_id = p_receiver;
+    IF NOT FOUND THEN
+        status := 'receiver_missing';
+        RETURN;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM account_locks
+               WHERE account_id = p_sender AND expires_at > now()) THEN
+        status := 'sender_locked';
+        RETURN;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM account_locks
+               WHERE account_id = p_receiver AND expires_at > now()) THEN
+        status := 'receiver_locked';
+        RETURN;
+    END IF;
+
+    is_tax := rcv.account_type = 1 AND snd.account_type = 0;
+
+    sender_amount := snd.amount;
+    receiver_amount := rcv.amount;
+    sender_infinite := snd.infinite;
+    receiver_infinite := rcv.infinite;
+
+    IF is_tax THEN
+        SELECT ubank, taxpaid
+        INTO sender_bank, sender_taxpaid
+        FROM wallets
+        WHERE user_id = p_sender
+        FOR UPDATE;
+
+        use_bank := sender_bank > p_amount;
+        IF NOT use_bank AND NOT sender_amount > p_amount THEN
+            status := 'no_tax_funds';
+            RETURN;
+        END IF;
+    ELSIF NOT snd.infinite AND NOT sender_amount > p_amount THEN
+        status := 'no_funds';
+        RETURN;
+    END IF;
+
+    IF use_bank THEN
+        UPDATE wallets
+        SET ubank = ubank - p_amount
+        WHERE user_id = p_sender
+        RETURNING ubank INTO sender_bank;
+    ELSIF NOT snd.infinite THEN
+        UPDATE accounts
+        SET amount = amount - p_amount
+        WHERE account_id = p_sender
+        RETURNING amount INTO sender_amount;
+    END IF;
+
+    IF is_tax THEN
+        UPDATE wallets
+        SET taxpaid = taxpaid + p_amount
+        WHERE user_id = p_sender
+        RETURNING taxpaid INTO sender_taxpaid;
+    END IF;
+
+    IF NOT rcv.infinite THEN
+        UPDATE accounts
+        SET amount = amount + p_amount
+        WHERE account_id = p_receiver
+        RETURNING amount INTO receiver_amount;
+    END IF;
+
+    /* tax transfers of 5JC or more count towards tax returns */
+    IF is_tax AND p_amount >= 500 THEN
+        INSERT INTO taxreturns (user_id, taxbank_id, amount, count)
+        VALUES (p_sender, p_receiver, p_amount, 1)
+        ON CONFLICT (user_id, taxbank_id)
+        DO UPDATE SET amount = taxreturns.amount + EXCLUDED.amount,
+                      count = taxreturns.count + 1;
+    END IF;
+
+    status := 'ok';
+END;
+$$ LANGUAGE plpgsql;
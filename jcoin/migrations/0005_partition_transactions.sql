@@ -0,0 +1,77 @@
+/*
+ Partition the transaction log by month. Needs Postgres 11 or newer.
+
+ The old table is copied over to the partitioned one, its idx
+ sequence is kept (as bigint, serial would overflow eventually).
+ */
+ALTER TABLE transactions RENAME TO transactions_old;
+ALTER TABLE transactions_old RENAME CONSTRAINT transactions_pkey
+    TO transactions_old_pkey;
+
+CREATE TABLE transactions (
+    idx bigint NOT NULL DEFAULT nextval('transactions_idx_seq'),
+    transferred_at timestamp without time zone NOT NULL default now(),
+
+    sender bigint NOT NULL REFERENCES accounts (account_id) ON DELETE RESTRICT,
+    receiver bigint NOT NULL REFERENCES accounts (account_id) ON DELETE RESTRICT,
+    amount numeric NOT NULL,
+
+    /* so we can search for description='steal', or something */
+    description text DEFAULT 'transfer',
+
+    /* unused since tax returns moved to the taxreturns ledger */
+    taxreturn_used boolean DEFAULT false,
+
+    PRIMARY KEY (idx, transferred_at)
+) PARTITION BY RANGE (transferred_at);
+
+ALTER SEQUENCE transactions_idx_seq AS bigint;
+ALTER SEQUENCE transactions_idx_seq OWNED BY transactions.idx;
+
+CREATE TABLE transactions_default
+PARTITION OF transactions DEFAULT;
+
+CREATE OR REPLACE FUNCTION transactions_ensure_partitions(day timestamp)
+RETURNS void AS $$
+DECLARE
+    month timestamp;
+BEGIN
+    FOR i IN 0..1 LOOP
+        month := date_trunc('month', day) + i * interval '1 month';
+
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF transactions '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'transactions_' || to_char(month, 'YYYY_MM'),
+            month, month + interval '1 month');
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+/* one partition for every month that has transactions, up to the next one */
+SELECT transactions_ensure_partitions(month)
+FROM generate_series(
+    date_trunc('month', coalesce(
+        (SELECT min(transferred_at) FROM transactions_old), now()::timestamp)),
+    now()::timestamp, interval '1 month') AS month;
+
+INSERT INTO transactions (idx, transferred_at, sender, receiver, amount,
+                          description, taxreturn_used)
+SELECT idx, coalesce(transferred_at, now()::timestamp), sender, receiver,
+       amount, description, taxreturn_used
+FROM transactions_old;
+
+DROP TABLE transactions_old;
+
+CREATE TABLE IF NOT EXISTS transactions_daily (
+    day date NOT NULL,
+    account_id bigint NOT NULL,
+    description text NOT NULL,
+
+    sent numeric NOT NULL DEFAULT 0,
+    received numeric NOT NULL DEFAULT 0,
+    sent_count int NOT NULL DEFAULT 0,
+    received_count int NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (day, account_id, description)
+);
@@ -0,0 +1,34 @@
+/*
+ Wallet change events: every change to an account or wallet sends its ID
+ on the wallet_changes channel, fanned out to clients by events.py.
+ Postgres folds identical notifications in a transaction, so a transfer
+ sends each account once.
+
+ The trigger argument is the name of the ID column.
+ */
+CREATE OR REPLACE FUNCTION notify_wallet_change() RETURNS trigger AS $$
+DECLARE
+    changed jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := to_jsonb(OLD);
+    ELSIF TG_OP = 'UPDATE' AND OLD IS NOT DISTINCT FROM NEW THEN
+        RETURN NULL;
+    ELSE
+        changed := to_jsonb(NEW);
+    END IF;
+
+    PERFORM pg_notify('wallet_changes', changed ->> TG_ARGV[0]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS accounts_notify_change ON accounts;
+CREATE TRIGGER accounts_notify_change
+    AFTER INSERT OR UPDATE OR DELETE ON accounts
+    FOR EACH ROW EXECUTE PROCEDURE notify_wallet_change('account_id');
+
+DROP TRIGGER IF EXISTS wallets_notify_change ON wallets;
+CREATE TRIGGER wallets_notify_change
+    AFTER INSERT OR UPDATE OR DELETE ON wallets
+    FOR EACH ROW EXECUTE PROCEDURE notify_wallet_change('user_id');
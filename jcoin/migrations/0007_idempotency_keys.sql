@@ -0,0 +1,18 @@
+/*
+ Responses of requests made with an Idempotency-Key, see idempotency.py.
+ status is NULL while the request is running.
+ */
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    client_id text NOT NULL,
+    key text NOT NULL,
+    fingerprint text NOT NULL,
+    created_at timestamp without time zone NOT NULL DEFAULT now(),
+
+    status int,
+    content_type text,
+    body bytea,
+    PRIMARY KEY (client_id, key)
+);
+
+CREATE INDEX IF NOT EXISTS idempotency_keys_created_at_idx
+    ON idempotency_keys (created_at);
@@ -0,0 +1,103 @@
+"""
+ranks.py - in-memory order statistics of wallets, so
+rank lookups don't need to scan the accounts table.
+"""
+import logging
+
+from sortedcontainers import SortedList
+
+log = logging.getLogger(__name__)
+
+
+class RankIndex:
+    """Order-statistic index over a value of each account.
+
+    Ranks have the same semantics as
+    ``rank() over (ORDER BY value DESC)`` in SQL: equal
+    values share the same rank, and the next rank skips.
+    """
+    def __init__(self):
+        self._values = {}
+        self._sorted = SortedList()
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, account_id: int):
+        return account_id in self._values
+
+    def load(self, rows):
+        """Replace the contents of the index with the given
+        (account_id, value) pairs."""
+        self._values = {account_id: value for account_id, value in rows}
+        self._sorted = SortedList(self._values.values())
+
+    def set(self, account_id: int, value):
+        """Insert or update the value of an account."""
+        try:
+            self._sorted.remove(self._values[account_id])
+        except KeyError:
+            pass
+
+        self._values[account_id] = value
+        self._sorted.add(value)
+
+    def remove(self, account_id: int):
+        """Remove an account from the index."""
+        try:
+            self._sorted.remove(self._values.pop(account_id))
+        except KeyError:
+            pass
+
+    def rank(self, account_id: int) -> int:
+        """Get the rank of an account, None if it isn't indexed."""
+        try:
+            value = self._values[account_id]
+        except KeyError:
+            return None
+
+        return len(self._sorted) - self._sorted.bisect_right(value) + 1
+
+
+class Ranks:
+    """Wealth and taxpaid ranks of user accounts."""
+    def __init__(self):
+        self.wealth = RankIndex()
+        self.taxes = RankIndex()
+
+    async def load(self, db):
+        """Rebuild both indexes from the database."""
+        accounts = await db.fetch("""
+        SELECT account_id, amount FROM accounts
+        WHERE account_type = 0
+        """)
+
+        wallets = await db.fetch("""
+        SELECT user_id, taxpaid FROM wallets
+        """)
+
+        self.wealth.load((r['account_id'], r['amount']) for r in accounts)
+        self.taxes.load((r['user_id'], r['taxpaid']) for r in wallets)
+
+        log.info('loaded ranks for %d accounts, %d wallets',
+                 len(self.wealth), len(self.taxes))
+
+    def add_user(self, user_id: int, amount=0, taxpaid=0):
+        """Add an user account."""
+        self.wealth.set(user_id, amount)
+        self.taxes.set(user_id, taxpaid)
+
+    def remove(self, account_id: int):
+        """Remove an account."""
+        self.wealth.remove(account_id)
+        self.taxes.remove(account_id)
+
+    def set_amount(self, account_id: int, amount):
+        """Update an account's amount, if it is an user account."""
+        if account_id in self.wealth:
+            self.wealth.set(account_id, amount)
+
+    def set_taxpaid(self, user_id: int, taxpaid):
+        """Update an user's taxpaid."""
+        if user_id in self.taxes:
+            self.taxes.set(user_id, taxpaid)
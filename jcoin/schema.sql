@@ -19,22 +19,30 @@ CREATE TABLE IF NOT EXISTS members (
     PRIMARY KEY(guild_id, user_id)
 );
 
-/* both users and taxbanks go here */
+/*
+ both users and taxbanks go here
+
+ all balances are stored as integer cents (1JC = 100).
+ */
 CREATE TABLE IF NOT EXISTS accounts (
     account_id bigint PRIMARY KEY NOT NULL,
     account_type int NOT NULL,
-    amount money DEFAULT 0
+    amount bigint NOT NULL DEFAULT 0,
+
+    /* accounts with infinite money (José), their amount is never changed */
+    infinite boolean NOT NULL DEFAULT false
 );
 
+/* compatibility view with balances in JC, use the tables on hot queries */
 CREATE VIEW account_amount as
-SELECT account_id, account_type, amount::money::numeric::float8
+SELECT account_id, account_type, amount / 100.0 AS amount, infinite
 FROM accounts;
 
 /* only user accounts here */
 CREATE TABLE IF NOT EXISTS wallets (
     user_id bigint NOT NULL REFERENCES accounts (account_id) ON DELETE CASCADE,
 
-    taxpaid money DEFAULT 0,
+    taxpaid bigint NOT NULL DEFAULT 0,
     hidecoins boolean DEFAULT false,
 
     /* for j!steal statistics */
@@ -42,17 +50,59 @@ CREATE TABLE IF NOT EXISTS wallets (
     steal_success int DEFAULT 0,
 
     /* secondary user wallets, more of a bank */
-    ubank money DEFAULT 10
+    ubank bigint NOT NULL DEFAULT 1000
 );
 
 CREATE VIEW wallets_taxpaid as
-SELECT user_id, taxpaid::numeric::float8, hidecoins, steal_uses, steal_success, ubank::numeric::float8
+SELECT user_id, taxpaid / 100.0 AS taxpaid, hidecoins, steal_uses,
+       steal_success, ubank / 100.0 AS ubank
 FROM wallets;
 
-/* The Log of all transactions */
+/*
+ Wallet change events: every change to an account or wallet sends its ID
+ on the wallet_changes channel, fanned out to clients by events.py.
+ Postgres folds identical notifications in a transaction, so a transfer
+ sends each account once.
+
+ The trigger argument is the name of the ID column.
+ */
+CREATE OR REPLACE FUNCTION notify_wallet_change() RETURNS trigger AS $$
+DECLARE
+    changed jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := to_jsonb(OLD);
+    ELSIF TG_OP = 'UPDATE' AND OLD IS NOT DISTINCT FROM NEW THEN
+        RETURN NULL;
+    ELSE
+        changed := to_jsonb(NEW);
+    END IF;
+
+    PERFORM pg_notify('wallet_changes', changed ->> TG_ARGV[0]);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS accounts_notify_change ON accounts;
+CREATE TRIGGER accounts_notify_change
+    AFTER INSERT OR UPDATE OR DELETE ON accounts
+    FOR EACH ROW EXECUTE PROCEDURE notify_wallet_change('account_id');
+
+DROP TRIGGER IF EXISTS wallets_notify_change ON wallets;
+CREATE TRIGGER wallets_notify_change
+    AFTER INSERT OR UPDATE OR DELETE ON wallets
+    FOR EACH ROW EXECUTE PROCEDURE notify_wallet_change('user_id');
+
+/*
+ The Log of all transactions.
+
+ Partitioned by month (transactions_YYYY_MM), partitions are made
+ ahead of time by transactions_ensure_partitions, and old ones are
+ archived by compact.py. Needs Postgres 11 or newer.
+ */
 CREATE TABLE IF NOT EXISTS transactions (
-    idx serial PRIMARY KEY,
-    transferred_at timestamp without time zone default now(),
+    idx bigserial,
+    transferred_at timestamp without time zone NOT NULL default now(),
 
     sender bigint NOT NULL REFERENCES accounts (account_id) ON DELETE RESTRICT,
     receiver bigint NOT NULL REFERENCES accounts (account_id) ON DELETE RESTRICT,
@@ -60,9 +110,219 @@ CREATE TABLE IF NOT EXISTS transactions (
 
     /* so we can search for description='steal', or something */
     description text DEFAULT 'transfer',
-    taxreturn_used boolean DEFAULT false
+
+    /* unused since tax returns moved to the taxreturns ledger */
+    taxreturn_used boolean DEFAULT false,
+
+    PRIMARY KEY (idx, transferred_at)
+) PARTITION BY RANGE (transferred_at);
+
+/* only gets rows if a month's partition wasn't made in time */
+CREATE TABLE IF NOT EXISTS transactions_default
+PARTITION OF transactions DEFAULT;
+
+/* Create the partitions for the month of `day` and the next one. */
+CREATE OR REPLACE FUNCTION transactions_ensure_partitions(day timestamp)
+RETURNS void AS $$
+DECLARE
+    month timestamp;
+BEGIN
+    FOR i IN 0..1 LOOP
+        month := date_trunc('month', day) + i * interval '1 month';
+
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF transactions '
+            'FOR VALUES FROM (%L) TO (%L)',
+            'transactions_' || to_char(month, 'YYYY_MM'),
+            month, month + interval '1 month');
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT transactions_ensure_partitions(now()::timestamp);
+
+/*
+ Per account daily summaries of archived transaction partitions,
+ the raw rows are exported to files (see compact.py).
+ */
+CREATE TABLE IF NOT EXISTS transactions_daily (
+    day date NOT NULL,
+    account_id bigint NOT NULL,
+    description text NOT NULL,
+
+    sent numeric NOT NULL DEFAULT 0,
+    received numeric NOT NULL DEFAULT 0,
+    sent_count int NOT NULL DEFAULT 0,
+    received_count int NOT NULL DEFAULT 0,
+
+    PRIMARY KEY (day, account_id, description)
 );
 
+/*
+ Account locks, used by steals and heists.
+
+ Locks are leases: they stop applying after expires_at, so a crashed
+ client can't leave an account locked forever.
+ */
+CREATE TABLE IF NOT EXISTS account_locks (
+    account_id bigint PRIMARY KEY,
+    expires_at timestamp without time zone NOT NULL
+);
+
+/* indexes for the hot read paths, see indexes.rst */
+CREATE UNIQUE INDEX IF NOT EXISTS wallets_user_id_idx
+    ON wallets (user_id);
+
+CREATE INDEX IF NOT EXISTS accounts_type_amount_idx
+    ON accounts (account_type, amount, account_id);
+
+CREATE INDEX IF NOT EXISTS wallets_taxpaid_idx
+    ON wallets (taxpaid, user_id);
+
+CREATE INDEX IF NOT EXISTS members_user_id_idx
+    ON members (user_id, guild_id);
+
+/*
+ Tax return ledger: tax paid by each user to each taxbank that
+ can still be returned, in cents.
+ Updated by transfer_funds and consumed by j!taxreturn withdraw.
+ */
+CREATE TABLE IF NOT EXISTS taxreturns (
+    user_id bigint NOT NULL REFERENCES accounts (account_id) ON DELETE CASCADE,
+    taxbank_id bigint NOT NULL REFERENCES accounts (account_id) ON DELETE CASCADE,
+    amount bigint NOT NULL DEFAULT 0,
+
+    /* how many transactions that amount came from */
+    count int NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, taxbank_id)
+);
+
+/*
+ Transfer funds between two accounts in a single round trip.
+
+ Amounts are in cents.
+
+ Checks balances and updates the sender (wallet or personal bank, for tax
+ transfers) and the receiver, all in the same statement. Tax transfers
+ also go to the tax return ledger. Logging the
+ transaction is left to the caller (see jcoin/manager.py).
+ Failed checks don't touch anything and only set `status`:
+
+  'ok', 'sender_missing', 'receiver_missing', 'sender_locked',
+  'receiver_locked', 'no_funds', 'no_tax_funds'
+
+ the amounts returned are the balances after the transfer
+ (or the current ones, on failure).
+ */
+CREATE OR REPLACE FUNCTION transfer_funds(p_sender bigint, p_receiver bigint,
+                                          p_amount bigint,
+                                          OUT status text,
+                                          OUT sender_amount bigint,
+                                          OUT receiver_amount bigint,
+                                          OUT sender_bank bigint,
+                                          OUT sender_taxpaid bigint,
+                                          OUT sender_infinite boolean,
+                                          OUT receiver_infinite boolean)
+AS $$
+DECLARE
+    snd accounts%ROWTYPE;
+    rcv accounts%ROWTYPE;
+    is_tax boolean;
+    use_bank boolean := false;
+BEGIN
+    /* lock both rows in a fixed order so two transfers
+       going in opposite directions can't deadlock */
+    PERFORM 1 FROM accounts
+    WHERE account_id IN (p_sender, p_receiver)
+    ORDER BY account_id
+    FOR UPDATE;
+
+    SELECT * INTO snd FROM accounts WHERE account_id = p_sender;
+    IF NOT FOUND THEN
+        status := 'sender_missing';
+        RETURN;
+    END IF;
+
+    SELECT * INTO rcv FROM accounts WHERE account_id = p_receiver;
+    IF NOT FOUND THEN
+        status := 'receiver_missing';
+        RETURN;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM account_locks
+               WHERE account_id = p_sender AND expires_at > now()) THEN
+        status := 'sender_locked';
+        RETURN;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM account_locks
+               WHERE account_id = p_receiver AND expires_at > now()) THEN
+        status := 'receiver_locked';
+        RETURN;
+    END IF;
+
+    is_tax := rcv.account_type = 1 AND snd.account_type = 0;
+
+    sender_amount := snd.amount;
+    receiver_amount := rcv.amount;
+    sender_infinite := snd.infinite;
+    receiver_infinite := rcv.infinite;
+
+    IF is_tax THEN
+        SELECT ubank, taxpaid
+        INTO sender_bank, sender_taxpaid
+        FROM wallets
+        WHERE user_id = p_sender
+        FOR UPDATE;
+
+        use_bank := sender_bank > p_amount;
+        IF NOT use_bank AND NOT sender_amount > p_amount THEN
+            status := 'no_tax_funds';
+            RETURN;
+        END IF;
+    ELSIF NOT snd.infinite AND NOT sender_amount > p_amount THEN
+        status := 'no_funds';
+        RETURN;
+    END IF;
+
+    IF use_bank THEN
+        UPDATE wallets
+        SET ubank = ubank - p_amount
+        WHERE user_id = p_sender
+        RETURNING ubank INTO sender_bank;
+    ELSIF NOT snd.infinite THEN
+        UPDATE accounts
+        SET amount = amount - p_amount
+        WHERE account_id = p_sender
+        RETURNING amount INTO sender_amount;
+    END IF;
+
+    IF is_tax THEN
+        UPDATE wallets
+        SET taxpaid = taxpaid + p_amount
+        WHERE user_id = p_sender
+        RETURNING taxpaid INTO sender_taxpaid;
+    END IF;
+
+    IF NOT rcv.infinite THEN
+        UPDATE accounts
+        SET amount = amount + p_amount
+        WHERE account_id = p_receiver
+        RETURNING amount INTO receiver_amount;
+    END IF;
+
+    /* tax transfers of 5JC or more count towards tax returns */
+    IF is_tax AND p_amount >= 500 THEN
+        INSERT INTO taxreturns (user_id, taxbank_id, amount, count)
+        VALUES (p_sender, p_receiver, p_amount, 1)
+        ON CONFLICT (user_id, taxbank_id)
+        DO UPDATE SET amount = taxreturns.amount + EXCLUDED.amount,
+                      count = taxreturns.count + 1;
+    END IF;
+
+    status := 'ok';
+END;
+$$ LANGUAGE plpgsql;
 
 /* Steal related stuff */
 CREATE TYPE cooldown_type AS ENUM ('prison', 'points');
@@ -118,6 +378,25 @@ CREATE TABLE IF NOT EXISTS taxreturn_cooldown (
     finish timestamp without time zone default now()
 );
 
+/*
+ Responses of requests made with an Idempotency-Key, see idempotency.py.
+ status is NULL while the request is running.
+ */
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    client_id text NOT NULL,
+    key text NOT NULL,
+    fingerprint text NOT NULL,
+    created_at timestamp without time zone NOT NULL DEFAULT now(),
+
+    status int,
+    content_type text,
+    body bytea,
+    PRIMARY KEY (client_id, key)
+);
+
+CREATE INDEX IF NOT EXISTS idempotency_keys_created_at_idx
+    ON idempotency_keys (created_at);
+
 /* <3 */
 CREATE TABLE relationships (
     user_id bigint NOT NULL,
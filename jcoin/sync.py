@@ -0,0 +1,206 @@
+"""
+sync.py - share changes to the in-memory state between workers.
+
+Each server process has its own rank index, economy totals and
+token cache. A worker applies its changes to its own state right
+away, and sends them to the other workers over NOTIFY, in batches
+of at most ``interval`` seconds.
+
+Changes are absolute (the new amount of an account, not how much
+it changed), and state_refresh in josecoin.py reloads everything
+from time to time, so a lost or reordered batch doesn't stay wrong.
+"""
+import asyncio
+import json
+import logging
+import uuid
+
+log = logging.getLogger(__name__)
+
+CHANNEL = 'jcoin_state'
+
+# NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD = 7000
+
+
+class StateSync:
+    """Apply changes to the server's state, and to the other workers'.
+
+    Without ``enabled`` (with a single worker), changes are
+    only applied here.
+    """
+    def __init__(self, app, *, enabled: bool, interval: float = 0.05):
+        self.app = app
+        self.enabled = enabled
+        self.interval = interval
+
+        #: tells our own notifications apart
+        self.worker_id = uuid.uuid4().hex
+
+        self._pending = []
+        self._task = None
+
+        #: how many notifications were sent / received
+        self.sent = 0
+        self.received = 0
+
+    @property
+    def loop(self):
+        return asyncio.get_event_loop()
+
+    def apply(self, op: str, *args):
+        """Apply a change to this worker's state."""
+        app = self.app
+
+        if op == 'amount':
+            account_id, amount = args
+            app.ranks.set_amount(account_id, amount)
+            app.economy.set_amount(account_id, amount)
+        elif op == 'taxpaid':
+            user_id, taxpaid = args
+            app.ranks.set_taxpaid(user_id, taxpaid)
+        elif op == 'add':
+            account_id, account_type = args
+
+            # a rank lookup may have added it already
+            if account_type == 0 and account_id not in app.ranks.wealth:
+                app.ranks.add_user(account_id)
+
+            if account_id not in app.economy:
+                app.economy.add_account(account_id, account_type)
+        elif op == 'remove':
+            account_id, steal_uses, steal_success = args
+            app.ranks.remove(account_id)
+            app.economy.remove_account(account_id, steal_uses, steal_success)
+        elif op == 'steals':
+            steal_uses, steal_success = args
+            app.economy.steal_uses += steal_uses
+            app.economy.steal_success += steal_success
+        elif op == 'token':
+            token, = args
+            app.tokens.invalidate(token)
+
+            # misses go to the database anyways, this only warms it
+            if token is None:
+                self.loop.create_task(app.tokens.load())
+        else:
+            log.warning('unknown state change %r', op)
+
+    def change(self, op: str, *args):
+        """Apply a change here, and send it to the other workers.
+
+        Parameters
+        ----------
+        op: str
+            What changed, one of ``amount`` (account ID, amount),
+            ``taxpaid`` (user ID, taxpaid), ``add`` (account ID,
+            account type), ``remove`` (account ID, steal uses,
+            steal successes), ``steals`` (steal uses, steal
+            successes to add) and ``token`` (the token, None
+            for all of them).
+        """
+        self.apply(op, *args)
+
+        if self.enabled:
+            self._pending.append([op, *args])
+
+    def _payloads(self, changes: list):
+        """Split changes into NOTIFY payloads."""
+        chunk, size = [], 0
+        for change in changes:
+            item = json.dumps(change)
+            if chunk and size + len(item) > MAX_PAYLOAD:
+                yield self._payload(chunk)
+                chunk, size = [], 0
+
+            chunk.append(item)
+            size += len(item) + 1
+
+        if chunk:
+            yield self._payload(chunk)
+
+    def _payload(self, items: list) -> str:
+        return (f'{{"worker": "{self.worker_id}", '
+                f'"changes": [{",".join(items)}]}}')
+
+    async def flush(self):
+        """Send the pending changes."""
+        if not self._pending:
+            return
+
+        changes, self._pending = self._pending, []
+        for payload in self._payloads(changes):
+            await self.app.db.execute("""
+            SELECT pg_notify($1, $2)
+            """, CHANNEL, payload)
+            self.sent += 1
+
+    async def flush_task(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # the others catch up on their next refresh
+                log.exception('failed to send state changes')
+
+    def _on_notify(self, conn, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+        except ValueError:
+            log.warning('invalid state change payload %r', payload)
+            return
+
+        if message.get('worker') == self.worker_id:
+            return
+
+        self.received += 1
+        for op, *args in message.get('changes', []):
+            try:
+                self.apply(op, *args)
+            except Exception:
+                log.exception('failed to apply state change %r', op)
+
+    async def reload(self):
+        """Reload everything, for when changes were lost."""
+        self.app.tokens.invalidate()
+        await self.app.ranks.load(self.app.db)
+        await self.app.economy.load(self.app.db)
+
+    def _on_lost(self):
+        self.loop.create_task(self.reload())
+
+    def start(self):
+        """Start sending and receiving changes.
+
+        Must be called before the events listener starts.
+        """
+        if not self.enabled:
+            return
+
+        self.app.events.listen(CHANNEL, self._on_notify, self._on_lost)
+        self._task = self.loop.create_task(self.flush_task())
+
+    async def close(self):
+        """Stop, sending whatever is left."""
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        self._task = None
+
+        try:
+            await self.flush()
+        except Exception:
+            log.exception('failed to send the last state changes')
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'pending': len(self._pending),
+            'sent': self.sent,
+            'received': self.received,
+        }
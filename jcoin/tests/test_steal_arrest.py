@@ -0,0 +1,98 @@
+"""
+Tests for steal_arrest, against a real database.
+
+Needs the server's requirements and a database made with
+``python3 migrate.py init``, given by the JCOIN_TEST_DSN
+environment variable. Everything runs in a transaction
+that is rolled back, nothing is left behind.
+
+usage:
+    JCOIN_TEST_DSN=postgres://... python3 -m pytest tests
+"""
+import asyncio
+import decimal
+import os
+import sys
+
+import pytest
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+asyncpg = pytest.importorskip('asyncpg')
+pytest.importorskip('sanic')
+pytest.importorskip('config')
+
+import josecoin  # noqa: E402
+
+DSN = os.environ.get('JCOIN_TEST_DSN')
+pytestmark = pytest.mark.skipif(not DSN, reason='JCOIN_TEST_DSN not set')
+
+THIEF_ID = 9000000000000000001
+GUILD_ID = 9000000000000000002
+
+
+def run(coro):
+    return asyncio.get_event_loop().run_until_complete(coro)
+
+
+async def arrest(thief_cents: int, amount: str) -> tuple:
+    """Arrest a thief with ``thief_cents`` for trying to steal
+    ``amount``, returning the result of steal_arrest and the
+    amounts of the thief and the taxbank after it."""
+    conn = await asyncpg.connect(DSN)
+    tr = conn.transaction()
+    await tr.start()
+    try:
+        await conn.execute("""
+        INSERT INTO accounts (account_id, account_type, amount)
+        VALUES ($1, 0, $2), ($3, 1, 0)
+        """, THIEF_ID, thief_cents, GUILD_ID)
+
+        # an empty bank, or tax transfers are paid from it
+        await conn.execute("""
+        INSERT INTO wallets (user_id, ubank) VALUES ($1, 0)
+        """, THIEF_ID)
+
+        thief = await conn.fetchrow("""
+        SELECT account_id, account_type, amount, infinite
+        FROM accounts WHERE account_id = $1
+        """, THIEF_ID)
+
+        res = await josecoin.steal_arrest(conn, thief, GUILD_ID,
+                                          decimal.Decimal(amount))
+
+        amounts = await conn.fetch("""
+        SELECT account_id, amount FROM accounts
+        WHERE account_id = ANY($1::bigint[])
+        """, [THIEF_ID, GUILD_ID])
+
+        return res, {r['account_id']: r['amount'] for r in amounts}
+    finally:
+        await tr.rollback()
+        await conn.close()
+
+
+def test_arrest_pays_half():
+    (hours, transfer), amounts = run(arrest(1000, '4'))
+
+    assert hours == josecoin.STEAL_ARREST_HOURS
+    assert transfer[2] == decimal.Decimal('2.00')
+    assert amounts == {THIEF_ID: 800, GUILD_ID: 200}
+
+
+def test_big_jail_takes_the_wallet():
+    (hours, transfer), amounts = run(arrest(500, '20'))
+
+    # all but a cent, see steal_arrest
+    assert hours == josecoin.STEAL_ARREST_HOURS + 4
+    assert transfer[2] == decimal.Decimal('4.99')
+    assert amounts == {THIEF_ID: 1, GUILD_ID: 499}
+
+
+def test_big_jail_empty_wallet():
+    (hours, transfer), amounts = run(arrest(1, '20'))
+
+    assert hours == josecoin.STEAL_ARREST_HOURS
+    assert transfer is None
+    assert amounts == {THIEF_ID: 1, GUILD_ID: 0}
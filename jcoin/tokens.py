@@ -0,0 +1,100 @@
+"""
+tokens.py - in-process cache of client tokens, so
+requests don't need a round trip to Postgres to be
+authenticated.
+"""
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class TokenCache:
+    """Cache client rows by their token.
+
+    Entries expire after ``ttl`` seconds, after that
+    (or on a miss) the client is fetched again from
+    the ``clients`` table.
+    """
+    def __init__(self, app, ttl: int = 300):
+        self.app = app
+        self.ttl = ttl
+        self._cache = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def db(self):
+        return self.app.db
+
+    async def load(self):
+        """Load all clients into the cache."""
+        rows = await self.db.fetch("""
+        SELECT token, client_id, client_name, auth_level FROM clients
+        """)
+
+        expires = time.monotonic() + self.ttl
+        self._cache = {
+            row['token']: (self._to_client(row), expires)
+            for row in rows
+        }
+
+        log.info('loaded %d client tokens', len(self._cache))
+
+    @staticmethod
+    def _to_client(row) -> dict:
+        return {
+            'client_id': row['client_id'],
+            'client_name': row['client_name'],
+            'auth_level': row['auth_level'],
+        }
+
+    async def get(self, token: str) -> dict:
+        """Get the client that has this token.
+
+        Returns None if the token is not
+        assigned to any client.
+        """
+        now = time.monotonic()
+
+        try:
+            client, expires = self._cache[token]
+            if now < expires:
+                self.hits += 1
+                return client
+        except KeyError:
+            pass
+
+        self.misses += 1
+        row = await self.db.fetchrow("""
+        SELECT client_id, client_name, auth_level FROM clients
+        WHERE token=$1
+        """, token)
+
+        if row is None:
+            self._cache.pop(token, None)
+            return None
+
+        client = self._to_client(row)
+        self._cache[token] = (client, now + self.ttl)
+        return client
+
+    def invalidate(self, token: str = None):
+        """Remove a token from the cache.
+
+        Removes all tokens if none is given.
+        """
+        if token is None:
+            self._cache.clear()
+            return
+
+        self._cache.pop(token, None)
+
+    @property
+    def stats(self) -> dict:
+        return {
+            'size': len(self._cache),
+            'hits': self.hits,
+            'misses': self.misses,
+        }